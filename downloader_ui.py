@@ -103,20 +103,13 @@ def main():
     so=st.empty()
     with rd.stdout(to=so):
         if run_button:
-            downloader = Downloader(email, start_date, end_date, [wavelength], instrument, cadence, file_format, path, download_limit, get_spike)
+            downloader = Downloader(email, start_date, end_date, [wavelength], instrument, cadence, file_format, path, download_limit, get_spike,
+                                    query_cache=os.path.join(path, 'query_cache.sqlite'))
     
             st.write("💪😎 We be balling 🏀⛹️")
 
-            request = downloader.create_query_request() # create drms client query request.
-            is_larger = False
-            for i in request:
-                if i.shape[0] > downloader.download_limit:
-                    print(f'Download request of {i.shape[0]} files is larger than download limit of {downloader.download_limit} files')
-                    is_larger = True
-                    break
-
-            if not is_larger:
-                downloader.download_data()
+            # Requests larger than the download limit are thinned to fit within it
+            downloader.download_data()
 
 
     # https://discuss.streamlit.io/t/multiple-images-along-the-same-row/118/7
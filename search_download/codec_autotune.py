@@ -0,0 +1,253 @@
+"""
+Codec autotuning for SDO zarr stores.  Samples frames from a store and measures, for every
+storage encoding and Blosc compressor, level and shuffle filter, the compression ratio, the
+compression and decoding speed and the error of the encoding, so that fits_to_zarr and
+zarr_to_jpg can be run with settings measured on our own data.
+
+Each (frame, channel) image of the samples is compressed on its own, like the chunks of a
+store with the default chunking.  Ratios are relative to float32 (or to the stored type for
+stores that are not float), and decoding includes the int16 to float32 conversion.
+
+Example:
+python -m search_download.codec_autotune --zarr_path /mnt/data.zarr --n_samples 16 --min_decode_mb_s 500
+
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from search_download.sdo_zarr import (SHUFFLES, channel_scale_offset, encode_stack, make_compressor,
+                                      open_sdo_store, select_valid_frames)
+
+CNAMES = ["lz4", "lz4hc", "zstd", "zlib", "blosclz"]
+CLEVELS = [1, 3, 5, 9]
+
+
+def sample_store(zarr_path: str = None, dataset_name: str = None, n_samples: int = 8):
+    """
+    Read n_samples frames evenly spaced among the valid frames of a store
+
+    Parameters:
+        zarr_path: (str)
+            Path of the store
+        dataset_name: (str)
+            Name of the stacks array, the first four dimensional array if None
+        n_samples: (int)
+            Number of frames
+
+    Returns:
+        samples: (numpy.ndarray)
+            (frame, channel, y, x) stacks, decoded to float32 unless stored as integers
+    """
+    data = open_sdo_store(zarr_path)
+    if dataset_name is None:
+        dataset_name = next(name for name, array in data.data_vars.items() if array.ndim == 4)
+    stacks = data[dataset_name]
+    if "valid" in stacks.coords:
+        stacks = select_valid_frames(stacks)
+    if stacks.shape[0] == 0:
+        raise ValueError(f"{zarr_path} has no valid frames to sample")
+    positions = np.unique(np.linspace(0, stacks.shape[0] - 1, n_samples).round().astype(int))
+    return stacks.isel(t_obs=positions).values
+
+
+def encode_samples(samples: np.ndarray = None, encoding: str = "float32"):
+    """
+    Encode samples like fits_to_zarr would
+
+    Parameters:
+        samples: (numpy.ndarray)
+            (frame, channel, y, x) stacks
+        encoding: (str)
+            float32, float16, int16 or uint8 (stores of zarr_to_jpg)
+
+    Returns:
+        encoded: (numpy.ndarray)
+            Stored values
+        decode: (function)
+            Converts stored values back to float32
+    """
+    if encoding == "int16":
+        scale, offset = channel_scale_offset(samples)
+        encoded = np.stack([encode_stack(stack, scale, offset) for stack in samples])
+        scale, offset = scale.astype(np.float32)[:, None, None], offset.astype(np.float32)[:, None, None]
+
+        def decode(image, channel):
+            decoded = image.astype(np.float32) * scale[channel] + offset[channel]
+            decoded[image == np.iinfo("i2").min] = np.nan
+            return decoded
+
+        return encoded, decode
+    dtypes = {"float32": "f4", "float16": "f2", "uint8": "u1"}
+    if encoding not in dtypes:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {list(dtypes) + ['int16']}")
+    if encoding == "float16":
+        samples = np.clip(samples, -np.finfo("f2").max, np.finfo("f2").max)
+    return samples.astype(dtypes[encoding]), lambda image, channel: image.astype(np.float32)
+
+
+def benchmark_codec(encoded: np.ndarray = None, decode=None, compressor=None, reference_bytes: int = None,
+                    repeats: int = 3):
+    """
+    Compress and decode every (frame, channel) image with a compressor
+
+    Parameters:
+        encoded: (numpy.ndarray)
+            (frame, channel, y, x) stored values
+        decode: (function)
+            Converts stored values of a channel back to float32, see encode_samples
+        compressor: (numcodecs codec)
+            Compressor to measure
+        reference_bytes: (int)
+            Bytes the ratio is relative to, by default those of encoded
+        repeats: (int)
+            Number of timed repetitions, the fastest one is kept
+
+    Returns:
+        result: (dict)
+            ratio, compress_mb_s and decode_mb_s (MB of decoded float32 per second)
+    """
+    images = [(channel, np.ascontiguousarray(image)) for stack in encoded for channel, image in enumerate(stack)]
+    reference_bytes = encoded.nbytes if reference_bytes is None else reference_bytes
+    decoded_bytes = encoded.size * 4
+
+    compress_seconds, decode_seconds = np.inf, np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        compressed = [(channel, compressor.encode(image)) for channel, image in images]
+        compress_seconds = min(compress_seconds, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for (channel, buffer), (_, image) in zip(compressed, images):
+            decode(np.frombuffer(compressor.decode(buffer), dtype=image.dtype).reshape(image.shape), channel)
+        decode_seconds = min(decode_seconds, time.perf_counter() - start)
+
+    compressed_bytes = sum(len(buffer) for _, buffer in compressed)
+    return {
+        "ratio": reference_bytes / compressed_bytes,
+        "compress_mb_s": encoded.nbytes / compress_seconds / 1e6,
+        "decode_mb_s": decoded_bytes / decode_seconds / 1e6,
+    }
+
+
+def autotune(samples: np.ndarray = None, encodings: list = None, cnames: list = None, clevels: list = None,
+             shuffles: list = None, repeats: int = 3):
+    """
+    Measure every combination of encoding, compressor, level and shuffle filter on samples
+
+    Parameters:
+        samples: (numpy.ndarray)
+            (frame, channel, y, x) stacks, see sample_store
+        encodings: (list)
+            Encodings, by default float32, float16 and int16 for float samples and uint8 otherwise
+        cnames: (list)
+            Blosc compressors, by default CNAMES
+        clevels: (list)
+            Compression levels, by default CLEVELS
+        shuffles: (list)
+            Shuffle filters, by default all of SHUFFLES
+        repeats: (int)
+            Number of timed repetitions
+
+    Returns:
+        results: (pandas.DataFrame)
+            One row per combination with its ratio, speeds and the maximum absolute and
+            root mean square error of the encoding, sorted by decreasing ratio
+    """
+    if encodings is None:
+        encodings = ["float32", "float16", "int16"] if samples.dtype.kind == "f" else ["uint8"]
+    cnames = CNAMES if cnames is None else cnames
+    clevels = CLEVELS if clevels is None else clevels
+    shuffles = list(SHUFFLES) if shuffles is None else shuffles
+    reference = samples.astype(np.float32) if samples.dtype.kind == "f" else samples
+
+    results = []
+    for encoding in encodings:
+        encoded, decode = encode_samples(samples, encoding)
+        decoded = np.stack([np.stack([decode(image, channel) for channel, image in enumerate(stack)])
+                            for stack in encoded])
+        error = np.abs(decoded - reference)[np.isfinite(reference)]
+        for cname in cnames:
+            for clevel in clevels:
+                for shuffle in shuffles:
+                    result = benchmark_codec(encoded, decode, make_compressor(cname, clevel, shuffle),
+                                             reference_bytes=reference.nbytes, repeats=repeats)
+                    results.append({"encoding": encoding, "cname": cname, "clevel": clevel, "shuffle": shuffle,
+                                    **result, "max_error": error.max(initial=0),
+                                    "rmse": np.sqrt(np.mean(error ** 2)) if error.size else 0})
+    return pd.DataFrame(results).sort_values("ratio", ascending=False, ignore_index=True)
+
+
+def pick_codec(results: pd.DataFrame = None, min_decode_mb_s: float = None, max_error: float = None):
+    """
+    Combination with the best ratio among those decoding fast enough and accurate enough
+
+    Parameters:
+        results: (pandas.DataFrame)
+            Output of autotune
+        min_decode_mb_s: (float)
+            Minimum decoding speed, no minimum if None
+        max_error: (float)
+            Maximum absolute error of the encoding, 0 for lossless, no maximum if None
+
+    Returns:
+        result: (pandas.Series)
+            Row of results, None if no combination qualifies
+    """
+    selected = results
+    if min_decode_mb_s is not None:
+        selected = selected[selected.decode_mb_s >= min_decode_mb_s]
+    if max_error is not None:
+        selected = selected[selected.max_error <= max_error]
+    if selected.empty:
+        return None
+    return selected.loc[selected.ratio.idxmax()]
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments to script.
+
+    Parameters:
+        args (list):    defaults to parsing any command line arguments
+
+    Returns:
+        parser args:    Namespace from argparse
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zarr_path", type=str, required=True, help="Path of the zarr store to sample")
+    parser.add_argument("--dataset_name", type=str, default=None, help="Stacks array, the first 4D array by default")
+    parser.add_argument("--n_samples", type=int, default=8, help="Number of frames to sample")
+    parser.add_argument("--encodings", type=str, nargs="+", default=None,
+                        help="Encodings to measure, float32 float16 int16 by default")
+    parser.add_argument("--cnames", type=str, nargs="+", default=CNAMES, help="Blosc compressors to measure")
+    parser.add_argument("--clevels", type=int, nargs="+", default=CLEVELS, help="Compression levels to measure")
+    parser.add_argument("--shuffles", type=str, nargs="+", default=list(SHUFFLES), help="Shuffle filters to measure")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repetitions of every measurement")
+    parser.add_argument("--min_decode_mb_s", type=float, default=None, help="Minimum decoding speed of the pick")
+    parser.add_argument("--max_error", type=float, default=None,
+                        help="Maximum absolute error of the pick, 0 for lossless")
+    parser.add_argument("--output", type=str, default=None, help="csv file to write the results to")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parser_output = parse_args()
+    samples = sample_store(parser_output.zarr_path, parser_output.dataset_name, parser_output.n_samples)
+    results = autotune(samples, parser_output.encodings, parser_output.cnames, parser_output.clevels,
+                       parser_output.shuffles, parser_output.repeats)
+    print(results.to_string(index=False))
+    if parser_output.output is not None:
+        results.to_csv(parser_output.output, index=False)
+
+    best = pick_codec(results, parser_output.min_decode_mb_s, parser_output.max_error)
+    if best is None:
+        print("No combination meets the constraints")
+    else:
+        print(f"Best: {best.to_dict()}")
+        flags = f"--cname {best.cname} --clevel {best.clevel} --shuffle {best.shuffle}"
+        if best.encoding != "uint8":
+            flags = f"--encoding {best.encoding} " + flags
+        print(f"Flags: {flags}")
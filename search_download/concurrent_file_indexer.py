@@ -1,93 +1,80 @@
 import argparse
-import glob
 import logging
 import os
-import re
 
-import dateutil.parser as dt
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from sunpy.map import Map
 
-import dask
-from dask.delayed import delayed
-from tqdm.dask import TqdmCallback
+from search_download.file_index import FileIndex
 
-def _filename_to_date(data_filename):
-    """ Takes a single path to an AIA or HMI file and returns its associated date   
-    Assumes that the files have the date within their name in the following format:
-        YYYYMMDD_hhmmss
-
-    Parameters
-    ----------
-    data_filename: str
-        path to an HMI or AIA file
-    Returns
-    -------
-    dt.datetime associated with the file    
-    """
-    try:
-        date_string = re.search(r"\d{8}_\d{6}(?!.+\d{8}_\d{6}.+)", data_filename).group().replace('_', 'T')
-    except:
-        date_string = data_filename.split("_")[-1].split('.')[0]
-    
-    return dt.isoparse(date_string)
+logger = logging.getLogger(__name__)
 
 
-    
-def filenames_to_dates(data_filenames, debug=False):
-    """ load dates from filenames for both AIA and HMI. it    
-    Assumes that the files have the date within their name in the following format:
-        YYYYMMDD_hhmmss
+def channel_tolerance(tolerance, sufix, n, cadence):
+    """ Pick the matching tolerance of a channel
 
     Parameters
     ----------
-    data_filenames: List of Lists
-        path names of the AIA files as a list of list, with each list in the list corresponding to
-        an AIA wavelength.  In the case of HMI it should be a list of lists with a single list of hmi files.
-    debug: 
-        if True select only the first 10 dates.
+    tolerance: None, a frequency string / Timedelta shared by all channels, a dict keyed by
+        sufix or a list in channel order
+    sufix: sufix of the channel
+    n: position of the channel
+    cadence: cadence of the reference grid, half of it is the default tolerance
 
     Returns
     -------
-    List of lists with files converted to datetimes.
+    pd.Timedelta
     """
-    iso_dates = [[_filename_to_date(file) for file in wl_files] for wl_files in data_filenames]
-    return iso_dates
+    if isinstance(tolerance, dict):
+        tolerance = tolerance.get(sufix)
+    elif isinstance(tolerance, (list, tuple)):
+        tolerance = tolerance[n]
+    if tolerance is None:
+        return pd.Timedelta(cadence) / 2
+    return pd.Timedelta(tolerance)
 
 
-def create_date_file_df(dates, files, sufix, dt_round='3min', debug=False):
-    """ Parse a list of datetimes and files into dataframe
+def match_channel(slots, dates, files, sufix, tolerance):
+    """ Match every slot of a reference grid with the closest file of a channel using a
+    sorted nearest-neighbour search (pd.merge_asof), O(n log n) in the number of files
 
     Parameters
     ----------
-    dates: list of dates
-    files: list of filepaths
+    slots: pd.DatetimeIndex with the times of the reference grid
+    dates: list of channel datetimes
+    files: list of filepaths of the channel
     sufix: string to use in the creation of the columns of the df.  Typically an
             AIA wavelength or the name 'hmi'
-    dt_round: frequency alias to round dates
-        see https://pandas.pydata.org/docs/reference/api/pandas.Series.dt.round.html
-    debug: Whether to use only a small set of the files (10)
-
+    tolerance: pd.Timedelta with the largest time offset accepted for a match
 
     Returns
     -------
-    pandas df with datetime index and paths
+    pandas df indexed by slot time with the file and its offset to the slot in seconds, only
+    for the slots that found a file
     """
-    df1 = pd.DataFrame(data={'dates':dates, f'files_{sufix}':files})
-    df1['dates'] = df1['dates'].dt.round(dt_round)
-    # Drop duplictaes in case datetimes round to the same value
-    df1 = df1.drop_duplicates(subset='dates', keep='first')
-    df1 = df1.set_index('dates', drop=True)
+    channel = pd.DataFrame({'file_dates': pd.to_datetime(pd.Series(dates)).to_numpy(), f'files_{sufix}': list(files)})
+    channel = channel.dropna(subset=['file_dates']).sort_values('file_dates', kind='stable')
+    grid = pd.DataFrame({'dates': pd.DatetimeIndex(slots).sort_values()})
+    channel['file_dates'] = channel['file_dates'].astype(grid['dates'].dtype)
 
-    if debug:
-        df1 = df1.iloc[::debug,:]
+    df = pd.merge_asof(grid, channel, left_on='dates', right_on='file_dates',
+                       direction='nearest', tolerance=tolerance)
+    df = df.dropna(subset=[f'files_{sufix}'])
+    df[f'offset_{sufix}'] = (df['file_dates'] - df['dates']).dt.total_seconds()
+
+    return df.set_index('dates', drop=True).drop(columns='file_dates')
 
-    return df1
 
+def match_file_times(all_iso_dates, all_filenames, all_sufixes, joint_df=None, debug=False,
+                     cadence='3min', tolerance=None, offsets=False, unique=True):
+    """ Match the files of several channels on a common cadence.  Every channel is matched
+    to the slots of a reference grid by nearest time within a tolerance (see match_channel),
+    and only the slots where every channel found a file are kept.
 
-def match_file_times(all_iso_dates, all_filenames, all_sufixes, joint_df=None, debug=False):
-    """ Parses aia_iso_dates and compile lists at the same time"
+    The grid has the given cadence over the time range covered by all channels or, if
+    joint_df is given, it is the index of joint_df.  This way AIA channels can be matched on
+    their own grid and HMI magnetograms on a 720s cadence can then be matched to the AIA
+    slots they are closest to.
 
     Parameters
     ----------
@@ -95,27 +82,172 @@ def match_file_times(all_iso_dates, all_filenames, all_sufixes, joint_df=None, d
     all_filenames: filenames of AIA files
     all_sufixes: list of strings to use in the creation of the columns of the df.  Typically
             AIA wavelengths or the name 'hmi'
-    joint_df: pandas dataframe to use as a starting point
+    joint_df: pandas dataframe to use as a starting point, its index is used as grid
     debug: Whether to use only a small set of the files (10)
+    cadence: frequency alias of the reference grid
+        see https://pandas.pydata.org/docs/user_guide/timeseries.html#offset-aliases
+    tolerance: largest offset between a file and its slot, either one value for all
+        channels, a dict keyed by sufix or a list in channel order.  Defaults to half the
+        cadence, which matches the files that used to round to the slot
+    offsets: if True, keep an offset_{sufix} column with the time of each file minus the
+        time of its slot, in seconds
+    unique: if True, a file that matched several slots (tolerances over half the cadence, or
+        a joint_df grid finer than the channel) is only kept in the slot where the matched
+        files are closest overall
 
     Returns
     -------
     pandas dataframe of matching datetimes
     """
-
-    for n, (aia_iso_dates, aia_filenames, sufix) in enumerate(zip(all_iso_dates, all_filenames, all_sufixes)):
-        df = create_date_file_df(aia_iso_dates, aia_filenames, sufix, debug=debug)
-        if n == 0 and joint_df is None:
+    all_iso_dates = [pd.to_datetime(pd.Series(dates)).dropna() for dates in all_iso_dates]
+
+    if joint_df is not None:
+        slots = joint_df.index
+    else:
+        start = max(dates.min() for dates in all_iso_dates)
+        end = min(dates.max() for dates in all_iso_dates)
+        slots = pd.date_range(pd.Timestamp(start).floor(cadence), pd.Timestamp(end).ceil(cadence), freq=cadence, name='dates')
+
+    for n, (iso_dates, filenames, sufix) in enumerate(zip(all_iso_dates, all_filenames, all_sufixes)):
+        filenames = np.asarray(list(filenames), dtype=object)[iso_dates.index.to_numpy()]
+        df = match_channel(slots, iso_dates, filenames, sufix, channel_tolerance(tolerance, sufix, n, cadence))
+        if joint_df is None:
             joint_df = df
         else:
             joint_df = joint_df.join(df, how='inner')
+        slots = joint_df.index
+
+    offset_columns = [f'offset_{sufix}' for sufix in all_sufixes]
+    if unique:
+        # Slots are claimed in order of the total offset of their files, ties by time
+        total_offset = joint_df[offset_columns].abs().sum(axis=1)
+        joint_df = joint_df.iloc[np.argsort(total_offset.to_numpy(), kind='stable')]
+        for sufix in all_sufixes:
+            joint_df = joint_df.drop_duplicates(subset=f'files_{sufix}', keep='first')
+        joint_df = joint_df.sort_index()
+    if not offsets:
+        joint_df = joint_df.drop(columns=offset_columns)
+
+    if debug:
+        joint_df = joint_df.iloc[::debug, :]
 
     return joint_df
 
 
-def get_fits_quality(filepath):
-    s_map = Map(filepath)
-    return s_map.meta["QUALITY"] == 0
+def build_match_index(aia_path=None, hmi_path=None, wavelengths=None, cadence='3min', tolerance=None,
+                      offsets=False, check_fits=False, index_path=None, reindex=False, debug=False,
+                      output=None, **scan_kwargs):
+    """ Match the AIA channels and the HMI magnetograms found on disk.  The files are listed
+    through the persistent FileIndex, so only new or changed files are parsed (and
+    quality-checked), then matched with match_file_times, AIA first and HMI to the AIA slots.
+
+    Parameters
+    ----------
+    aia_path: directory with one folder per AIA wavelength
+    hmi_path: directory of the HMI files
+    wavelengths: AIA wavelengths to match, all the folders of aia_path if None
+    cadence: frequency alias of the reference grid
+    tolerance: largest offset between a file and its slot, either one value for all
+        channels, a dict keyed by channel (e.g. aia171, hmi) or a list with one value per
+        matched channel: the AIA wavelengths found on disk sorted by wavelength, then hmi.
+        Defaults to half the cadence
+    offsets: if True, keep the offset of every file to its slot in seconds
+    check_fits: if True, only match files whose QUALITY flag is 0
+    index_path: path of the file index, file_index.sqlite in aia_path (or hmi_path) if None
+    reindex: if True, list every channel directory even if it did not change
+    debug: Whether to use only a small set of the files (10)
+    output: if given, write the matches to this .parquet or .csv file
+    scan_kwargs: additional scan_fits_quality arguments, e.g. max_workers or batch_size
+
+    Returns
+    -------
+    pandas dataframe with a datetime64 index named dates and one categorical files_{channel}
+    column per channel, aia channels sorted by wavelength and then hmi
+    """
+    channels = {}
+    if aia_path is not None:
+        available_wavelengths = [d for d in os.listdir(aia_path) if os.path.isdir(os.path.join(aia_path, d))]
+        wavelengths = available_wavelengths if wavelengths is None else [str(wl) for wl in wavelengths]
+        intersection_wavelengths = sorted(set(available_wavelengths).intersection(wavelengths), key=float)
+        if len(intersection_wavelengths) < len(wavelengths):
+            logger.warning(f'Found only {available_wavelengths}, but the user request is {wavelengths}')
+        for wl in intersection_wavelengths:
+            channels[f'aia{wl}'] = (os.path.join(aia_path, wl), f'*aia*{wl}_*.fits')
+    if hmi_path is not None:
+        channels['hmi'] = (hmi_path, '*.fits')
+    if not channels:
+        raise ValueError('No channel to match, aia_path or hmi_path is needed')
+
+    if isinstance(tolerance, (list, tuple)):
+        if len(tolerance) != len(channels):
+            raise ValueError(f'Got {len(tolerance)} tolerances for the {len(channels)} channels {list(channels)}')
+        tolerance = dict(zip(channels, tolerance))
+
+    # Bring the index of all channels up to date: only new or changed files are parsed
+    # (and quality-checked), deleted ones are dropped
+    index_path = index_path or os.path.join(aia_path or hmi_path, 'file_index.sqlite')
+    with FileIndex(index_path) as index:
+        stats = index.update(channels, check_fits=check_fits, force=reindex, **scan_kwargs)
+        logger.info(f'Updated {index_path}:\n{stats.to_string(index=False)}')
+        channel_files = {channel: index.files(channel, check_fits=check_fits) for channel in channels}
+    if debug:
+        channel_files = {channel: files[0:10] for channel, files in channel_files.items()}
+
+    matches = None
+    aia_channels = [channel for channel in channels if channel != 'hmi']
+    if aia_channels:
+        matches = match_file_times([channel_files[c].date for c in aia_channels],
+                                   [channel_files[c].path for c in aia_channels],
+                                   aia_channels, debug=debug, cadence=cadence,
+                                   tolerance=tolerance, offsets=offsets)
+    if hmi_path is not None:
+        hmi_tolerance = tolerance.get('hmi') if isinstance(tolerance, dict) else tolerance
+        matches = match_file_times([channel_files['hmi'].date], [channel_files['hmi'].path], ['hmi'],
+                                   joint_df=matches, cadence=cadence, tolerance=hmi_tolerance,
+                                   offsets=offsets)
+
+    matches.index = pd.DatetimeIndex(matches.index, name='dates').as_unit('ns')
+    file_columns = [column for column in matches.columns if column.startswith('files_')]
+    matches[file_columns] = matches[file_columns].astype('category')
+
+    if output is not None:
+        write_match_index(matches, output)
+    return matches
+
+
+def write_match_index(matches, filename):
+    """ Write a match table, as Parquet unless filename ends in .csv
+
+    Parameters
+    ----------
+    matches: pandas dataframe returned by build_match_index
+    filename: path of the .parquet or .csv file
+    """
+    if str(filename).endswith('.csv'):
+        matches.to_csv(filename, index=True)
+    else:
+        matches.to_parquet(filename, index=True)
+
+
+def read_match_index(filename):
+    """ Read a match table written by write_match_index, or a csv of an earlier version of
+    the indexer, with the same types build_match_index returns
+
+    Parameters
+    ----------
+    filename: path of the .parquet or .csv file
+
+    Returns
+    -------
+    pandas dataframe with a datetime64 index named dates and categorical files_{channel} columns
+    """
+    if str(filename).endswith('.csv'):
+        matches = pd.read_csv(filename, index_col=0)
+        matches.index = pd.DatetimeIndex(pd.to_datetime(matches.index, format='ISO8601'), name='dates').as_unit('ns')
+        file_columns = [column for column in matches.columns if column.startswith('files_')]
+        matches[file_columns] = matches[file_columns].astype('category')
+        return matches
+    return pd.read_parquet(filename)
 
 
 if __name__ == "__main__":
@@ -135,113 +267,48 @@ if __name__ == "__main__":
                         nargs='+', default=None,
                         help='Channels to combine')
     p.add_argument('--dt_round', type=str, default='3min',
-                   help='frequency alias to round dates to find closest matches')
+                   help='frequency alias of the reference grid the files are matched to')
+    p.add_argument('--tolerance', type=str, nargs='+', default=None,
+                   help='largest offset between a file and its slot, one for all channels or one per matched channel '
+                        '(AIA wavelengths found on disk in increasing order, then hmi).  Defaults to half of dt_round')
+    p.add_argument('--offsets', action='store_true',
+                   help='whether to save the time offset of every matched file to its slot')
     p.add_argument('--check_fits', action='store_true',
                    help='whether to verify all fits files for the quality flag')
+    p.add_argument('--scan_workers', type=int, default=None,
+                   help='number of workers reading fits headers with --check_fits')
+    p.add_argument('--scan_batch_size', type=int, default=256,
+                   help='number of fits headers read by each task with --check_fits')
+    p.add_argument('--scan_processes', action='store_true',
+                   help='read fits headers on a process pool instead of a thread pool')
+    p.add_argument('--index', type=str, default=None,
+                   help='path of the persistent file index, file_index.sqlite in aia_path (or hmi_path) by default')
+    p.add_argument('--reindex', action='store_true',
+                   help='list all channel directories even if they did not change since the last run')
+    p.add_argument('--output_format', type=str, default='parquet', choices=['parquet', 'csv'],
+                   help='format of the match table')
     p.add_argument('--debug', action='store_true',
                    help='Only process a few files (10)')
 
     args = p.parse_args()
 
-    hmi_path = args.hmi_path
-    aia_path = args.aia_path
-    wavelengths = args.wavelengths
-    dt_round = args.dt_round
-    check_fits = args.check_fits
-    debug = args.debug
-
-    # Process AIA files, if hmi path provided
-    if aia_path is not None:
-        available_wavelengths = [d for d in os.listdir(aia_path) if os.path.isdir(aia_path+'/'+d)]
-        intersection_wavelengths = list(set(available_wavelengths).intersection(wavelengths))
-        intersection_wavelengths.sort(key=float)
-
-        if len(intersection_wavelengths) < len(wavelengths):
-            LOG.log(level=30, msg=f'Found only {available_wavelengths}, but the user request is {wavelengths}')
-
-        nb_wavelengths = len(intersection_wavelengths)
-
-        # LOADING AIA data
-        # List of filenames, per wavelength
-
-        aia_filenames = [[f.replace('\\', '/') for f in sorted(glob.glob(aia_path + '/%s/*aia*%s_*.fits' % (wl, wl)))] for wl in intersection_wavelengths]
-
-        if debug:
-            aia_filenames = [files[0:10] for files in aia_filenames]
-
-    # Process HMI files, if hmi path provided
-    if hmi_path is not None:
-        hmi_filenames = [[f.replace('\\', '/') for f in sorted(glob.glob(hmi_path + '/*.fits'))]]
-        if debug:
-            hmi_filenames = [files[0:10] for files in hmi_filenames]
-
-    if check_fits:
-        # Assemble list of lists with delayed actions for all files per channel per instrument
-        all_files = []
-        if aia_path is not None:
-            all_files.append(aia_filenames)
-        if hmi_path is not None:
-            all_files.append(hmi_filenames)
-
-        delayed_quality = []
-        for instrument in all_files:
-            channels = []
-            for channel in instrument:
-                files = []
-                for file in channel:
-                    files.append(delayed(get_fits_quality)(file))
-                channels.append(files)
-            delayed_quality.append(channels)
-
-        # Execute delayed actions to identify quality issues
-        with TqdmCallback(desc="Checking quality flag for all files"):
-            quality = dask.compute(*delayed_quality)
-
-        # Remove files with bad quality
-        hmi_index = 0
-        if aia_path is not None:
-            hmi_index = 1
-            clean_aia_filenames = []
-            for channel, mask in zip(aia_filenames, quality[0]):
-                clean_channel = [channel[i] for i in range(len(channel)) if mask[i]]
-                clean_aia_filenames.append(clean_channel)
-            aia_filenames = clean_aia_filenames
-
-        if hmi_path is not None:
-            clean_hmi_filenames = []
-            for channel, mask in zip(hmi_filenames, quality[hmi_index]):
-                clean_channel = [channel[i] for i in range(len(channel)) if mask[i]]
-                clean_hmi_filenames.append(clean_channel)
-            hmi_filenames = clean_hmi_filenames        
-
-
-    # load aia dates
-    result_matches = None
-    if aia_path is not None:
-        aia_iso_dates = filenames_to_dates(aia_filenames, debug=debug)
-
-        aia_sufixes = [f'aia{wl}' for wl in intersection_wavelengths]
-        result_matches = match_file_times(aia_iso_dates, aia_filenames, aia_sufixes, debug=debug)
-
-    # Process HMI files, if hmi path provided
-    if hmi_path is not None:
-        # load hmi dates
-        hmi_iso_dates = filenames_to_dates(hmi_filenames, debug)
-        result_matches = match_file_times(hmi_iso_dates, hmi_filenames, ['hmi'], joint_df=result_matches)
-
-
-    # Save csv with aia filenames, aia iso dates, eve iso dates, eve indices, and time deltas
-    if aia_path is not None:
-        if hmi_path is not None:
-            intersection_wavelengths.append('hmi')
-            filename = f'aia_hmi_matches_{"_".join(intersection_wavelengths)}.csv'
-        else:
-            f'aia_matches_{"_".join(intersection_wavelengths)}.csv'
-        filename = os.path.join(aia_path, filename).replace('\\','/')
-        result_matches.to_csv(filename, index=True)
-    elif hmi_path is not None:
-        filename = 'hmi_index.csv'
-        filename = os.path.join(hmi_path, filename).replace('\\','/')
-        result_matches.to_csv(filename, index=True)
-    
-    
+    tolerance = args.tolerance
+    if tolerance is not None and len(tolerance) == 1:
+        tolerance = tolerance[0]  # One value for all channels
+
+    matches = build_match_index(args.aia_path, args.hmi_path, args.wavelengths, cadence=args.dt_round,
+                                tolerance=tolerance, offsets=args.offsets, check_fits=args.check_fits,
+                                index_path=args.index, reindex=args.reindex, debug=args.debug,
+                                batch_size=args.scan_batch_size, max_workers=args.scan_workers,
+                                processes=args.scan_processes)
+
+    # Save the matches next to the data, named after the matched channels
+    channels = [column.replace('files_aia', '').replace('files_', '')
+                for column in matches.columns if column.startswith('files_')]
+    if args.aia_path is not None:
+        prefix = 'aia_hmi_matches' if args.hmi_path is not None else 'aia_matches'
+        filename = os.path.join(args.aia_path, f'{prefix}_{"_".join(channels)}.{args.output_format}')
+    else:
+        filename = os.path.join(args.hmi_path, f'hmi_index.{args.output_format}')
+    write_match_index(matches, filename.replace('\\', '/'))
+    LOG.info(f'Saved {len(matches)} matches to {filename}')
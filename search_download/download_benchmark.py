@@ -0,0 +1,284 @@
+"""
+End-to-end benchmark of the Downloader against the local fake JSOC server (see fake_jsoc.py).
+Every combination of wavelength count, date span, format and export method is downloaded into
+a fresh folder and its throughput and export latency are reported, so transfer optimizations
+can be measured without a JSOC account or network access.
+
+Example:
+python -m search_download.download_benchmark --wavelengths 1 4 --days 1 2 --methods url-tar url --bandwidth 5e6
+
+"""
+import argparse
+import datetime
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from search_download.downloader import Downloader
+from search_download.fake_jsoc import FakeJsocServer
+
+AIA_WAVELENGTHS = [171, 193, 211, 304, 335, 94, 131, 1600, 1700]
+
+
+def run_download(
+    server: FakeJsocServer = None,
+    path: str = None,
+    wavelengths: int = 1,
+    days: int = 1,
+    file_format: str = "fits",
+    method: str = "url-tar",
+    instrument: str = "aia",
+    cadence: str = "1h",
+    **downloader_kwargs,
+):
+    """
+    Download one configuration from the fake JSOC server and measure it
+
+    Parameters:
+        server: (FakeJsocServer)
+            Server to download from
+        path: (str)
+            Empty folder to download to
+        wavelengths: (int)
+            Number of AIA wavelengths to download, ignored for HMI
+        days: (int)
+            Length of the date range in days
+        file_format: (str)
+            fits or jpg
+        method: (str)
+            JSOC export method for fits files, "url-tar-stream" streams the url-tar export
+        instrument: (str)
+            aia or hmi
+        cadence: (str)
+            Cadence of the download
+        downloader_kwargs:
+            Additional Downloader arguments, e.g. concurrent_exports or shard_records
+
+    Returns:
+        result: (dict)
+            Configuration, file and byte counts, wall time, throughput and export latency
+    """
+    sdate = datetime.datetime(2023, 1, 1)
+    edate = sdate + datetime.timedelta(days=days - 1)
+    wavelength = AIA_WAVELENGTHS[0:wavelengths] if instrument == "aia" else [None]
+    downloader_kwargs.setdefault("poll_interval", 0.1)
+
+    downloader = Downloader(
+        "user@example.com",
+        sdate.strftime("%Y-%m-%dT%H:%M:%S"),
+        edate.strftime("%Y-%m-%dT%H:%M:%S"),
+        wavelength,
+        instrument,
+        cadence,
+        file_format,
+        path,
+        method=method.replace("-stream", ""),
+        stream_tar=method.endswith("-stream"),
+        client=server.client(),
+        **downloader_kwargs,
+    )
+
+    bytes_sent = server.bytes_sent
+    start = time.perf_counter()
+    _, metrics = downloader.download_data(return_metrics=True)
+    wall_seconds = time.perf_counter() - start
+
+    shards = [m for m in metrics if m["level"] == "shard"]
+    files = [
+        f for _, _, names in os.walk(path) for f in names if f.endswith(f".{file_format}")
+    ]
+    file_bytes = sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, names in os.walk(path)
+        for f in names
+        if f.endswith(f".{file_format}")
+    )
+    export_seconds = [m["export_seconds"] for m in shards if "export_seconds" in m]
+    return {
+        "instrument": instrument,
+        "wavelengths": len(wavelength),
+        "days": days,
+        "format": file_format,
+        "method": method,
+        "shards": len(shards),
+        "failed_shards": sum(m["status"] == "failed" for m in shards),
+        "files": len(files),
+        "bytes": file_bytes,
+        "bytes_sent": server.bytes_sent - bytes_sent,
+        "wall_seconds": wall_seconds,
+        "files_per_s": len(files) / wall_seconds,
+        "mb_per_s": file_bytes / 1e6 / wall_seconds,
+        "mean_export_seconds": sum(export_seconds) / max(1, len(export_seconds)),
+        "max_export_seconds": max(export_seconds, default=0),
+        "transfer_seconds": sum(m.get("transfer_seconds", 0) for m in shards),
+    }
+
+
+def run_benchmark(
+    wavelengths: list = None,
+    days: list = None,
+    formats: list = None,
+    methods: list = None,
+    repeats: int = 1,
+    path: str = None,
+    server_kwargs: dict = None,
+    **downloader_kwargs,
+):
+    """
+    Run every combination of wavelength count, date span, format and method against a
+    fresh fake JSOC server
+
+    Parameters:
+        wavelengths: (list)
+            Numbers of AIA wavelengths to download
+        days: (list)
+            Lengths of the date range in days
+        formats: (list)
+            File formats, fits and/or jpg.  Export methods only apply to fits.
+        methods: (list)
+            Export methods for fits files: url-tar, url-tar-stream, url and url_quick
+        repeats: (int)
+            Number of times each combination is run
+        path: (str)
+            Folder to download to, a temporary folder if None.  It is emptied between runs.
+        server_kwargs: (dict)
+            FakeJsocServer arguments, e.g. queue_delay, bandwidth or image_size
+        downloader_kwargs:
+            Additional Downloader arguments shared by all runs
+
+    Returns:
+        results: (pandas.DataFrame)
+            One row per run, see run_download
+    """
+    wavelengths = [1] if wavelengths is None else wavelengths
+    days = [1] if days is None else days
+    formats = ["fits"] if formats is None else formats
+    methods = ["url-tar"] if methods is None else methods
+    root = tempfile.mkdtemp() if path is None else path
+
+    server = FakeJsocServer(**(server_kwargs or {}))
+    results = []
+    try:
+        for file_format, method, n_wavelengths, n_days, repeat in itertools.product(
+            formats, methods, wavelengths, days, range(repeats)
+        ):
+            if file_format == "jpg" and method != methods[0]:
+                continue  # jpg exports ignore the method
+            run_path = os.path.join(root, "benchmark_run")
+            shutil.rmtree(run_path, ignore_errors=True)
+            result = run_download(
+                server,
+                run_path,
+                n_wavelengths,
+                n_days,
+                file_format,
+                method if file_format == "fits" else "url_quick",
+                **downloader_kwargs,
+            )
+            result["repeat"] = repeat
+            print(
+                f"{result['format']} {result['method']} {result['wavelengths']} wavelength(s) "
+                f"{result['days']} day(s): {result['files']} files in "
+                f"{result['wall_seconds']:.2f} s ({result['mb_per_s']:.2f} MB/s)"
+            )
+            results.append(result)
+    finally:
+        server.close()
+        if path is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return pd.DataFrame(results)
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments to script.
+
+    Parameters:
+        args (list):    defaults to parsing any command line arguments
+
+    Returns:
+        parser args:    Namespace from argparse
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--wavelengths", type=int, nargs="+", default=[1, 3],
+        help="Numbers of AIA wavelengths to download",
+    )
+    parser.add_argument(
+        "--days", type=int, nargs="+", default=[1], help="Lengths of the date range in days"
+    )
+    parser.add_argument(
+        "--formats", type=str, nargs="+", default=["fits"], help="File formats, fits and/or jpg"
+    )
+    parser.add_argument(
+        "--methods", type=str, nargs="+", default=["url-tar", "url-tar-stream", "url", "url_quick"],
+        help="Export methods for fits files: url-tar, url-tar-stream, url and url_quick",
+    )
+    parser.add_argument(
+        "--instrument", type=str, default="aia", help="Instrument to download, aia or hmi"
+    )
+    parser.add_argument(
+        "--cadence", type=str, default="1h", help="Cadence of the downloads"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=1, help="Number of times each combination is run"
+    )
+    parser.add_argument(
+        "--concurrent_exports", type=int, default=1, help="Exports waiting on JSOC at the same time"
+    )
+    parser.add_argument(
+        "--shard_records", type=int, default=None, help="Maximum number of records per export"
+    )
+    parser.add_argument(
+        "--queue_delay", type=float, default=1, help="Seconds every export waits in the queue"
+    )
+    parser.add_argument(
+        "--record_delay", type=float, default=0, help="Additional queue seconds per exported record"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="Bytes per second of every file transfer"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds every HTTP request waits"
+    )
+    parser.add_argument(
+        "--image_size", type=int, default=1024, help="Pixels on a side of the synthetic images"
+    )
+    parser.add_argument(
+        "-p", "--path", type=str, default=None, help="Folder to download to, temporary if not given"
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="CSV file to write the results to"
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parser_output = parse_args()
+    results = run_benchmark(
+        parser_output.wavelengths,
+        parser_output.days,
+        parser_output.formats,
+        parser_output.methods,
+        repeats=parser_output.repeats,
+        path=parser_output.path,
+        server_kwargs={
+            "queue_delay": parser_output.queue_delay,
+            "record_delay": parser_output.record_delay,
+            "bandwidth": parser_output.bandwidth,
+            "latency": parser_output.latency,
+            "image_size": parser_output.image_size,
+        },
+        instrument=parser_output.instrument,
+        cadence=parser_output.cadence,
+        concurrent_exports=parser_output.concurrent_exports,
+        shard_records=parser_output.shard_records,
+    )
+    print(results.to_string(index=False))
+    if parser_output.output is not None:
+        results.to_csv(parser_output.output, index=False)
@@ -12,14 +12,39 @@ Daniel Geyfman - dgeyfman0@saddleback.edu
 Andres Muñoz-Jaramillo - andres.munoz@swri.org // https://github.com/amunozj
 
 """
+import asyncio
 import datetime
-import glob
+import functools
+import http.client
+import json
 import os
 import argparse
+import math
+import re
 import shutil
+import tarfile
+import time
+import urllib.request
+from concurrent.futures import Executor
+import pandas as pd
 import drms  # Module to interface with JSOC https://docs.sunpy.org/projects/drms/en/stable/_modules/drms/utils.html
 
-from search_download.file_renamer import rename_filenames
+from search_download.file_renamer import (
+    is_renamed,
+    compact_filename,
+    record_filename,
+)
+from search_download.file_fetcher import FileFetcher
+from search_download.query_cache import QueryCache
+from search_download.utils.scandir_walker import walk_files
+
+# Rough size of a single exported record, used to turn a byte budget into a shard length
+RECORD_BYTES_ESTIMATE = {"fits": 12e6, "jpg": 6e5}
+
+CADENCE_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Errors of a download that resubmitting the export can recover from, anything else is a bug
+TRANSFER_ERRORS = (OSError, tarfile.TarError, http.client.HTTPException)
 
 
 class Downloader:
@@ -49,7 +74,8 @@ class Downloader:
         path: (str)
             Path to download the files to (default is current directory)
         download_limit: (int)
-            Limit the number of files to download, if None, all files will be downloaded
+            Limit the number of files to download per wavelength, if None, all files will be
+            downloaded.  Larger requests are thinned by exporting at a multiple of the cadence
         get_spike: (bool)
             Flag that specifies whether to download spikes files for AIA. Spikes are hot pixels
             that are normally removed from AIA images, but the user may want to retrieve them.
@@ -57,6 +83,39 @@ class Downloader:
             Whether to use the different AIA colormaps or a grayscale colormap
         multiwavelength: (bool)
             Whether to merge the files into multi-wavelength stacks.  Defaults to fits files
+        concurrent_exports: (int)
+            Maximum number of exports waiting on JSOC at the same time.  With the default of 1,
+            the next export is submitted while the previous one downloads.
+        poll_interval: (float)
+            Seconds between status checks of pending JSOC exports
+        shard_records: (int)
+            Split the date range into time shards of at most this many records per export
+        shard_bytes: (float)
+            Split the date range into time shards of roughly this many bytes per export
+        record_bytes: (float)
+            Estimated size of one record, used with shard_bytes.  Defaults to a per-format estimate
+        max_retries: (int)
+            Number of times a failed shard export or download is resubmitted before giving up
+        incremental: (bool)
+            Only export the records of the query that are not already on disk under their
+            renamed YYYYMMDD_HHMMSS_instrument_wl_4k names
+        stream_tar: (bool)
+            Extract fits files from the url-tar HTTP stream straight into their renamed
+            paths instead of saving and unpacking the whole archive
+        method: (str)
+            JSOC export method for fits files: "url-tar" (default) exports a single tar file,
+            "url" and "url_quick" export individual files that are fetched in parallel
+        fetch_workers: (int)
+            Number of files fetched at the same time with the "url" and "url_quick" methods
+        query_cache: (str or QueryCache)
+            SQLite file (or QueryCache) used to keep JSOC query results between runs
+        executor: (concurrent.futures.Executor)
+            Executor that runs the blocking JSOC and transfer calls of the async methods, if
+            None, the default executor of the event loop is shared by all jobs
+        metrics_path: (str)
+            JSON lines file to which the per-shard and per-wavelength metrics are appended
+        client: (drms.Client)
+            Client used to talk to JSOC, if None, one is created with the given email
     """
 
     def __init__(
@@ -72,6 +131,20 @@ class Downloader:
         download_limit: int = None,
         get_spike: bool = None,
         grayscale: bool = False,
+        concurrent_exports: int = 1,
+        poll_interval: float = 5,
+        shard_records: int = None,
+        shard_bytes: float = None,
+        record_bytes: float = None,
+        max_retries: int = 2,
+        incremental: bool = False,
+        stream_tar: bool = False,
+        method: str = "url-tar",
+        fetch_workers: int = 8,
+        query_cache=None,
+        executor: Executor = None,
+        metrics_path: str = None,
+        client: drms.Client = None,
     ):
         self.email = email
         if isinstance(sdate, str):
@@ -106,10 +179,31 @@ class Downloader:
             False  # False, there is no large file limit (limits number of files)
         )
         self.download_limit = download_limit  # Maximum number of files to download.
-        self.client = drms.Client(email=self.email, verbose=True)
+        self.thinned_cadence = {}  # Per-wavelength cadence that keeps exports within download_limit
+        self.client = client
+        if self.client is None:
+            self.client = drms.Client(email=self.email, verbose=True)
         self.get_spike = get_spike  # Bool switch to download spikes files or not.   Spikes are hot pixels normally removed from AIA, but can be donwloaded if desired
         self.export = None
         self.grayscale = grayscale
+        self.concurrent_exports = max(1, int(concurrent_exports))  # Exports in flight at once
+        self.poll_interval = poll_interval  # Seconds between JSOC status checks
+        self.shard_records = shard_records  # Maximum number of records per export
+        self.shard_bytes = shard_bytes  # Approximate byte budget per export
+        self.record_bytes = record_bytes  # Estimated bytes per record
+        if self.record_bytes is None:
+            self.record_bytes = RECORD_BYTES_ESTIMATE.get(self.format, RECORD_BYTES_ESTIMATE["fits"])
+        self.max_retries = max_retries  # Resubmissions allowed per shard
+        self.failed_exports = []  # JSOC strings that could not be downloaded
+        self.incremental = incremental  # Skip records that are already on disk
+        self.stream_tar = stream_tar  # Extract url-tar exports while they download
+        self.method = method  # JSOC export method for fits files
+        self.validmethods = ["url-tar", "url", "url_quick"]
+        self.fetcher = FileFetcher(max_workers=fetch_workers)  # Parallel per-file transfers
+        self.query_cache = query_cache  # Persistent cache of query results
+        self.executor = executor  # Runs blocking calls for the async methods
+        self.metrics = []  # Stage timings and throughput of the last download_data
+        self.metrics_path = metrics_path  # JSON lines file for the metrics
 
         self.jpg_defaults = {
             94: {"scaling": "LOG", "min": 1, "max": 240, "ct": "aia_94.lut"},
@@ -127,13 +221,18 @@ class Downloader:
         if not os.path.exists(self.path):
             os.mkdir(self.path)
 
-    def assemble_jsoc_string(self, wavelength: int = None):
+        if isinstance(self.query_cache, str):
+            self.query_cache = QueryCache(self.query_cache)
+
+    def assemble_jsoc_string(self, wavelength: int = None, shard: tuple = None):
         """
         Given all the parameters, create the jsoc string to query the data
 
         Parameters:
             wavelength:  int
                 AIA wavelength used to generate jsoc string
+            shard: tuple
+                (start datetime, duration in seconds) to use instead of the full date range
 
         Returns:
             None
@@ -143,7 +242,11 @@ class Downloader:
             self.cadence = self.cadence.replace(".0", "")
 
         # Changed the format of the jsoc string
-        jsoc_string = f"[{self.sdate.isoformat()}/{(self.edate-self.sdate).days+1}d@{self.cadence}]"  # used to assemble the query string that will be sent to the JSOC database
+        cadence = self.thinned_cadence.get(wavelength, self.cadence)
+        if shard is None:
+            jsoc_string = f"[{self.sdate.isoformat()}/{(self.edate-self.sdate).days+1}d@{cadence}]"  # used to assemble the query string that will be sent to the JSOC database
+        else:
+            jsoc_string = f"[{shard[0].isoformat()}/{format_duration(shard[1])}@{cadence}]"
 
         # # The jsocString is used to assemble a string for query requests
         # # Assemble query string for AIA.
@@ -183,69 +286,734 @@ class Downloader:
 
         for wavelength in self.wavelength:
             jsoc_string = self.assemble_jsoc_string(wavelength)
-            query = self.client.query(jsoc_string, key="t_rec")
+            query = self.query(jsoc_string, key="t_rec")
             query_list.append(query)
 
         return query_list
 
-    def download_data(self):
+    def query(self, jsoc_string: str = None, key="t_rec"):
+        """
+        Run a JSOC query, going through the query cache if there is one
+
+        Parameters:
+            jsoc_string: str
+                JSOC record-set string
+            key: (str or list)
+                Keywords to retrieve
+
+        Returns:
+            query: (panda.df)
+        """
+        if self.query_cache is None:
+            return self.client.query(jsoc_string, key=key)
+        return self.query_cache.query(self.client, jsoc_string, key=key, end=self.range_end())
+
+    def cadence_seconds(self, wavelength: int = None):
+        """
+        Convert the cadence string into seconds
+
+        Parameters:
+            wavelength:  int
+                If given, return the thinned cadence of this wavelength, if it has one
+
+        Returns:
+            seconds: (int)
+                Cadence in seconds
+        """
+        cadence = self.thinned_cadence.get(wavelength, self.cadence).replace(".0", "")
+        return int(float(cadence[:-1]) * CADENCE_SECONDS[cadence[-1]])
+
+    def thin_cadences(self, queries: list = None):
+        """
+        Query every wavelength and, where the query holds more than download_limit records,
+        pick the smallest multiple of the cadence that keeps the export within the limit.
+        The count is made on the records of the query itself, so gaps in the data are
+        taken into account.
+
+        Parameters:
+            queries: (list)
+                Results of create_query_request at the full cadence, queried if None
+
+        Returns:
+            thinned_cadence: (dict)
+                Cadence to export for each wavelength that has to be thinned
+        """
+        self.thinned_cadence = {}
+        if self.download_limit is None:
+            return self.thinned_cadence
+
+        if queries is None:
+            queries = self.create_query_request()
+        start = self.range_start()
+        cadence = self.cadence_seconds()
+        for wavelength, query in zip(self.wavelength, queries):
+            if len(query) <= self.download_limit:
+                continue
+
+            t_recs = [parse_t_rec(t_rec) for t_rec in query["T_REC"]]
+            indices = [
+                round((t_rec - start).total_seconds() / cadence)
+                for t_rec in t_recs
+                if t_rec is not None
+            ]
+            factor = math.ceil(len(indices) / self.download_limit)
+            while sum(index % factor == 0 for index in indices) > self.download_limit:
+                factor += 1
+
+            self.thinned_cadence[wavelength] = format_duration(factor * cadence)
+            print(
+                f"{wavelength}: {len(query)} records exceed the download limit of "
+                f"{self.download_limit}, exporting at a cadence of {self.thinned_cadence[wavelength]}"
+            )
+        return self.thinned_cadence
+
+    def thin_query(self, wavelength: int = None, query=None):
+        """
+        Keep the records of a full cadence query that fall on the thinned cadence grid of a
+        wavelength, i.e. the records a query at the thinned cadence would return
+
+        Parameters:
+            wavelength:  int
+                AIA wavelength of the query
+            query: (panda.df)
+                Result of client.query at the full cadence, with a T_REC column
+
+        Returns:
+            query: (panda.df)
+                Records on the thinned grid, query itself if the wavelength is not thinned
         """
-        Takes the jsoc string and downloads the data
+        if wavelength not in self.thinned_cadence:
+            return query
+        start = self.range_start()
+        cadence = self.cadence_seconds()
+        factor = round(self.cadence_seconds(wavelength) / cadence)
+        on_grid = []
+        for t_rec in query["T_REC"]:
+            t_rec = parse_t_rec(t_rec)
+            on_grid.append(t_rec is not None and round((t_rec - start).total_seconds() / cadence) % factor == 0)
+        return query[on_grid]
+
+    def range_start(self):
+        """
+        Start of the date range as a datetime
 
         Parameters:
             None
 
         Returns:
-            export_request: (panda.df)
-                Dataframe with the number of files to download
+            start: (datetime.datetime)
         """
-        export = []
-        # Renames file name to this format: YYYYMMDD_HHMMSS_RESOLUTION_INSTRUMENT.fits
+        start = self.sdate
+        if not isinstance(start, datetime.datetime):
+            start = datetime.datetime.combine(start, datetime.time())
+        return start
 
-        for wavelength in self.wavelength:
-            jsoc_string = self.assemble_jsoc_string(wavelength)
-            if self.format == "jpg" and self.instrument == "aia":
-                protocol_args = self.jpg_defaults[wavelength]
-                if self.grayscale:
-                    protocol_args["ct"] = "grey.sao"
+    def range_end(self):
+        """
+        End of the date range (exclusive) as a datetime
 
-                export_request = self.client.export(
-                    jsoc_string, protocol=self.format, protocol_args=protocol_args
-                )
+        Parameters:
+            None
+
+        Returns:
+            end: (datetime.datetime)
+        """
+        return self.range_start() + datetime.timedelta(days=(self.edate - self.sdate).days + 1)
+
+    def time_shards(self, span: tuple = None, wavelength: int = None):
+        """
+        Split the date range into consecutive time shards sized by shard_records or
+        shard_bytes.  Shard lengths are multiples of the cadence so that every shard
+        starts on the same cadence grid as the full range.
+
+        Parameters:
+            span: tuple
+                (start datetime, duration in seconds) to split instead of the full date range
+            wavelength:  int
+                Wavelength whose (possibly thinned) cadence sets the shard length
+
+        Returns:
+            shards: (list)
+                List of (start datetime, duration in seconds) tuples, or [None] if the
+                full range is not sharded
+        """
+        records = []
+        if self.shard_records is not None:
+            records.append(int(self.shard_records))
+        if self.shard_bytes is not None:
+            records.append(int(self.shard_bytes // self.record_bytes))
+        if not records:
+            return [span]
+
+        cadence = self.cadence_seconds(wavelength)
+        shard_seconds = max(1, min(records)) * cadence
+
+        if span is None:
+            span = (self.range_start(), int((self.range_end() - self.range_start()).total_seconds()))
+        start, total_seconds = span
+
+        shards = []
+        for offset in range(0, total_seconds, shard_seconds):
+            duration = min(shard_seconds, total_seconds - offset)
+            shards.append((start + datetime.timedelta(seconds=offset), duration))
+        return shards
+
+    def local_record_times(self, wavelength: int = None):
+        """
+        Collect the observation times of the renamed files already in path/<wavelength>
+
+        Parameters:
+            wavelength:  int
+                AIA wavelength folder to look into
+
+        Returns:
+            times: (set)
+                Datetimes parsed from the YYYYMMDD_HHMMSS part of the filenames
+        """
+        times = set()
+        wavelength_path = os.path.join(self.path, str(wavelength))
+        if not os.path.isdir(wavelength_path):
+            return times  # Nothing downloaded yet
+        for entry in walk_files(wavelength_path, f"*.{self.format}", stat=False):
+            if is_renamed(entry.name):
+                times.add(datetime.datetime.strptime(entry.name[0:15], "%Y%m%d_%H%M%S"))
+        return times
+
+    def missing_spans(self, wavelength: int = None, query=None):
+        """
+        Compare a query against the files on disk and coalesce the missing records into
+        as few contiguous spans as possible.  Spans are aligned to the cadence grid of the
+        full date range, so exporting them selects the same records as the full range.
+
+        Parameters:
+            wavelength:  int
+                AIA wavelength of the query
+            query: (panda.df)
+                Result of client.query with a T_REC column
+
+        Returns:
+            spans: (list)
+                List of (start datetime, duration in seconds) tuples
+        """
+        present = self.local_record_times(wavelength)
+        start = self.range_start()
+        cadence = self.cadence_seconds(wavelength)
+
+        spans = []
+        n_missing = 0
+        run = None  # [first grid index, last grid index] of the current run of missing records
+        for t_rec in query["T_REC"]:
+            t_rec = parse_t_rec(t_rec)
+            if t_rec is None:
+                continue
+            if t_rec in present:
+                if run is not None:
+                    spans.append(run)
+                    run = None
+                continue
+            n_missing += 1
+            index = round((t_rec - start).total_seconds() / cadence)
+            if run is None:
+                run = [index, index]
             else:
-                export_request = self.client.export(
-                    jsoc_string, protocol=self.format, method="url-tar"
-                )
-            export_request.wait()
-
-            # If the download path doesn't exist, make one.
-            if not os.path.exists(
-                os.path.join(self.path, str(wavelength)).replace("\\", "/")
-            ):
-                os.mkdir(os.path.join(self.path, str(wavelength)).replace("\\", "/"))
-            export_output = export_request.download(
-                os.path.join(self.path, str(wavelength)).replace("\\", "/")
+                run[1] = index
+        if run is not None:
+            spans.append(run)
+        print(
+            f"{wavelength}: {n_missing} of {len(query)} records missing on disk, "
+            f"exporting them in {len(spans)} record sets"
+        )
+
+        return [
+            (start + datetime.timedelta(seconds=first * cadence), (last - first + 1) * cadence)
+            for first, last in spans
+        ]
+
+    def export_jobs(self):
+        """
+        List the (wavelength, jsoc string) pairs that have to be exported.  Wavelengths
+        over the download limit are thinned first, and in incremental mode only the spans
+        missing on disk are listed.
+
+        Parameters:
+            None
+
+        Returns:
+            jobs: (list)
+                List of (wavelength, jsoc string) tuples
+        """
+        # Query every wavelength once at the full cadence, for both the thinning and the
+        # comparison with the files on disk
+        self.thinned_cadence = {}
+        queries = None
+        if self.download_limit is not None or self.incremental:
+            queries = self.create_query_request()
+        self.thin_cadences(queries)
+
+        if not self.incremental:
+            return [
+                (wavelength, self.assemble_jsoc_string(wavelength, shard))
+                for wavelength in self.wavelength
+                for shard in self.time_shards(wavelength=wavelength)
+            ]
+
+        jobs = []
+        for wavelength, query in zip(self.wavelength, queries):
+            for span in self.missing_spans(wavelength, self.thin_query(wavelength, query)):
+                for shard in self.time_shards(span, wavelength):
+                    jobs.append((wavelength, self.assemble_jsoc_string(wavelength, shard)))
+        return jobs
+
+    def submit_export(self, wavelength: int = None, jsoc_string: str = None):
+        """
+        Submit the JSOC export request for a single wavelength without waiting for it
+
+        Parameters:
+            wavelength:  int
+                AIA wavelength to export
+            jsoc_string: str
+                Record set to export, if None, the full date range is used
+
+        Returns:
+            export_request: (drms.ExportRequest)
+                Pending export request
+        """
+        if jsoc_string is None:
+            jsoc_string = self.assemble_jsoc_string(wavelength)
+        if self.format == "jpg" and self.instrument == "aia":
+            protocol_args = self.jpg_defaults[wavelength]
+            if self.grayscale:
+                protocol_args["ct"] = "grey.sao"
+
+            export_request = self.client.export(
+                jsoc_string, protocol=self.format, protocol_args=protocol_args
             )
+        elif self.method == "url_quick":
+            # Quick exports hand out the files as they are stored
+            export_request = self.client.export(
+                jsoc_string, protocol="as-is", method=self.method
+            )
+        else:
+            export_request = self.client.export(
+                jsoc_string, protocol=self.format, method=self.method
+            )
+        return export_request
 
-            if self.format == "fits":
-                for f in export_output.download:
-                    shutil.unpack_archive(
-                        f, os.path.join(self.path, str(wavelength)).replace("\\", "/")
-                    )
-                    os.remove(f)
-            else:
-                export.append(export_output)
+    def download_export(self, wavelength: int = None, export_request=None, metrics: dict = None):
+        """
+        Download the files of a finished export request straight under their compact
+        YYYYMMDD_HHMMSS_instrument_wl_4k names, computed from the record metadata of the
+        export.  Every file is written to a temporary name and moved into place, so no
+        pass over the folder is needed afterwards.
 
-            files = glob.glob(
-                os.path.join(self.path, str(wavelength), f"*.{self.format}").replace(
-                    "\\", "/"
+        Parameters:
+            wavelength:  int
+                AIA wavelength of the export
+            export_request: (drms.ExportRequest)
+                Export request that has finished on the JSOC side
+            metrics: (dict)
+                If given, filled with the bytes, file count and seconds spent in the
+                transfer and unpack stages
+
+        Returns:
+            export_output: (panda.df)
+                Dataframe with the downloaded files for jpgs, None for fits
+        """
+        if metrics is None:
+            metrics = {}
+        wavelength_path = os.path.join(self.path, str(wavelength)).replace("\\", "/")
+
+        # If the download path doesn't exist, make one.
+        os.makedirs(wavelength_path, exist_ok=True)
+
+        if self.format == "jpg" or self.method in ["url", "url_quick"]:
+            urls = export_request.urls
+            destinations = [
+                os.path.join(
+                    wavelength_path, self.export_filename(record, filename, wavelength)
+                ).replace("\\", "/")
+                for record, filename in zip(urls.record, urls.filename)
+            ]
+            stats = self.fetcher.fetch(list(urls.url), destinations)
+            metrics.update(
+                transfer_seconds=stats["seconds"],
+                bytes=stats["bytes"],
+                files=stats["files"] - len(stats["failed"]),
+            )
+            if stats["failed"]:
+                raise OSError(f"Could not download {len(stats['failed'])} files")
+            if self.format == "jpg":
+                return pd.DataFrame(
+                    {"record": urls.record, "url": urls.url, "download": destinations}
                 )
+            return None
+
+        records = self.export_records(export_request)
+
+        if self.stream_tar:
+            # Transfer and unpacking overlap, so they are timed together
+            start = time.perf_counter()
+            files = []
+            for url in export_request.urls.url:
+                files += self.stream_tar_export(url, wavelength_path, wavelength, records)
+            metrics.update(
+                transfer_seconds=time.perf_counter() - start,
+                bytes=sum(os.path.getsize(f) for f in files),
+                files=len(files),
             )
-            rename_filenames(files, wavelength)
+            return None
+
+        start = time.perf_counter()
+        export_output = export_request.download(wavelength_path)
+        metrics.update(
+            transfer_seconds=time.perf_counter() - start,
+            bytes=sum(os.path.getsize(f) for f in export_output.download if f is not None),
+        )
+
+        start = time.perf_counter()
+        files = []
+        for f in export_output.download:
+            with tarfile.open(f) as tar:
+                files += self.extract_tar(tar, wavelength_path, wavelength, records)
+            os.remove(f)
+        metrics.update(unpack_seconds=time.perf_counter() - start, files=len(files))
+
+        return None
+
+    def export_records(self, export_request=None):
+        """
+        Record string of every file of an export, keyed by filename
+
+        Parameters:
+            export_request: (drms.ExportRequest)
+                Export request that has finished on the JSOC side
+
+        Returns:
+            records: (dict)
+                JSOC record string of each exported filename, without the directory
+        """
+        data = export_request.data
+        return {
+            filename.replace("\\", "/").split("/")[-1]: record
+            for record, filename in zip(data.record, data.filename)
+            if record
+        }
+
+    def export_filename(self, record: str = None, filename: str = None, wavelength: int = None):
+        """
+        Compact name of an exported file, taken from its record string when there is one
+
+        Parameters:
+            record: str
+                JSOC record string of the file
+            filename: str
+                Filename given by JSOC
+            wavelength:  int
+                AIA wavelength of the export
+
+        Returns:
+            filename: str
+        """
+        if record:
+            return record_filename(record, self.format)
+        return compact_filename(filename, wavelength)
+
+    def extract_tar(self, tar=None, wavelength_path: str = None, wavelength: int = None, records: dict = None):
+        """
+        Write each file of a tar export directly to its compact name.  Members are written to
+        a temporary file first and moved into place, so at most one member is ever incomplete
+        on disk.
+
+        Parameters:
+            tar: (tarfile.TarFile)
+                Open tar export, it may be a stream
+            wavelength_path: str
+                Folder to write the files to
+            wavelength:  int
+                AIA wavelength of the export
+            records: (dict)
+                JSOC record string of each member name, see export_records
+
+        Returns:
+            files: (list)
+                Paths of the extracted files
+        """
+        if records is None:
+            records = {}
+        files = []
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(f".{self.format}"):
+                continue
+            name = member.name.split("/")[-1]
+            new_file = os.path.join(
+                wavelength_path, self.export_filename(records.get(name), name, wavelength)
+            ).replace("\\", "/")
+            tmp_file = new_file + ".part"
+            with open(tmp_file, "wb") as out_file:
+                shutil.copyfileobj(tar.extractfile(member), out_file)
+            os.replace(tmp_file, new_file)
+            files.append(new_file)
+        return files
+
+    def stream_tar_export(
+        self, url: str = None, wavelength_path: str = None, wavelength: int = None, records: dict = None
+    ):
+        """
+        Read a url-tar export as an HTTP stream and write each fits member directly to its
+        compact name (see extract_tar) instead of saving and unpacking the whole archive
+
+        Parameters:
+            url: str
+                URL of the tar file
+            wavelength_path: str
+                Folder to write the fits files to
+            wavelength:  int
+                AIA wavelength of the export
+            records: (dict)
+                JSOC record string of each member name, see export_records
+
+        Returns:
+            files: (list)
+                Paths of the extracted fits files
+        """
+        with urllib.request.urlopen(url, timeout=60) as response:
+            with tarfile.open(fileobj=response, mode="r|*") as tar:
+                return self.extract_tar(tar, wavelength_path, wavelength, records)
+
+    async def run_blocking(self, function, *args):
+        """
+        Run a blocking call (drms request, HTTP transfer, unpacking) on the shared executor
+        of the running event loop, so that no job needs a thread of its own
+
+        Parameters:
+            function: (callable)
+                Blocking function to run
+            args:
+                Arguments of the function
+
+        Returns:
+            Result of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def create_query_request_async(self):
+        """
+        Asynchronous version of create_query_request that runs the queries of all
+        wavelengths at the same time
+
+        Parameters:
+            None
+
+        Returns:
+            query: (list)
+                List with the query dataframe of every wavelength
+        """
+        return await asyncio.gather(
+            *[
+                self.run_blocking(self.query, self.assemble_jsoc_string(wavelength))
+                for wavelength in self.wavelength
+            ]
+        )
+
+    async def wait_export(self, export_request=None):
+        """
+        Wait for an export request to finish on the JSOC side without blocking the event loop
+
+        Parameters:
+            export_request: (drms.ExportRequest)
+                Pending export request
+
+        Returns:
+            None
+        """
+        while not await self.run_blocking(export_request.has_finished):
+            await asyncio.sleep(self.poll_interval)
+        export_request.wait()  # Raises if the export failed
+
+    async def download_data_async(self):
+        """
+        Takes the jsoc string and downloads the data without blocking the event loop, so that
+        many Downloader jobs can share one loop.  The date range is split into time shards if
+        shard_records or shard_bytes are set.  Up to concurrent_exports shard exports wait on
+        JSOC at the same time while finished ones download, so the next export is always
+        queued while the previous one transfers and unpacks.  A shard that fails is
+        resubmitted up to max_retries times without affecting the others.
+
+        Parameters:
+            None
+
+        Returns:
+            export_request: (panda.df)
+                Dataframe with the number of files to download
+        """
+        jobs = await self.run_blocking(self.export_jobs)
+        self.failed_exports = []
+        self.metrics = []
+
+        # Keep the JSOC queue full without piling up more ready exports than we can download
+        in_flight = asyncio.Semaphore(2 * self.concurrent_exports)
+        export_slots = asyncio.Semaphore(self.concurrent_exports)
+        download_slots = asyncio.Semaphore(self.concurrent_exports)
+
+        async def run_job(wavelength, jsoc_string):
+            async with in_flight:
+                for attempt in range(self.max_retries + 1):
+                    # Fresh record per attempt, so nothing measured by a failed attempt leaks into it
+                    metrics = {
+                        "level": "shard",
+                        "wavelength": wavelength,
+                        "jsoc_string": jsoc_string,
+                        "attempts": attempt + 1,
+                    }
+                    try:
+                        async with export_slots:
+                            start = time.perf_counter()
+                            export_request = await self.run_blocking(
+                                self.submit_export, wavelength, jsoc_string
+                            )
+                            await self.wait_export(export_request)
+                            metrics["export_seconds"] = time.perf_counter() - start
+                    except Exception as e:
+                        error = e
+                    else:
+                        try:
+                            async with download_slots:
+                                output = await self.run_blocking(
+                                    self.download_export, wavelength, export_request, metrics
+                                )
+                        except TRANSFER_ERRORS as e:
+                            error = e
+                        else:
+                            metrics["status"] = "ok"
+                            self.record_metrics(metrics)
+                            return output
+
+                    if attempt < self.max_retries:
+                        print(f"Export of {jsoc_string} failed ({error}), resubmitting")
+                        continue
+                    print(f"Export of {jsoc_string} failed ({error}), giving up")
+                    self.failed_exports.append(jsoc_string)
+                    metrics["status"] = "failed"
+                    self.record_metrics(metrics)
+                    return None
+
+        try:
+            outputs = await asyncio.gather(*[run_job(*job) for job in jobs])
+        finally:
+            # Release the keep-alive connections kept between the exports of this run
+            await self.run_blocking(self.fetcher.close)
+
+        for wavelength in self.wavelength:
+            self.record_metrics(summarize_metrics(self.metrics, wavelength))
+
+        return [output for output in outputs if output is not None]
+
+    def record_metrics(self, metrics: dict = None):
+        """
+        Keep a metrics record and append it to metrics_path as a JSON line
+
+        Parameters:
+            metrics: (dict)
+                Metrics of a shard or a wavelength
+
+        Returns:
+            None
+        """
+        if metrics.get("bytes") and metrics.get("transfer_seconds"):
+            metrics["mb_per_s"] = metrics["bytes"] / 1e6 / metrics["transfer_seconds"]
+        self.metrics.append(metrics)
+        if self.metrics_path is not None:
+            with open(self.metrics_path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+
+    def download_data(self, return_metrics: bool = False):
+        """
+        Takes the jsoc string and downloads the data.  Synchronous wrapper around
+        download_data_async, use that one from code that already runs an event loop.
 
+        Parameters:
+            return_metrics: bool
+                Whether to also return the per-shard and per-wavelength metrics
+
+        Returns:
+            export_request: (panda.df)
+                Dataframe with the number of files to download
+            metrics: (list)
+                Only if return_metrics is True, list of metrics dictionaries
+        """
+        export = asyncio.run(self.download_data_async())
+        if return_metrics:
+            return export, self.metrics
         return export
 
 
+def summarize_metrics(metrics: list = None, wavelength: int = None):
+    """
+    Add up the shard metrics of a wavelength
+
+    Parameters:
+        metrics: (list)
+            Shard metrics dictionaries recorded by download_data
+        wavelength: (int)
+            Wavelength to summarize
+
+    Returns:
+        summary: (dict)
+            Totals of the numeric stages, shard and failure counts, and the longest
+            export latency
+    """
+    shards = [m for m in metrics if m["level"] == "shard" and m["wavelength"] == wavelength]
+    summary = {
+        "level": "wavelength",
+        "wavelength": wavelength,
+        "shards": len(shards),
+        "failed_shards": sum(m["status"] == "failed" for m in shards),
+        "max_export_seconds": max((m.get("export_seconds", 0) for m in shards), default=0),
+    }
+    for key in ["transfer_seconds", "unpack_seconds", "bytes", "files"]:
+        values = [m[key] for m in shards if key in m]
+        if values:
+            summary[key] = sum(values)
+    return summary
+
+
+def parse_t_rec(t_rec: str):
+    """
+    Parse a JSOC T_REC value such as 2010-12-21T00:00:02Z or 2010.12.21_00:00:00_TAI
+
+    Parameters:
+        t_rec: (str)
+            T_REC keyword value
+
+    Returns:
+        t_rec: (datetime.datetime)
+            Time of the record to the second, None for missing values
+    """
+    digits = re.sub(r"\D", "", str(t_rec))
+    if len(digits) < 14:
+        return None
+    return datetime.datetime.strptime(digits[0:14], "%Y%m%d%H%M%S")
+
+
+def format_duration(seconds: int):
+    """
+    Express a duration in the largest JSOC time unit that divides it exactly
+
+    Parameters:
+        seconds: (int)
+            Duration in seconds
+
+    Returns:
+        duration: (str)
+            Duration such as "2d", "6h", "30m" or "12s"
+    """
+    for unit in ["d", "h", "m"]:
+        if seconds % CADENCE_SECONDS[unit] == 0:
+            return f"{seconds // CADENCE_SECONDS[unit]}{unit}"
+    return f"{seconds}s"
+
+
 def parse_args(args=None):
     """
     Parses command line arguments to script. Sets up argument for which
@@ -314,7 +1082,7 @@ def parse_args(args=None):
         "--download_limit",
         type=int,
         default=1000,
-        help="Limit the number of files to download, defaults to 1000",
+        help="Limit the number of files to download per wavelength by thinning the cadence, defaults to 1000",
     )
 
     parser.add_argument(
@@ -329,6 +1097,74 @@ def parse_args(args=None):
         help="Whether to collate wavelengths in different channels",
     )
 
+    parser.add_argument(
+        "--concurrent_exports",
+        type=int,
+        default=1,
+        help="Number of exports to keep waiting on JSOC at the same time, defaults to 1",
+    )
+
+    parser.add_argument(
+        "--shard_records",
+        type=int,
+        default=None,
+        help="Split the date range into exports of at most this many records",
+    )
+
+    parser.add_argument(
+        "--shard_bytes",
+        type=float,
+        default=None,
+        help="Split the date range into exports of roughly this many bytes",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only download the records that are not already in the download path",
+    )
+
+    parser.add_argument(
+        "--stream_tar",
+        action="store_true",
+        help="Extract fits files while the tar export downloads instead of unpacking it afterwards",
+    )
+
+    parser.add_argument(
+        "--method",
+        type=str,
+        default="url-tar",
+        help='JSOC export method for fits files: "url-tar", "url" or "url_quick", defaults to url-tar',
+    )
+
+    parser.add_argument(
+        "--fetch_workers",
+        type=int,
+        default=8,
+        help="Number of files fetched in parallel with the url and url_quick methods, defaults to 8",
+    )
+
+    parser.add_argument(
+        "--query_cache",
+        type=str,
+        default=None,
+        help="SQLite file in which JSOC query results are cached between runs",
+    )
+
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help="JSON lines file to which per-shard and per-wavelength download metrics are appended",
+    )
+
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=2,
+        help="Number of times a failed shard is resubmitted, defaults to 2",
+    )
+
     return parser.parse_args(args)
 
 
@@ -345,6 +1181,16 @@ if __name__ == "__main__":
         parser_output.path,
         parser_output.download_limit,
         grayscale=parser_output.grayscale,
+        concurrent_exports=parser_output.concurrent_exports,
+        shard_records=parser_output.shard_records,
+        shard_bytes=parser_output.shard_bytes,
+        max_retries=parser_output.max_retries,
+        incremental=parser_output.incremental,
+        stream_tar=parser_output.stream_tar,
+        method=parser_output.method,
+        fetch_workers=parser_output.fetch_workers,
+        query_cache=parser_output.query_cache,
+        metrics_path=parser_output.metrics_path,
     )
 
     # request = downloader.create_query_request() # create drms client query request.
@@ -7,10 +7,9 @@ from functools import partial
 import matplotlib.image
 
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
 from tqdm.contrib.concurrent import process_map
 
+from search_download.concurrent_file_indexer import read_match_index, write_match_index
 from search_download.utils.utils import loadMapStack
 
 # Initialize Python Logger
@@ -74,8 +73,8 @@ def parse_args():
     p.add_argument('--aia_path', dest='aia_path', type=str, default="/mnt/data",
                    help='aia_path')
     p.add_argument('--matches', dest='matches', type=str,
-                   default="/mnt/data/aia_matches_171_211_304.csv",
-                   help='multi-wavelength matches')
+                   default="/mnt/data/aia_matches_171_211_304.parquet",
+                   help='multi-wavelength matches (.parquet or .csv)')
     p.add_argument('--stack_outpath', dest='stack_outpath', type=str,
                    default="/mnt/data_out",
                    help='out_path')
@@ -127,20 +126,18 @@ if __name__ == "__main__":
     
 
     # Load indices
-    matches = pd.read_csv(matches)
+    matches = read_match_index(matches)
     if debug:
-        matches = matches.loc[0:10, :]
+        matches = matches.iloc[0:11]
 
     # Extract filenames for stacks
     aia_columns = []
     for wl in wavelength_order:
         for col in matches.columns:
-            if wl in col:
+            if wl in col and col.startswith('files_'):
                 aia_columns.append(col)
 
-    aia_files = []
-    for index, row in tqdm(matches.iterrows()):
-        aia_files.append(row[aia_columns].tolist())  # (channel, files)
+    aia_files = matches[aia_columns].astype(str).to_numpy().tolist()  # (time, channel files)
 
     # Path for output
     os.makedirs(stack_outpath, exist_ok=True)
@@ -161,10 +158,10 @@ if __name__ == "__main__":
 
     # Save
     if debug:
-        matches = matches.loc[0:len(converted_file_paths), :]
+        matches = matches.iloc[0:len(converted_file_paths)]
 
     print('Saving Matches')
     matches['aia_stack'] = converted_file_paths
-    matches_output = args.matches.replace('\\','/').split('/')[-1].replace('.csv','_processed.csv')
-    matches_output = f'{stack_outpath}/{matches_output}'
-    matches.to_csv(matches_output, index=False)
+    matches_output, extension = os.path.splitext(args.matches.replace('\\','/').split('/')[-1])
+    matches_output = f'{stack_outpath}/{matches_output}_processed{extension}'
+    write_match_index(matches, matches_output)
@@ -0,0 +1,691 @@
+"""
+Local stand-in for the Stanford Joint Science Operations Center (JSOC) http://jsoc.stanford.edu/
+that speaks the drms JSON protocol.  It answers record-set queries, export requests and export
+status checks, and serves synthetic AIA/HMI files with JSOC names and headers, so the Downloader
+can be run and benchmarked without a JSOC account or network access.
+
+Example:
+python -m search_download.fake_jsoc --port 8080 --queue_delay 10 --bandwidth 5e6
+
+"""
+import argparse
+import datetime
+import io
+import json
+import re
+import tarfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import drms
+import numpy as np
+from astropy.io import fits
+
+from search_download.downloader import CADENCE_SECONDS
+
+# Series the Downloader exports from, with their native cadence in seconds
+SERIES = {
+    "aia.lev1_euv_12s": {"instrument": "aia", "cadence": 12, "segment": "image_lev1"},
+    "aia.lev1_uv_24s": {"instrument": "aia", "cadence": 24, "segment": "image_lev1"},
+    "aia.lev1_vis_1h": {"instrument": "aia", "cadence": 3600, "segment": "image_lev1"},
+    "hmi.m_720s": {"instrument": "hmi", "cadence": 720, "segment": "magnetogram"},
+}
+
+# Keywords written to the synthetic headers and listed by series_struct, with their DRMS type
+KEYWORD_TYPES = {
+    "T_REC": "time",
+    "T_OBS": "time",
+    "DATE-OBS": "string",
+    "WAVELNTH": "int",
+    "EXPTIME": "double",
+    "QUALITY": "int",
+    "CDELT1": "double",
+    "CDELT2": "double",
+    "CRPIX1": "double",
+    "CRPIX2": "double",
+    "CROTA2": "double",
+    "RSUN_OBS": "double",
+    "DSUN_OBS": "double",
+}
+
+SUN_RADIUS_ARCSEC = 976.0
+FULL_RESOLUTION = 4096
+
+
+def parse_record_set(jsoc_string: str):
+    """
+    Split a JSOC record set such as aia.lev1_euv_12s[2010-12-21/1d@12m][171]{image}
+    into its series, T_REC values, wavelength and segment
+
+    Parameters:
+        jsoc_string: (str)
+            JSOC record set as produced by Downloader.assemble_jsoc_string
+
+    Returns:
+        series: (str)
+            Lower case series name
+        t_recs: (list)
+            Datetimes of the records on the native cadence of the series
+        wavelength: (int)
+            AIA wavelength, or None for HMI
+        segment: (str)
+            Requested segment, or None for all segments
+    """
+    match = re.match(
+        r"\s*([\w\.]+)\[([^/\]]+)/(\d+)([smhd])(?:@(\d+)([smhd]))?\](?:\[(\d+)\])?(?:\{(\w+)\})?",
+        jsoc_string,
+    )
+    series = match.group(1).lower()
+    start = datetime.datetime.fromisoformat(match.group(2))
+    duration = int(match.group(3)) * CADENCE_SECONDS[match.group(4)]
+    cadence = SERIES[series]["cadence"]
+    if match.group(5):
+        cadence = max(cadence, int(match.group(5)) * CADENCE_SECONDS[match.group(6)])
+    t_recs = [
+        start + datetime.timedelta(seconds=offset)
+        for offset in range(0, duration, cadence)
+    ]
+    wavelength = int(match.group(7)) if match.group(7) else None
+    return series, t_recs, wavelength, match.group(8)
+
+
+def t_rec_string(t_rec: datetime.datetime, wavelength: int = None):
+    """
+    T_REC keyword value of an AIA record, or of an HMI record if wavelength is None
+    """
+    if wavelength is None:
+        return t_rec.strftime("%Y.%m.%d_%H:%M:%S_TAI")
+    return t_rec.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def record_string(t_rec: datetime.datetime, wavelength: int = None, series: str = None):
+    """
+    JSOC record string of an AIA image record, or of an HMI magnetogram if wavelength is None
+    """
+    if wavelength is None:
+        return f"hmi.M_720s[{t_rec_string(t_rec)}]{{magnetogram}}"
+    if series is None:
+        series = "aia.lev1_euv_12s"
+    return f"{series}[{t_rec_string(t_rec, wavelength)}][{wavelength}]{{image_lev1}}"
+
+
+def export_filename(
+    t_rec: datetime.datetime, wavelength: int = None, series: str = None, file_type: str = "fits"
+):
+    """
+    JSOC export filename of an AIA image record, or of an HMI magnetogram if wavelength is None
+    """
+    if wavelength is None:
+        return f"hmi.m_720s.{t_rec.strftime('%Y%m%d_%H%M%S')}_TAI.1.magnetogram.{file_type}"
+    if series is None:
+        series = "aia.lev1_euv_12s"
+    if file_type == "jpg":
+        return f"{series}.{t_rec.strftime('%Y%m%dT%H%M%S')}Z.{wavelength}.image_lev1.jpg"
+    return f"{series}.{t_rec.strftime('%Y-%m-%dT%H%M%S')}Z.{wavelength}.image_lev1.{file_type}"
+
+
+def synthetic_header(t_rec: datetime.datetime, wavelength: int = None, image_size: int = 256):
+    """
+    Level 1 header of an AIA image, or of an HMI magnetogram if wavelength is None, with the
+    pointing keywords scaled to the image size
+
+    Parameters:
+        t_rec: (datetime.datetime)
+            Slot time of the record
+        wavelength: (int)
+            AIA wavelength, or None for HMI
+        image_size: (int)
+            Number of pixels on a side
+
+    Returns:
+        header: (astropy.io.fits.Header)
+    """
+    scale = FULL_RESOLUTION / image_size
+    t_obs = t_rec + datetime.timedelta(seconds=1.5 if wavelength is not None else 0)
+    header = fits.Header()
+    if wavelength is None:
+        header["TELESCOP"] = "SDO/HMI"
+        header["INSTRUME"] = "HMI_FRONT2"
+        header["CONTENT"] = "MAGNETOGRAM"
+        header["WAVELNTH"] = 6173
+        header["BUNIT"] = "Gauss"
+        header["EXPTIME"] = 135.0
+        cdelt = 0.504 * scale
+    else:
+        header["TELESCOP"] = "SDO/AIA"
+        header["INSTRUME"] = "AIA_3" if wavelength < 1000 else "AIA_2"
+        header["WAVELNTH"] = wavelength
+        header["WAVEUNIT"] = "angstrom"
+        header["BUNIT"] = "DN"
+        header["EXPTIME"] = 2.0
+        cdelt = 0.6 * scale
+    header["LVL_NUM"] = 1.0
+    header["T_REC"] = t_rec_string(t_rec, wavelength)
+    header["T_OBS"] = t_obs.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    header["DATE-OBS"] = t_obs.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    header["QUALITY"] = 0
+    header["CTYPE1"] = "HPLN-TAN"
+    header["CTYPE2"] = "HPLT-TAN"
+    header["CUNIT1"] = "arcsec"
+    header["CUNIT2"] = "arcsec"
+    header["CDELT1"] = cdelt
+    header["CDELT2"] = cdelt
+    header["CRPIX1"] = image_size / 2 + 0.5
+    header["CRPIX2"] = image_size / 2 + 0.5
+    header["CRVAL1"] = 0.0
+    header["CRVAL2"] = 0.0
+    header["CROTA2"] = 0.0
+    header["RSUN_OBS"] = SUN_RADIUS_ARCSEC
+    header["R_SUN"] = SUN_RADIUS_ARCSEC / cdelt
+    header["DSUN_OBS"] = 1.496e11
+    header["PERCENTD"] = 100.0
+    return header
+
+
+def synthetic_image(t_rec: datetime.datetime, wavelength: int = None, image_size: int = 256):
+    """
+    Limb-brightened solar disk (AIA) or a pair of bipolar regions on a noise floor (HMI)
+    that changes slowly with time, so consecutive frames differ
+
+    Parameters:
+        t_rec: (datetime.datetime)
+            Slot time of the record
+        wavelength: (int)
+            AIA wavelength, or None for HMI
+        image_size: (int)
+            Number of pixels on a side
+
+    Returns:
+        image: (np.ndarray)
+            int16 image of image_size x image_size pixels
+    """
+    cdelt = (0.504 if wavelength is None else 0.6) * FULL_RESOLUTION / image_size
+    axis = (np.arange(image_size, dtype=np.float32) - image_size / 2 + 0.5) * cdelt
+    r = np.hypot(axis[None, :], axis[:, None]) / SUN_RADIUS_ARCSEC
+    phase = t_rec.timestamp() / 86400
+    rng = np.random.default_rng(int(t_rec.timestamp()) + (wavelength or 0))
+    noise = rng.normal(0, 1, (image_size, image_size)).astype(np.float32)
+
+    if wavelength is None:
+        x = axis[None, :] / SUN_RADIUS_ARCSEC - 0.3 * np.sin(phase)
+        y = axis[:, None] / SUN_RADIUS_ARCSEC
+        image = 800 * (np.exp(-((x - 0.05) ** 2 + y**2) / 0.002) - np.exp(-((x + 0.05) ** 2 + y**2) / 0.002))
+        image = np.where(r < 1, image + 10 * noise, -32768)
+    else:
+        disk = np.where(r < 1, 1 + 0.5 * r**2, np.exp(-(r - 1) * 20) * 1.5)
+        image = 300 * (1 + 0.1 * np.sin(phase)) * disk + 5 * noise
+    return np.clip(image, -32768, 32767).astype(np.int16)
+
+
+def fits_file(
+    t_rec: datetime.datetime, wavelength: int = None, image_size: int = 256, compress: bool = True
+):
+    """
+    Bytes of a synthetic level 1 fits file.  Like the JSOC files, the image is stored
+    RICE-compressed in the first extension unless compress is False.
+
+    Parameters:
+        t_rec: (datetime.datetime)
+            Slot time of the record
+        wavelength: (int)
+            AIA wavelength, or None for HMI
+        image_size: (int)
+            Number of pixels on a side
+        compress: (bool)
+            Whether to write a tile-compressed image extension
+
+    Returns:
+        content: (bytes)
+    """
+    header = synthetic_header(t_rec, wavelength, image_size)
+    image = synthetic_image(t_rec, wavelength, image_size)
+    if compress:
+        hdus = fits.HDUList(
+            [fits.PrimaryHDU(), fits.CompImageHDU(image, header, compression_type="RICE_1")]
+        )
+    else:
+        hdus = fits.HDUList([fits.PrimaryHDU(image, header)])
+    buffer = io.BytesIO()
+    hdus.writeto(buffer)
+    return buffer.getvalue()
+
+
+def jpg_file(t_rec: datetime.datetime, wavelength: int = None, image_size: int = 256):
+    """
+    Bytes of a synthetic jpg image of a record
+    """
+    from PIL import Image
+
+    image = synthetic_image(t_rec, wavelength, image_size).astype(np.float32)
+    image = 255 * (image - image.min()) / max(1, np.ptp(image))
+    buffer = io.BytesIO()
+    Image.fromarray(image.astype(np.uint8)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 request handler with keep-alive connections that serves file content,
+    honouring bytes=start- range requests like the JSOC download server
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_file(self, content: bytes = None, write=None, limit: int = None):
+        """
+        Answer the request with content, or with the part of it asked for by a Range header
+
+        Parameters:
+            content: (bytes)
+                Full content of the file
+            write: (function)
+                Called as write(stream, body) to send the body, stream.write if None
+            limit: (int)
+                Number of bytes after which the body is cut off and the connection closed,
+                with the full Content-Length announced, None to send everything
+        """
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header is not None:
+            start = int(re.match(r"bytes=(\d+)-", range_header).group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        body = content[start:]
+        if limit is not None:
+            body = body[:limit]
+            self.close_connection = True
+        if write is None:
+            self.wfile.write(body)
+        else:
+            write(self.wfile, body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeJsocServer:
+    """
+    Local HTTP server that answers the drms JSON requests (jsoc_info, jsoc_fetch and
+    checkAddress.sh) and serves the exported files.  Exports wait in a queue for
+    queue_delay + record_delay * records seconds, and every file transfer is throttled
+    to bandwidth bytes per second.
+
+    Parameters:
+        port: (int)
+            Port to listen on, 0 picks a free one
+        queue_delay: (float)
+            Seconds every export waits in the queue
+        record_delay: (float)
+            Additional queue seconds per exported record
+        bandwidth: (float)
+            Bytes per second of every file transfer, None for no limit
+        latency: (float)
+            Seconds every HTTP request waits before it is answered
+        image_size: (int)
+            Number of pixels on a side of the synthetic images
+        compress: (bool)
+            Whether the fits files are RICE-compressed like the JSOC ones
+        fail_exports: (int)
+            Number of export requests that fail on the JSOC side before the rest succeed
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        queue_delay: float = 0,
+        record_delay: float = 0,
+        bandwidth: float = None,
+        latency: float = 0,
+        image_size: int = 256,
+        compress: bool = True,
+        fail_exports: int = 0,
+    ):
+        self.queue_delay = queue_delay
+        self.record_delay = record_delay
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.image_size = image_size
+        self.compress = compress
+        self.fail_exports = fail_exports
+        self.exports = {}  # requestid -> export description
+        self.files = {}  # download path -> (t_rec, wavelength, file type) or tar member paths
+        self.cache = {}  # (t_rec, wavelength, file type) -> file content
+        self.requests = []  # (operation, argument) of every JSON request
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(FileRequestHandler):
+            def do_GET(self):
+                time.sleep(server.latency)
+                url = urllib.parse.urlparse(self.path)
+                args = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+                cgi = url.path.split("/")[-1]
+                if cgi in ["jsoc_info", "jsoc_fetch", "checkAddress.sh"]:
+                    self.send_json(server.handle_json(cgi, args))
+                elif url.path in server.files:
+                    self.send_file(server.file_content(url.path), server.throttled_write)
+                else:
+                    self.send_error(404)
+
+            def send_json(self, content):
+                body = json.dumps(content).encode("latin1")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        """
+        Base URL of the server
+        """
+        return f"http://127.0.0.1:{self.server.server_port}/"
+
+    def server_config(self):
+        """
+        drms server configuration that points at this server
+
+        Parameters:
+            None
+
+        Returns:
+            config: (drms.config.ServerConfig)
+        """
+        return drms.config.ServerConfig(
+            name="FAKEJSOC",
+            cgi_baseurl=self.url + "cgi-bin/ajax/",
+            cgi_jsoc_info="jsoc_info",
+            cgi_jsoc_fetch="jsoc_fetch",
+            cgi_check_address="checkAddress.sh",
+            http_download_baseurl=self.url,
+        )
+
+    def client(self, email: str = "user@example.com"):
+        """
+        drms.Client connected to this server
+
+        Parameters:
+            email: (str)
+                Export address, every address is accepted as registered
+
+        Returns:
+            client: (drms.Client)
+        """
+        return drms.Client(server=self.server_config(), email=email)
+
+    def handle_json(self, cgi: str = None, args: dict = None):
+        """
+        Answer a drms JSON request
+
+        Parameters:
+            cgi: (str)
+                Name of the requested CGI program
+            args: (dict)
+                Query arguments of the request
+
+        Returns:
+            response: (dict)
+        """
+        op = "check_address" if cgi == "checkAddress.sh" else args.get("op")
+        with self._lock:
+            self.requests.append((op, args.get("ds", args.get("requestid"))))
+        try:
+            if op == "check_address":
+                return {"status": 2, "msg": "Email address is registered"}
+            if op == "series_struct":
+                return self.series_struct(args["ds"])
+            if op == "rs_list":
+                return self.rs_list(args["ds"], args.get("key", ""))
+            if op == "exp_request":
+                return self.exp_request(args)
+            if op == "exp_status":
+                return self.exp_status(args["requestid"])
+        except (AttributeError, KeyError, ValueError) as e:
+            return {"status": 1, "error": f"Bad request: {e}"}
+        return {"status": 1, "error": f"Unsupported operation {op}"}
+
+    def series_struct(self, ds: str = None):
+        """
+        Series description with the primekeys, keywords and segment of the series
+        """
+        series = SERIES.get(ds.lower())
+        if series is None:
+            return {"status": 1, "error": f"Unknown series {ds}"}
+        primekeys = ["T_REC"] if series["instrument"] == "hmi" else ["T_REC", "WAVELNTH"]
+        return {
+            "status": 0,
+            "primekeys": primekeys,
+            "dbindex": primekeys,
+            "note": f"Synthetic {series['instrument'].upper()} series",
+            "retention": 10000,
+            "unitsize": 1,
+            "archive": 1,
+            "tapegroup": 1,
+            "keywords": [{"name": k, "type": t} for k, t in KEYWORD_TYPES.items()],
+            "links": [],
+            "segments": [{"name": series["segment"], "type": "short", "protocol": "fits"}],
+        }
+
+    def rs_list(self, ds: str = None, key: str = ""):
+        """
+        Keyword values of every record of a record set
+        """
+        series, t_recs, wavelength, _ = parse_record_set(ds)
+        names = [k.strip().upper() for k in key.split(",") if k.strip()]
+        headers = None
+        keywords = []
+        for name in names:
+            if name == "T_REC":
+                values = [t_rec_string(t_rec, wavelength) for t_rec in t_recs]
+            else:
+                if headers is None:
+                    headers = [synthetic_header(t_rec, wavelength, self.image_size) for t_rec in t_recs]
+                values = [str(h.get(name, "MISSING")) for h in headers]
+            keywords.append({"name": name, "values": values})
+        return {"status": 0, "count": len(t_recs), "keywords": keywords}
+
+    def exp_request(self, args: dict = None):
+        """
+        Queue an export request.  url_quick exports of as-is files are answered at once
+        with the storage paths of the files, like on JSOC.
+        """
+        series, t_recs, wavelength, _ = parse_record_set(args["ds"])
+        method = args.get("method", "url_quick")
+        protocol = args.get("protocol", "as-is").split(",")[0].lower()
+        file_type = "jpg" if protocol == "jpg" else "fits"
+
+        with self._lock:
+            number = len(self.exports) + 1
+            fail = number <= self.fail_exports
+            requestid = f"JSOC_{datetime.date.today().strftime('%Y%m%d')}_{number:03d}"
+            self.exports[requestid] = {
+                "series": series,
+                "t_recs": t_recs,
+                "wavelength": wavelength,
+                "method": method,
+                "protocol": protocol,
+                "file_type": file_type,
+                "fail": fail,
+                "ready": time.time() + self.queue_delay + self.record_delay * len(t_recs),
+            }
+
+        if method == "url_quick" and protocol == "as-is" and not fail:
+            data = []
+            for n, t_rec in enumerate(t_recs):
+                path = f"/SUM{number}/D{n}/S00000/image_lev1.fits"
+                if wavelength is None:
+                    path = f"/SUM{number}/D{n}/S00000/magnetogram.fits"
+                self.files[path] = (t_rec, wavelength, file_type)
+                data.append({"record": record_string(t_rec, wavelength, series), "filename": path})
+            return {
+                "status": 0,
+                "requestid": "",
+                "method": method,
+                "protocol": protocol,
+                "dir": None,
+                "count": len(data),
+                "data": data,
+                "wait": 0,
+            }
+        return {
+            "status": 2,
+            "requestid": requestid,
+            "method": method,
+            "protocol": protocol,
+            "wait": self.queue_delay,
+        }
+
+    def exp_status(self, requestid: str = None):
+        """
+        Status of a queued export, with the file list once it is ready
+        """
+        export = self.exports.get(requestid)
+        if export is None:
+            return {"status": 6, "error": f"Request {requestid} not found"}
+        remaining = export["ready"] - time.time()
+        if remaining > 0:
+            return {"status": 1, "requestid": requestid, "wait": remaining}
+        if export["fail"]:
+            return {"status": 4, "requestid": requestid, "error": "Export failed"}
+
+        directory = f"/SUM/export/{requestid}"
+        data = []
+        for t_rec in export["t_recs"]:
+            filename = export_filename(
+                t_rec, export["wavelength"], export["series"], export["file_type"]
+            )
+            self.files[f"{directory}/{filename}"] = (t_rec, export["wavelength"], export["file_type"])
+            data.append(
+                {"record": record_string(t_rec, export["wavelength"], export["series"]), "filename": filename}
+            )
+        tar = None
+        if export["method"] == "url-tar":
+            tar = f"{directory}/{requestid}.tar"
+            self.files[tar] = [f"{directory}/{d['filename']}" for d in data]
+        return {
+            "status": 0,
+            "requestid": requestid,
+            "method": export["method"],
+            "protocol": export["protocol"],
+            "dir": directory,
+            "count": len(data),
+            "data": data,
+            "tarfile": tar,
+            "wait": 0,
+        }
+
+    def file_content(self, path: str = None):
+        """
+        Content of a served file, generated on first use.  Tar exports are assembled from
+        their member files.
+        """
+        entry = self.files[path]
+        if isinstance(entry, list):
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode="w") as tar:
+                for member in entry:
+                    content = self.file_content(member)
+                    info = tarfile.TarInfo(member.split("/")[-1])
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+            return buffer.getvalue()
+
+        with self._lock:
+            content = self.cache.get(entry)
+        if content is None:
+            t_rec, wavelength, file_type = entry
+            if file_type == "jpg":
+                content = jpg_file(t_rec, wavelength, self.image_size)
+            else:
+                content = fits_file(t_rec, wavelength, self.image_size, self.compress)
+            with self._lock:
+                self.cache[entry] = content
+        return content
+
+    def throttled_write(self, stream, content: bytes = None, chunk_size: int = 1 << 14):
+        """
+        Write content to a response stream at no more than bandwidth bytes per second
+        """
+        start = time.perf_counter()
+        for offset in range(0, len(content), chunk_size):
+            chunk = content[offset : offset + chunk_size]
+            if self.bandwidth:
+                ahead = (offset + len(chunk)) / self.bandwidth - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            with self._lock:
+                self.bytes_sent += len(chunk)
+            stream.write(chunk)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments to script.
+
+    Parameters:
+        args (list):    defaults to parsing any command line arguments
+
+    Returns:
+        parser args:    Namespace from argparse
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--queue_delay", type=float, default=0, help="Seconds every export waits in the queue"
+    )
+    parser.add_argument(
+        "--record_delay", type=float, default=0, help="Additional queue seconds per exported record"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, help="Bytes per second of every file transfer"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds every HTTP request waits"
+    )
+    parser.add_argument(
+        "--image_size", type=int, default=256, help="Pixels on a side of the synthetic images"
+    )
+    parser.add_argument(
+        "--no_compress", action="store_true", help="Serve uncompressed fits files"
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parser = parse_args()
+    server = FakeJsocServer(
+        port=parser.port,
+        queue_delay=parser.queue_delay,
+        record_delay=parser.record_delay,
+        bandwidth=parser.bandwidth,
+        latency=parser.latency,
+        image_size=parser.image_size,
+        compress=not parser.no_compress,
+    )
+    print(f"Fake JSOC listening on {server.url}cgi-bin/ajax/ (Ctrl+C to stop)")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,241 @@
+"""
+File that contains the FileFetcher class to download the individual files of JSOC exports
+made with the per-file methods ('url' and 'url_quick') using a pool of HTTP workers.
+
+"""
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+class FileFetcher:
+    """
+    Download a list of files with a bounded pool of workers.  Every worker keeps its own
+    keep-alive connection per host, partial downloads are resumed with HTTP range
+    requests and failed transfers are retried with exponential backoff.  The pool and its
+    connections are kept between calls to fetch until close is called.
+
+    Parameters:
+        max_workers: (int)
+            Number of files transferred at the same time
+        max_retries: (int)
+            Number of times a failed transfer is retried before giving up
+        backoff: (float)
+            Seconds to wait before the first retry, doubled on every further retry
+        timeout: (float)
+            Socket timeout in seconds
+        chunk_size: (int)
+            Number of bytes read from the socket at a time
+        progress: (bool)
+            Whether to show a tqdm progress bar
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_retries: int = 3,
+        backoff: float = 1,
+        timeout: float = 60,
+        chunk_size: int = 1 << 20,
+        progress: bool = True,
+    ):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._connections = set()  # Open connections of all workers, closed by close
+
+    def _connection(self, scheme: str, netloc: str):
+        """
+        Return the keep-alive connection of the calling worker for a host
+        """
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+            with self._lock:
+                self._connections.add(connection)
+        return connection
+
+    def _drop_connection(self, scheme: str, netloc: str):
+        connection = self._local.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+            with self._lock:
+                self._connections.discard(connection)
+
+    def _worker_pool(self):
+        """
+        Return the worker pool, started on first use
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fetch")
+            return self._pool
+
+    def close(self):
+        """
+        Stop the worker pool and close the connections of its workers.  The next call to
+        fetch starts a new pool.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            connections, self._connections = self._connections, set()
+        if pool is not None:
+            pool.shutdown(wait=True)
+        for connection in connections:
+            connection.close()
+
+    @staticmethod
+    def _expected_size(response, offset: int):
+        """
+        Size of the complete file announced by a 200 or 206 response, None if unknown
+        """
+        if response.status == 206:
+            content_range = response.getheader("Content-Range", "")
+            total = content_range.rpartition("/")[2]
+            if total.isdigit():
+                return int(total)
+            length = response.getheader("Content-Length")
+            return offset + int(length) if length is not None else None
+        length = response.getheader("Content-Length")
+        return int(length) if length is not None else None
+
+    def _transfer(self, url: str, destination: str):
+        """
+        Single attempt at downloading url into destination, resuming from destination.part.
+        A transfer that ends before the announced size raises http.client.IncompleteRead
+        and keeps the partial file, so the next attempt resumes it.
+        """
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        tmp_file = destination + ".part"
+        offset = os.path.getsize(tmp_file) if os.path.exists(tmp_file) else 0
+
+        headers = {"User-Agent": "hits-sdo-downloader"}
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+
+        connection = self._connection(parsed.scheme, parsed.netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if response.status == 416 and offset > 0:
+                # The partial file is already complete
+                response.read()
+                os.replace(tmp_file, destination)
+                return
+            if response.status not in (200, 206):
+                response.read()
+                raise OSError(f"HTTP {response.status} while downloading {url}")
+
+            # Append to the partial file, or start over if the server ignored the range
+            mode = "ab" if response.status == 206 else "wb"
+            size = offset if response.status == 206 else 0
+            expected = self._expected_size(response, offset)
+            with open(tmp_file, mode) as out_file:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+                    size += len(chunk)
+            # http.client returns an empty read instead of raising when the connection drops
+            if expected is not None and size < expected:
+                raise http.client.IncompleteRead(b"", expected - size)
+            if response.will_close:
+                self._drop_connection(parsed.scheme, parsed.netloc)
+        except (OSError, http.client.HTTPException):
+            self._drop_connection(parsed.scheme, parsed.netloc)
+            raise
+
+        os.replace(tmp_file, destination)
+
+    def fetch_file(self, url: str, destination: str):
+        """
+        Download a single file, retrying with exponential backoff
+
+        Parameters:
+            url: str
+                URL of the file
+            destination: str
+                Final path of the file, files that already exist are skipped
+
+        Returns:
+            transferred: (int)
+                Number of bytes received, or None if the download failed
+        """
+        if os.path.exists(destination):
+            return 0
+        part_file = destination + ".part"
+        resumed = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._transfer(url, destination)
+                return os.path.getsize(destination) - resumed
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self.max_retries:
+                    print(f"Could not download {url}: {e}")
+                    return None
+                time.sleep(self.backoff * 2**attempt)
+
+    def fetch(self, urls: list, destinations: list):
+        """
+        Download all files with the worker pool
+
+        Parameters:
+            urls: list
+                URLs to download
+            destinations: list
+                Final path of each file
+
+        Returns:
+            stats: (dict)
+                Number of files, failed files, bytes, seconds and MB/s of the transfer
+        """
+        start = time.time()
+        results = list(
+            tqdm(
+                self._worker_pool().map(self.fetch_file, urls, destinations),
+                total=len(urls),
+                desc="Downloading files",
+                disable=not self.progress,
+            )
+        )
+        seconds = time.time() - start
+
+        n_bytes = sum(r for r in results if r is not None)
+        stats = {
+            "files": len(urls),
+            "failed": [d for d, r in zip(destinations, results) if r is None],
+            "bytes": n_bytes,
+            "seconds": seconds,
+            "mb_per_s": n_bytes / 1e6 / seconds if seconds > 0 else 0.0,
+        }
+        print(
+            f"Fetched {stats['files'] - len(stats['failed'])} of {stats['files']} files, "
+            f"{n_bytes / 1e6:.1f} MB in {seconds:.1f} s ({stats['mb_per_s']:.1f} MB/s)"
+        )
+        return stats
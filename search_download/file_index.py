@@ -0,0 +1,209 @@
+"""
+File that contains the FileIndex class, a persistent SQLite index of the downloaded AIA and HMI
+files so that the indexer only lists, parses and quality-checks what changed since its last run.
+
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from search_download.utils.file_scan import filenames_to_dates, scan_fits_quality
+from search_download.utils.scandir_walker import walk_files
+
+
+class FileIndex:
+    """
+    Index of the files of each channel with their size, modification time, parsed date and
+    quality flag, stored in a single SQLite file.  Each update stats the channel directories:
+    a directory whose modification time did not change since the last update is not listed
+    again, and in the others only new or changed files are parsed and deleted ones dropped.
+
+    Parameters:
+        path: (str)
+            Path of the SQLite file, an in-memory index if None
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(":memory:" if path is None else path, timeout=30,
+                                           check_same_thread=False)
+        with self._lock, self._connection as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, channel TEXT, size INTEGER, mtime_ns INTEGER, "
+                "date_ns INTEGER, quality INTEGER, error TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS files_channel ON files (channel, date_ns)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "channel TEXT PRIMARY KEY, path TEXT, pattern TEXT, mtime_ns INTEGER)"
+            )
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def list_directory(directory: str = None, pattern: str = "*"):
+        """
+        Size and modification time of the files of a directory matching a pattern
+
+        Parameters:
+            directory: (str)
+                Directory to list, not recursively
+            pattern: (str)
+                fnmatch pattern of the file names
+
+        Returns:
+            files: (dict)
+                path -> (size, mtime_ns)
+        """
+        files = {}
+        for entry in walk_files(directory, pattern):
+            stat = entry.stat()
+            files[entry.path.replace("\\", "/")] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def update_channel(self, channel: str = None, directory: str = None, pattern: str = "*",
+                       check_fits: bool = False, force: bool = False, **scan_kwargs):
+        """
+        Bring the index of one channel up to date with its directory
+
+        Parameters:
+            channel: (str)
+                Name of the channel, e.g. aia171 or hmi
+            directory: (str)
+                Directory of the channel files
+            pattern: (str)
+                fnmatch pattern of the channel file names
+            check_fits: (bool)
+                Whether to read the quality flag of files that do not have one yet
+            force: (bool)
+                List the directory even if its modification time did not change
+            scan_kwargs:
+                Additional scan_fits_quality arguments, e.g. max_workers or batch_size
+
+        Returns:
+            stats: (dict)
+                Numbers of added, changed, removed and quality-checked files, and whether
+                the directory was listed
+        """
+        stats = {"channel": channel, "listed": False, "added": 0, "changed": 0, "removed": 0, "checked": 0}
+        directory = directory.replace("\\", "/")
+        directory_mtime = os.stat(directory).st_mtime_ns
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT path, pattern, mtime_ns FROM directories WHERE channel = ?", (channel,)
+            ).fetchone()
+        if force or row is None or tuple(row) != (directory, pattern, directory_mtime):
+            stats["listed"] = True
+            stats.update(self._sync_files(channel, directory, pattern))
+            with self._lock, self._connection as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                    (channel, directory, pattern, directory_mtime),
+                )
+
+        if check_fits:
+            stats["checked"] = self._check_quality(channel, **scan_kwargs)
+        return stats
+
+    def _sync_files(self, channel, directory, pattern):
+        listed = self.list_directory(directory, pattern)
+        with self._lock:
+            indexed = {
+                path: (size, mtime_ns)
+                for path, size, mtime_ns in self._connection.execute(
+                    "SELECT path, size, mtime_ns FROM files WHERE channel = ?", (channel,)
+                )
+            }
+
+        removed = [(path,) for path in indexed.keys() - listed.keys()]
+        new = [path for path, stat in listed.items() if indexed.get(path) != stat]
+        dates = filenames_to_dates([new], errors="coerce")[0] if new else []
+        rows = [
+            (path, channel, *listed[path], None if pd.isna(date) else date.value, None, None)
+            for path, date in zip(new, dates)
+        ]
+        with self._lock, self._connection as connection:
+            connection.executemany("DELETE FROM files WHERE path = ?", removed)
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+        added = sum(path not in indexed for path in new)
+        return {"added": added, "changed": len(new) - added, "removed": len(removed)}
+
+    def _check_quality(self, channel, **scan_kwargs):
+        with self._lock:
+            files = [
+                path for path, in self._connection.execute(
+                    "SELECT path FROM files WHERE channel = ? AND quality IS NULL AND error IS NULL",
+                    (channel,),
+                )
+            ]
+        if not files:
+            return 0
+        quality = scan_fits_quality(files, keywords=["QUALITY"], **scan_kwargs)
+        rows = [
+            (None if pd.isna(q) else int(q), error, path)
+            for path, q, error in zip(quality.file, quality.QUALITY, quality.error)
+        ]
+        with self._lock, self._connection as connection:
+            connection.executemany("UPDATE files SET quality = ?, error = ? WHERE path = ?", rows)
+        return len(rows)
+
+    def update(self, channels: dict = None, check_fits: bool = False, force: bool = False, **scan_kwargs):
+        """
+        Bring the index of several channels up to date
+
+        Parameters:
+            channels: (dict)
+                channel -> (directory, pattern)
+            check_fits: (bool)
+                Whether to read the quality flag of files that do not have one yet
+            force: (bool)
+                List the directories even if their modification time did not change
+            scan_kwargs:
+                Additional scan_fits_quality arguments
+
+        Returns:
+            stats: (pandas.DataFrame)
+                One row per channel, see update_channel, with the seconds it took
+        """
+        stats = []
+        for channel, (directory, pattern) in channels.items():
+            start = time.perf_counter()
+            channel_stats = self.update_channel(channel, directory, pattern, check_fits, force, **scan_kwargs)
+            channel_stats["seconds"] = time.perf_counter() - start
+            stats.append(channel_stats)
+        return pd.DataFrame(stats)
+
+    def files(self, channel: str = None, check_fits: bool = False):
+        """
+        Indexed files of a channel with a parsed date, sorted by path
+
+        Parameters:
+            channel: (str)
+                Name of the channel
+            check_fits: (bool)
+                Only return files whose quality flag is 0
+
+        Returns:
+            files: (pandas.DataFrame)
+                path, date, size, quality and error columns
+        """
+        query = "SELECT path, date_ns, size, quality, error FROM files WHERE channel = ? AND date_ns IS NOT NULL"
+        if check_fits:
+            query += " AND quality = 0"
+        with self._lock:
+            files = pd.read_sql_query(query + " ORDER BY path", self._connection, params=(channel,))
+        files.insert(1, "date", pd.to_datetime(files.pop("date_ns"), unit="ns"))
+        return files
@@ -16,86 +16,275 @@ Andres Muñoz-Jaramillo - andres.munoz@swri.org // https://github.com/amunozj
 
 import re
 import os
-import glob
-from functools import partial
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
-from tqdm.contrib.concurrent import process_map
+import pandas as pd
+from tqdm import tqdm
 
+from search_download.utils.scandir_walker import list_files
 
-def rename_filename(wavelength:int = None, file:str=None):
+# One parser for every JSOC filename the downloader produces, e.g.
+# aia.lev1_euv_12s.2010-12-21T120013Z.171.image_lev1.fits, aia.lev1_euv_12s.2010-12-21T000013Z.171.spikes.fits,
+# hmi.m_720s.20101223_000000_TAI.1.magnetogram.fits and aia.lev1_euv_12s.20101221T000013Z.171.image_lev1.jpg
+JSOC_FILENAME = re.compile(
+    r"(?P<instrument>[a-z]+)\.\w+\."
+    r"(?P<date>\d{4}[-.]?\d{2}[-.]?\d{2})[T_](?P<time>\d{2}:?\d{2}:?\d{2})Z?(?:_TAI)?\."
+    r"(?:(?P<wavelength>\d+)\.)?"
+    r"(?P<segment>\w+)\.(?P<file_type>fits|jpg)$"
+)
+RENAMED_FILENAME = re.compile(r"\d{8}_\d{6}_[a-z]+_\d+_4k")
+RECORD_PRIME_KEYS = re.compile(r"\[([^\]]*)\]")
+NON_DIGITS = re.compile(r"\D")
+
+# Thread pools kept between calls to rename_filenames, by number of workers
+RENAME_POOLS = {}
+RENAME_POOLS_LOCK = threading.Lock()
+
+
+def is_renamed(file:str=None):
+    '''
+    Check whether a file already has the compact YYYYMMDD_HHMMSS_INSTRUMENT_WAVELENGTH_RESOLUTION name
+
+    Parameters:
+        file: str
+            filename or path to check
+
+    Returns:
+        bool
+    '''
+    return RENAMED_FILENAME.match(file.replace("\\", "/").split("/")[-1]) is not None
+
+
+def compact_filename(file:str=None, wavelength:int = None):
     '''
-    Rename file name to this format: YYYYMMDD_HHMMSS_RESOLUTION_INSTRUMENT.[file_type] 
+    Compute the compact name of a JSOC file: YYYYMMDD_HHMMSS_INSTRUMENT_WAVELENGTH_RESOLUTION.[file_type]
     aia strings look like aia.lev1_euv_12s.2010-12-21T120013Z.171.image_lev1.fits or
     aia.lev1_euv_12s.2010-12-21T000013Z.171.spikes.fits
-    
-    hmi strings look like hmi.m_720s.20101223_000000_TAI.1.magnetogram.fits    
 
-    We're using RegEx:
-    https://www.rexegg.com/regex-quickstart.html - RegEx cheat sheet    
+    hmi strings look like hmi.m_720s.20101223_000000_TAI.1.magnetogram.fits
+
+    jpg strings look like aia.lev1_euv_12s.20101221T000013Z.171.image_lev1.jpg
 
-    
     Parameters:
         file: str
-            filemname to rename
+            filename (or path) to convert
         wavelength: int
-            wavelength to append to the filename if None, it gets it from the filename
-    
+            wavelength of jpg files, if None, it gets it from the filename.  Ignored for fits
+            files, whose filename always carries it
+
     Returns:
-        None
+        new_file_name: str
+            compact filename, without the directory
     '''
 
-    path = '/'.join(file.replace("\\", "/").split("/")[0:-1])
     file = file.replace("\\", "/").split("/")[-1]
-    file_type = re.search(r"(jpg|fits)", file).group()
-    instrument = re.search(r"[a-z]+", file).group()
-
-    if file_type == 'fits':
-        date = re.search(r"(\d+)(\S)(\d+)(\S)(\d+)", file).group()     # (\.) ([-|\.])
-        hhmmss = re.search(r"[0-9]{6}", file).group()
-        if instrument == 'aia':
-            wavelength = re.search(r"(?<=\.)(\d{2,4})(?=\.)", file).group()
-        else:
-            wavelength = '1'
-
-    else:
-        date = re.search(r"[0-9]{8}", file).group()
-        hhmmss = re.search(r"(?<=_)[0-9]{6}", file).group()
-        if wavelength is None:
-            wavelength = '1'
+    match = JSOC_FILENAME.search(file)
+    if match is None:
+        raise ValueError(f"{file} is not a JSOC filename")
+    instrument = match.group("instrument")
+    file_type = match.group("file_type")
+
+    if instrument != 'aia':
+        wavelength = '1'
+    elif file_type == 'fits' or wavelength is None:
+        wavelength = match.group("wavelength") or '1'
 
     spikes = ""
-    if re.search("spikes", file):
+    if match.group("segment") == "spikes":
         spikes = ".spikes"
 
+    date = match.group("date").replace('-', '').replace('.', '')
+    hhmmss = match.group("time").replace(':', '')
+
     # Rename file name to this format: YYYYMMDD_HHMMSS_INSTRUMENT_WAVELENGTH_RESOLUTION_.[filetype]
 
-    new_file_name = f"{date.replace('-','').replace('.','')}_{hhmmss.replace(':','')}_{instrument}_{wavelength}_4k{spikes}.{file_type}"
+    return f"{date}_{hhmmss}_{instrument}_{wavelength}_4k{spikes}.{file_type}"
+
+
+def record_filename(record:str=None, file_type:str='fits'):
+    '''
+    Compute the compact name of a file from its JSOC record string, for exports whose
+    filenames carry no date (e.g. image_lev1.fits from url_quick exports).
+    aia records look like aia.lev1_euv_12s[2010-12-21T00:00:02Z][171]{image_lev1}
+
+    hmi records look like hmi.M_720s[2010.12.21_00:00:00_TAI]{magnetogram}
+
+    Parameters:
+        record: str
+            JSOC record string
+        file_type: str
+            extension of the file, fits or jpg
+
+    Returns:
+        new_file_name: str
+            compact filename
+    '''
+
+    instrument = record[0:3].lower()
+    prime_keys = RECORD_PRIME_KEYS.findall(record)
+    digits = NON_DIGITS.sub("", prime_keys[0])
+
+    wavelength = '1'
+    if instrument == 'aia' and len(prime_keys) > 1:
+        wavelength = prime_keys[1]
+
+    spikes = ""
+    if "spikes" in record:
+        spikes = ".spikes"
+
+    return f"{digits[0:8]}_{digits[8:14]}_{instrument}_{wavelength}_4k{spikes}.{file_type}"
+
+
+def rename_filename(wavelength:int = None, file:str=None):
+    '''
+    Rename file name to this format: YYYYMMDD_HHMMSS_RESOLUTION_INSTRUMENT.[file_type]
+    See compact_filename for the accepted JSOC filenames.
+
+    Parameters:
+        file: str
+            filemname to rename
+        wavelength: int
+            wavelength to append to the filename if None, it gets it from the filename
+
+    Returns:
+        None
+    '''
+
+    path = '/'.join(file.replace("\\", "/").split("/")[0:-1])
+    file = file.replace("\\", "/").split("/")[-1]
+    new_file_name = compact_filename(file, wavelength)
     # print(newFileName) # for testing.
     # rename file.
     os.rename(os.path.join(path, file).replace("\\", "/"), os.path.join(path, new_file_name).replace("\\", "/"))
 
 
-def rename_filenames(files:list, wavelength:int = None, max_workers:int = None):
+def rename_table(files:list, wavelength:int = None):
     '''
-    File that uses parallel processing to rename all files.  It calls rename_file
-    (see above).
-    
+    Map JSOC filenames to their compact names without touching the files.  Files that
+    already carry a compact name are left out, files whose name cannot be parsed are kept
+    with their error and no new name.
+
+    Parameters:
+        files: list
+            list of filenames (or paths) to rename
+        wavelength: int
+            wavelength of jpg files, if None, it gets it from the filename
+
+    Returns:
+        table: (pandas.DataFrame)
+            old and new path of every file to rename, and the error of every file that
+            could not be parsed (None otherwise)
+    '''
+    old = []
+    new = []
+    errors = []
+    for file in files:
+        file = file.replace("\\", "/")
+        path, _, name = file.rpartition("/")
+        if is_renamed(name):
+            continue
+        old.append(file)
+        try:
+            name = compact_filename(name, wavelength)
+        except ValueError as e:
+            new.append(None)
+            errors.append(str(e))
+            continue
+        new.append(f"{path}/{name}" if path else name)
+        errors.append(None)
+    return pd.DataFrame({"old": old, "new": new, "error": errors})
+
+
+def rename_pool(max_workers:int = None):
+    '''
+    Thread pool used to rename files.  Renaming is metadata I/O, so threads are enough and
+    the pool is kept between calls instead of being started for every batch of files.
+
+    Parameters:
+        max_workers: int
+            Number of threads, defaults to the ThreadPoolExecutor default
+
+    Returns:
+        pool: (concurrent.futures.ThreadPoolExecutor)
+    '''
+    with RENAME_POOLS_LOCK:
+        if max_workers not in RENAME_POOLS:
+            RENAME_POOLS[max_workers] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="rename"
+            )
+        return RENAME_POOLS[max_workers]
+
+
+def rename_batch(old:list, new:list):
+    '''
+    Rename a batch of files, returning the error of every file that could not be renamed
+
+    Parameters:
+        old: list
+            current paths
+        new: list
+            new paths
+
+    Returns:
+        errors: list
+            None for renamed files, the error message otherwise
+    '''
+    errors = []
+    for old_file, new_file in zip(old, new):
+        try:
+            os.rename(old_file, new_file)
+            errors.append(None)
+        except OSError as e:
+            errors.append(str(e))
+    return errors
+
+
+def rename_filenames(files:list, wavelength:int = None, max_workers:int = None, batch_size:int = 1000, dry_run:bool = False):
+    '''
+    Rename files to their compact names (see compact_filename) in batches on a persistent
+    thread pool.  Files that already carry a compact name are skipped.
+
     Parameters:
         files: list
             list of filemnames to rename
         wavelength: int
-            wavelength to append to the filename if None, it gets it from the filename
+            wavelength of jpg files, if None, it gets it from the filename
         max_workers: int
-            Number of workers to pass to the process map.
+            Number of threads renaming files.
             See https://docs.python.org/3/library/concurrent.futures.html
-    
+        batch_size: int
+            Number of files renamed by each task
+        dry_run: bool
+            If True, only compute the old to new mapping and leave the files alone
+
     Returns:
-        None
+        table: (pandas.DataFrame)
+            old and new path of every file to rename, plus the error of each file (None
+            if it was renamed).  In a dry run only files that cannot be parsed have one.
     '''
 
-    partial_rename_filename = partial(rename_filename, wavelength)
-    process_map(partial_rename_filename, files, max_workers=max_workers)
+    table = rename_table(files, wavelength)
+    parsed = table.error.isna()
+    if dry_run or not parsed.any():
+        return table
+
+    pool = rename_pool(max_workers)
+    old = list(table.old[parsed])
+    new = list(table.new[parsed])
+    futures = [
+        pool.submit(rename_batch, old[i:i + batch_size], new[i:i + batch_size])
+        for i in range(0, len(old), batch_size)
+    ]
+    errors = []
+    with tqdm(total=len(old), unit="file") as progress:
+        for future in futures:
+            batch_errors = future.result()
+            errors += batch_errors
+            progress.update(len(batch_errors))
+    table.loc[parsed, "error"] = errors
+    return table
 
 
 def parse_args(args=None):
@@ -125,7 +314,18 @@ def parse_args(args=None):
     parser.add_argument('--max_workers',
                     type=int,
                     default=None,
-                    help='Specify the number of workers to use during process map'
+                    help='Specify the number of threads renaming files'
+                    )
+
+    parser.add_argument('--batch_size',
+                    type=int,
+                    default=1000,
+                    help='Number of files renamed by each task'
+                    )
+
+    parser.add_argument('--dry_run',
+                    action='store_true',
+                    help='Print the old and new names without renaming the files'
                     )
 
     return parser.parse_args(args)
@@ -133,6 +333,7 @@ def parse_args(args=None):
 if __name__=="__main__":
     parser_output = parse_args()
 
-    files = glob.glob(os.path.join(parser_output.path,'**', f'*.{parser_output.format}').replace('\\','/'))
-    rename_filenames(files)
-
+    files = list_files(parser_output.path, f'*.{parser_output.format}', recursive=True)
+    table = rename_filenames(files, max_workers=parser_output.max_workers, batch_size=parser_output.batch_size, dry_run=parser_output.dry_run)
+    if parser_output.dry_run:
+        print(table.to_string(index=False))
@@ -1,16 +1,17 @@
 import argparse
 import logging
-from datetime import datetime
+import os
 
 from functools import partial
 
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
 
+from search_download.concurrent_file_indexer import read_match_index
+from search_download.sdo_zarr import (SHUFFLES, STORAGE_ENCODINGS, append_dates, channel_scale_offset,
+                                      create_sdo_store, ingest_frames, make_compressor, sample_stacks,
+                                      write_checkpoint)
 from search_download.utils.utils import loadMapStack, loadMap
 import zarr
-from numcodecs import Blosc
 
 # Initialize Python Logger
 logging.basicConfig(format='%(levelname)-4s '
@@ -32,6 +33,71 @@ META_PROPERTIES_TO_KEEP = ['telescop', 'instrume', 'waveunit',   # Instrument pr
                            'crln_obs', 'crlt_obs', 'car_rot', 'hgln_obs', 'hglt_obs',  # Heliographic coordinates
                            'pc1_1', 'pc1_2', 'pc2_1', 'pc2_2'] # Detector rotation matrix
 
+def load_frame(frame,
+               aia_preprocessing=False,
+               aia_calibration='aiapy',
+               aia_normalization='linear',
+               fix_radius_padding=None,
+               resolution=None,
+               remove_nans=False,
+               percentile_clip=0.25):
+    """Load the AIA stack and the HMI magnetogram of one time index.  If only one of them
+    fails (e.g. the QUALITY check of an AIA file), the other one is kept and the channels
+    of the failed one are zero and flagged invalid.
+
+    Parameters
+    ----------
+    frame: tuple with the list of AIA files and the list of HMI files of the time index
+    Other parameters as in parse_args
+
+    Returns
+    -------
+    (channel, y, x) numpy array with the AIA channels followed by HMI, a dict with the
+    META_PROPERTIES_TO_KEEP of the first AIA file (of the HMI file without AIA) and a
+    boolean array that is False for the channels that could not be loaded
+    """
+    aia_files, hmi_files = frame
+    parts = []  # (number of channels, stack or None if it failed)
+    meta = None
+    error = None
+    if len(aia_files) > 0:
+        try:
+            aia_stack, meta = loadMapStack(aia_files,
+                                           aia_preprocessing=aia_preprocessing,
+                                           calibration=aia_calibration,
+                                           normalization=aia_normalization,
+                                           fix_radius_padding=fix_radius_padding,
+                                           resolution=resolution,
+                                           remove_nans=remove_nans,
+                                           percentile_clip=percentile_clip,
+                                           return_meta=True)
+        except Exception as e:
+            LOG.warning(f'AIA stack of {aia_files[0]} failed: {e}')
+            aia_stack, error = None, e
+        parts.append((len(aia_files), aia_stack))
+
+    if len(hmi_files) > 0:
+        try:
+            hmi_map = loadMap(hmi_files[0], resolution=resolution, fix_radius_padding=fix_radius_padding, zero_outside_disk=True)
+            if remove_nans:
+                hmi_map.data[np.isnan(hmi_map.data)] = 1e-10
+                hmi_map.data[np.isinf(hmi_map.data)] = 1e-10
+            if meta is None:
+                meta = hmi_map.meta
+            hmi_stack = hmi_map.data[None, :, :]
+        except Exception as e:
+            LOG.warning(f'HMI map {hmi_files[0]} failed: {e}')
+            hmi_stack, error = None, e
+        parts.append((1, hmi_stack))
+
+    valid = np.array([stack is not None for n, stack in parts for _ in range(n)])
+    if not valid.any():
+        raise error
+    shape = next(stack.shape[1:] for _, stack in parts if stack is not None)
+    stack = np.concatenate([np.zeros((n,) + shape, dtype=np.float32) if stack is None else stack for n, stack in parts])
+    return stack, {key: meta[key] for key in META_PROPERTIES_TO_KEEP if key in meta}, valid
+
+
 def parse_args():
     # Commands 
     p = argparse.ArgumentParser(
@@ -41,8 +107,8 @@ def parse_args():
     p.add_argument('--hmi_path', dest='hmi_path', type=str, default="/mnt/hmi_data",
                    help='hmi path')
     p.add_argument('--matches', dest='matches', type=str,
-                   default="/mnt/data/aia_matches_171_211_304.csv",
-                   help='multi-wavelength matches')
+                   default="/mnt/data/aia_matches_171_211_304.parquet",
+                   help='multi-wavelength matches (.parquet or .csv)')
     p.add_argument('--zarr_outpath', dest='zarr_outpath', type=str,
                    default="/mnt/data_out",
                    help='Zarr out path')
@@ -50,6 +116,10 @@ def parse_args():
                    help='Size of chunks in time')
     p.add_argument('--channel_chunk_size', dest='channel_chunk_size', type=int, default=1, 
                    help='Size of chunks in channels')        
+    p.add_argument('--space_chunk_size', dest='space_chunk_size', type=int, default=None,
+                   help='Size of chunks in the spatial dimensions, whole images by default')
+    p.add_argument('--pyramid_levels', dest='pyramid_levels', type=int, nargs='*', default=[],
+                   help='Downsampling factors of block-averaged copies of the stacks, e.g. 2 4 8')
     p.add_argument('--aia_preprocessing', dest='aia_preprocessing', action='store_true', 
                    help='Whether to pre-process AIA or simply load the image')
     p.add_argument('--aia_calibration', dest='aia_calibration', type=str,
@@ -66,6 +136,23 @@ def parse_args():
                    help='change nans and inf for zero')
     p.add_argument('--percentile_clip', dest='percentile_clip', type=float, default=0.25, 
                    help='clipping of the hottest pixels to the 100-percentile_clip percentile')
+    p.add_argument('--encoding', dest='encoding', type=str, default='float32', choices=list(STORAGE_ENCODINGS),
+                   help='Storage of the stacks: lossless float32, float16, or int16 with a scale and offset per channel')
+    p.add_argument('--encoding_samples', dest='encoding_samples', type=int, default=8,
+                   help='Number of frames loaded to set the scale and offset of the int16 encoding')
+    p.add_argument('--cname', dest='cname', type=str, default='zstd',
+                   help='Blosc compressor of the stacks, see codec_autotune')
+    p.add_argument('--clevel', dest='clevel', type=int, default=5,
+                   help='Blosc compression level')
+    p.add_argument('--shuffle', dest='shuffle', type=str, default='bitshuffle', choices=list(SHUFFLES),
+                   help='Blosc shuffle filter')
+    p.add_argument('--write_buffer_mb', dest='write_buffer_mb', type=float, default=2048,
+                   help='Memory in MB each process may use to gather complete chunks before writing them')
+    p.add_argument('--max_workers', dest='max_workers', type=int, default=None,
+                   help='Number of processes loading and writing stacks, all cores by default')
+    p.add_argument('--append', action='store_true',
+                   help='Add dates after the last stored one to an existing store and resume unfinished frames instead '
+                        'of overwriting it.  Dates before the first stored one are an error')
     p.add_argument('--debug', action='store_true',
                    help='Only process a few files (10)')
     args = p.parse_args()
@@ -90,42 +177,21 @@ if __name__ == "__main__":
     percentile_clip = args.percentile_clip
     debug = args.debug
     
-    # Prepare dictionary for storing header information
-    for key in META_PROPERTIES_TO_KEEP:
-        vars()[key] = []
-
     # Load indices
-    matches = pd.read_csv(matches)
+    matches = read_match_index(matches)
     if debug:
-        matches = matches.loc[0:10, :]
+        matches = matches.iloc[0:11]
 
     # Extract filenames for stacks
-    aia_columns = []
-    for col in matches.columns:
-        if 'aia' in col:
-            aia_columns.append(col)
-
+    aia_columns = [col for col in matches.columns if col.startswith('files_aia')]
     aia_files = None
     if len(aia_columns) > 0:
-        aia_files = []
-        for index, row in tqdm(matches.iterrows(), total=matches.shape[0], desc='Turning aia dataframe columns into stacks'):
-            aia_files.append(row[aia_columns].tolist())  # (channel, files)    
-
-    hmi_columns = []
-    for col in matches.columns:
-        if 'hmi' in col:
-            hmi_columns.append(col)            
+        aia_files = matches[aia_columns].astype(str).to_numpy().tolist()  # (time, channel files)
 
+    hmi_columns = [col for col in matches.columns if col.startswith('files_hmi')]
     hmi_files = None
     if len(hmi_columns) > 0:
-        hmi_files = []
-        for index, row in tqdm(matches.iterrows(), total=matches.shape[0], desc='Turning hmi dataframe columns into stacks'):
-            hmi_files.append(row[hmi_columns].tolist())
-
-    # Initialize zarr
-    store = zarr.DirectoryStore(zarr_outpath)
-    compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
-    root = zarr.group(store=store, overwrite=True)
+        hmi_files = matches[hmi_columns].astype(str).to_numpy().tolist()
 
     if len(aia_columns) > 0:
         dataset_name = 'aia'
@@ -134,94 +200,65 @@ if __name__ == "__main__":
     elif len(hmi_columns) > 0:
         dataset_name = 'hmi'
 
-    n_channels = len(aia_columns) + len(hmi_columns)
-    sdo_stacks = root.create_dataset(dataset_name, 
-                            shape=(matches.shape[0], n_channels, resolution, resolution), 
-                            chunks=(time_chunk_size, channel_chunk_size, None, None), 
-                            dtype='f4',
-                            compressor=compressor)
-
-    # Processing AIA stacks
-    if len(aia_columns) > 0:
-        partial_load_map_stack = partial(loadMapStack,
-                                aia_preprocessing=aia_preprocessing,
-                                calibration=aia_calibration,
-                                normalization=aia_normalization,
-                                fix_radius_padding=fix_radius_padding,
-                                resolution=resolution,
-                                remove_nans=remove_nans,
-                                percentile_clip=percentile_clip,
-                                return_meta=True)
-
-        for i, file_stack in tqdm(enumerate(aia_files), total=len(aia_files), desc='Processing AIA stacks'):
-            try:
-                # open file
-                aia_stack, aia_meta = partial_load_map_stack(file_stack)
-
-                # Store meta parameters
-                for key in META_PROPERTIES_TO_KEEP:
-                    vars()[key].append(aia_meta[key])
-
-                sdo_stacks[i, 0:len(aia_columns), :, :] = aia_stack
-
-            except Exception as e:
-                print(e)
-
-    if len(hmi_columns) > 0:
-        for i, file_stack in tqdm(enumerate(hmi_files), total=len(hmi_files), desc='Processing HMI stacks'):
-            try:
-                # open file
-                hmi_map = loadMap(file_stack[0], resolution=resolution, fix_radius_padding=fix_radius_padding, zero_outside_disk=True)
-
-                if remove_nans:
-                    hmi_map.data[np.isnan(hmi_map.data)] = 1e-10
-                    hmi_map.data[np.isinf(hmi_map.data)] = 1e-10               
-
-
-                
-                # Store meta parameters
-                if len(aia_columns) == 0:
-                    for key in META_PROPERTIES_TO_KEEP:
-                        if key in hmi_map.meta.keys():
-                            vars()[key].append(hmi_map.meta[key])
-
-                sdo_stacks[i, len(aia_columns), :, :] = hmi_map.data
-
-            except Exception as e:
-                print(e)
-
-    # Store header parameters
-    for key in META_PROPERTIES_TO_KEEP:
-        if len(vars()[key])>0:
-            sdo_stacks.attrs[key.lower()]=vars()[key]                      
-
-    # Set attribute that specifies the dimensions so that xarray can open the zarr
-    sdo_stacks.attrs['_ARRAY_DIMENSIONS'] = ['t_obs', 'channel', 'x', 'y']
-
-    # Create group for t_obs
-    sdo_t_obs = root.create_dataset('t_obs', 
-                            shape=(matches.shape[0]), 
-                            chunks=(None), 
-                            dtype='M8[ns]',
-                            compressor=None) 
-
-    # Convert t_obs to datetime and save it
-
-    sdo_t_obs[:] = np.array([datetime.strptime(t.replace('_TAI','').replace('-','.').replace('T','_'), '%Y.%m.%d_%H:%M:%S.%f') for t in t_obs])
-    sdo_t_obs.attrs['_ARRAY_DIMENSIONS'] = ['t_obs']
-
     # Add channels all channels need to have the same number of characters
     channels = ['aia'+column.split('files_aia')[1].zfill(3) for column in aia_columns]
-    channels.append('hmilos')
-
-    sdo_channels = root.create_dataset('channel', 
-                            shape=(len(aia_columns) + len(hmi_columns)), 
-                            chunks=(None), 
-                            dtype=str,
-                            compressor=None)
-    sdo_channels[:] = np.array(channels)
-    sdo_channels.attrs['_ARRAY_DIMENSIONS'] = ['channel']
-    
-
-    zarr.consolidate_metadata(store)           
-    
\ No newline at end of file
+    if len(hmi_columns) > 0:
+        channels.append('hmilos')
+
+    n_times = matches.shape[0]
+    # AIA and HMI files of every time index
+    frames = list(zip(aia_files or [[]] * n_times, hmi_files or [[]] * n_times))
+    partial_load_frame = partial(load_frame,
+                                 aia_preprocessing=aia_preprocessing,
+                                 aia_calibration=aia_calibration,
+                                 aia_normalization=aia_normalization,
+                                 fix_radius_padding=fix_radius_padding,
+                                 resolution=resolution,
+                                 remove_nans=remove_nans,
+                                 percentile_clip=percentile_clip)
+
+    # Initialize zarr, or grow an existing store with the new dates.  An existing store keeps
+    # its encoding, compressor and scale and offset of the channels.
+    if args.append and os.path.exists(os.path.join(zarr_outpath, '.zgroup')):
+        root = zarr.open_group(zarr_outpath, mode='r+')
+        if dataset_name not in root or list(root['channel'][:]) != channels:
+            raise ValueError(f'{zarr_outpath} does not hold a {dataset_name} array with channels {channels}')
+        indices = append_dates(root, dataset_name, matches.index)
+    else:
+        channel_scale, channel_offset = None, None
+        if args.encoding == 'int16':
+            samples = sample_stacks(frames, partial_load_frame, args.encoding_samples)
+            channel_scale, channel_offset = channel_scale_offset(samples)
+            LOG.info(f'int16 scale {channel_scale} and offset {channel_offset} of the channels')
+        root = create_sdo_store(zarr_outpath, dataset_name, matches.index, channels, resolution,
+                                time_chunk_size=time_chunk_size,
+                                channel_chunk_size=channel_chunk_size,
+                                space_chunk_size=args.space_chunk_size,
+                                pyramid_levels=args.pyramid_levels,
+                                encoding=args.encoding,
+                                channel_scale=channel_scale,
+                                channel_offset=channel_offset,
+                                compressor=make_compressor(args.cname, args.clevel, args.shuffle))
+        indices = np.arange(n_times)
+
+    # Only load the frames that are not in the store yet
+    completed = root['completed'][:]
+    todo = [i for i in range(n_times) if indices[i] >= 0 and not completed[indices[i]]]
+    LOG.info(f'{len(todo)} of {n_times} frames to write, {root["completed"].shape[0]} time indices in the store')
+
+    # Load and write the stacks in parallel, AIA and HMI of a time index together.  Each task
+    # owns one time chunk of the array, so writers never touch the same chunk.  Header values
+    # and the completion bitmap are checkpointed as chunks finish, so a stopped run can be
+    # resumed with --append.
+    metas, write_stats = ingest_frames(zarr_outpath, dataset_name, [frames[i] for i in todo], partial_load_frame,
+                                       indices=[indices[i] for i in todo],
+                                       max_workers=args.max_workers,
+                                       buffer_bytes=int(args.write_buffer_mb * 1024 ** 2),
+                                       checkpoint=partial(write_checkpoint, root, dataset_name),
+                                       return_stats=True)
+    LOG.info(f'Write statistics: {write_stats}')
+    n_failed = sum(meta is None for meta in metas)
+    if n_failed > 0:
+        LOG.warning(f'{n_failed} frames failed and are left incomplete, rerun with --append to retry them')
+
+    zarr.consolidate_metadata(root.store)
@@ -0,0 +1,211 @@
+"""
+Benchmarks of the concurrent_file_indexer steps on synthetic AIA/HMI file lists, comparing the
+vectorized implementations against the per-file ones and checking that they agree.
+
+Example:
+python -m search_download.indexer_benchmark --n_files 1000000
+
+"""
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from search_download.concurrent_file_indexer import match_file_times
+from search_download.file_index import FileIndex
+from search_download.utils.file_scan import _filename_to_date, filenames_to_dates
+
+
+def synthetic_filenames(n_files: int = 100000, wavelength: int = 171, cadence: int = 12):
+    """
+    Compact AIA filenames (or HMI ones if wavelength is None) of n_files consecutive records
+
+    Parameters:
+        n_files: (int)
+            Number of files
+        wavelength: (int)
+            AIA wavelength, or None for HMI
+        cadence: (int)
+            Seconds between files
+
+    Returns:
+        filenames: (list)
+    """
+    start = datetime.datetime(2010, 12, 21)
+    instrument = "hmi" if wavelength is None else "aia"
+    folder = "hmi" if wavelength is None else str(wavelength)
+    return [
+        f"/data/sdo/{folder}/"
+        f"{(start + datetime.timedelta(seconds=n * cadence)).strftime('%Y%m%d_%H%M%S')}"
+        f"_{instrument}_{wavelength or 1}_4k.fits"
+        for n in range(n_files)
+    ]
+
+
+def benchmark_filenames_to_dates(n_files: int = 100000):
+    """
+    Time the per-file and vectorized filename to date conversions of one channel
+
+    Parameters:
+        n_files: (int)
+            Number of filenames
+
+    Returns:
+        result: (dict)
+            Seconds taken by each implementation and the speedup
+    """
+    filenames = synthetic_filenames(n_files)
+
+    start = time.perf_counter()
+    scalar_dates = [_filename_to_date(f) for f in filenames]
+    scalar_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vector_dates = filenames_to_dates([filenames])[0]
+    vector_seconds = time.perf_counter() - start
+
+    if not (pd.DatetimeIndex(scalar_dates) == vector_dates).all():
+        raise AssertionError("Vectorized dates differ from the per-file dates")
+
+    return {
+        "step": "filenames_to_dates",
+        "n_files": n_files,
+        "scalar_seconds": scalar_seconds,
+        "vectorized_seconds": vector_seconds,
+        "speedup": scalar_seconds / vector_seconds,
+    }
+
+
+def benchmark_match_file_times(n_files: int = 100000, n_channels: int = 2):
+    """
+    Time the nearest-time matching of n_channels AIA channels, followed by HMI, against
+    the former round and inner join matching
+
+    Parameters:
+        n_files: (int)
+            Number of files per AIA channel
+        n_channels: (int)
+            Number of AIA channels
+
+    Returns:
+        result: (dict)
+            Seconds taken by each implementation and the number of matched slots
+    """
+    wavelengths = [171, 193, 211, 304, 335, 94, 131][0:n_channels]
+    filenames = [synthetic_filenames(n_files, wl) for wl in wavelengths]
+    dates = filenames_to_dates(filenames)
+    sufixes = [f"aia{wl}" for wl in wavelengths]
+    hmi_filenames = [synthetic_filenames(n_files * 12 // 720, None, 720)]
+    hmi_dates = filenames_to_dates(hmi_filenames)
+
+    start = time.perf_counter()
+    joint_df = None
+    for channel_dates, channel_files, sufix in zip(dates + hmi_dates, filenames + hmi_filenames, sufixes + ["hmi"]):
+        df = pd.DataFrame({"dates": channel_dates, f"files_{sufix}": channel_files})
+        df["dates"] = df["dates"].dt.round("3min")
+        df = df.drop_duplicates(subset="dates", keep="first").set_index("dates")
+        joint_df = df if joint_df is None else joint_df.join(df, how="inner")
+    rounded_seconds = time.perf_counter() - start
+    rounded_slots = len(joint_df)
+
+    start = time.perf_counter()
+    matches = match_file_times(dates, filenames, sufixes, cadence="3min")
+    matches = match_file_times(hmi_dates, hmi_filenames, ["hmi"], joint_df=matches, cadence="3min")
+    nearest_seconds = time.perf_counter() - start
+
+    return {
+        "step": "match_file_times",
+        "n_files": n_files,
+        "rounded_seconds": rounded_seconds,
+        "rounded_slots": rounded_slots,
+        "nearest_seconds": nearest_seconds,
+        "nearest_slots": len(matches),
+    }
+
+
+def benchmark_file_index(n_files: int = 100000, n_new: int = 3600):
+    """
+    Time a full index of n_files empty files of one channel, an update with no change and an
+    update after n_new files were added, as after a daily download
+
+    Parameters:
+        n_files: (int)
+            Number of files already in the archive
+        n_new: (int)
+            Number of files added before the last update
+
+    Returns:
+        result: (dict)
+            Seconds taken by each update
+    """
+    root = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(root, "171")
+        os.mkdir(directory)
+        filenames = synthetic_filenames(n_files + n_new)
+        for filename in filenames[0:n_files]:
+            open(os.path.join(directory, os.path.basename(filename)), "w").close()
+        channels = {"aia171": (directory, "*aia*171_*.fits")}
+
+        with FileIndex(os.path.join(root, "file_index.sqlite")) as index:
+            start = time.perf_counter()
+            index.update(channels)
+            full_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            index.update(channels)
+            unchanged_seconds = time.perf_counter() - start
+
+            for filename in filenames[n_files:]:
+                open(os.path.join(directory, os.path.basename(filename)), "w").close()
+            start = time.perf_counter()
+            stats = index.update(channels)
+            incremental_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        "step": "file_index",
+        "n_files": n_files,
+        "full_seconds": full_seconds,
+        "unchanged_seconds": unchanged_seconds,
+        "n_new": int(stats.added.sum()),
+        "incremental_seconds": incremental_seconds,
+    }
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments to script.
+
+    Parameters:
+        args (list):    defaults to parsing any command line arguments
+
+    Returns:
+        parser args:    Namespace from argparse
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--n_files", type=int, nargs="+", default=[10000, 100000], help="Numbers of files per channel"
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parser_output = parse_args()
+    results = pd.DataFrame(
+        [benchmark_filenames_to_dates(n_files) for n_files in parser_output.n_files]
+    )
+    print(results.to_string(index=False))
+    results = pd.DataFrame(
+        [benchmark_match_file_times(n_files) for n_files in parser_output.n_files]
+    )
+    print(results.to_string(index=False))
+    results = pd.DataFrame(
+        [benchmark_file_index(n_files) for n_files in parser_output.n_files]
+    )
+    print(results.to_string(index=False))
@@ -0,0 +1,135 @@
+"""
+File that contains the QueryCache class, a persistent SQLite cache of JSOC query results
+so that repeated planning runs and UI sessions do not hit the network.
+
+"""
+import datetime
+import io
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+
+import pandas as pd
+
+
+class QueryCache:
+    """
+    Cache of drms query results keyed by the full JSOC record-set string and key list.
+    Results are stored as compressed JSON in a single SQLite file.  Entries expire after
+    ttl seconds, except for ranges that ended more than settle_days ago, which never
+    change and are kept forever.
+
+    Parameters:
+        path: (str)
+            Path of the SQLite file
+        ttl: (float)
+            Seconds an entry for a range that may still change stays valid
+        settle_days: (float)
+            Age in days after which the data of a range is considered final
+    """
+
+    def __init__(self, path: str = None, ttl: float = 3600, settle_days: float = 30):
+        self.path = path
+        self.ttl = ttl
+        self.settle_days = settle_days
+        self._lock = threading.Lock()
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "key TEXT PRIMARY KEY, created REAL, permanent INTEGER, payload BLOB)"
+            )
+
+    def _connect(self):
+        """
+        New connection to the cache file.  Used as closing(connection), connection: the
+        connection context manager only commits, it does not close the connection.
+        """
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def cache_key(jsoc_string: str = None, key=None):
+        """
+        Key of a query in the cache
+
+        Parameters:
+            jsoc_string: str
+                JSOC record-set string
+            key: (str or list)
+                Keywords requested from the query
+
+        Returns:
+            cache_key: str
+        """
+        if isinstance(key, str):
+            key = key.split(",")
+        return jsoc_string + "|" + ",".join(k.strip().lower() for k in key or [])
+
+    def get(self, jsoc_string: str = None, key=None):
+        """
+        Cached result of a query
+
+        Returns:
+            query: (panda.df)
+                Query result, or None if it is missing or expired
+        """
+        with self._lock, closing(self._connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT created, permanent, payload FROM queries WHERE key = ?",
+                (self.cache_key(jsoc_string, key),),
+            ).fetchone()
+        if row is None:
+            return None
+        created, permanent, payload = row
+        if not permanent and time.time() - created > self.ttl:
+            return None
+        return pd.read_json(
+            io.StringIO(zlib.decompress(payload).decode()),
+            orient="split",
+            dtype=False,
+            convert_dates=False,
+        )
+
+    def put(self, jsoc_string: str = None, key=None, query=None, permanent: bool = False):
+        """
+        Store the result of a query
+        """
+        payload = zlib.compress(query.to_json(orient="split", index=False).encode())
+        with self._lock, closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                (self.cache_key(jsoc_string, key), time.time(), int(permanent), payload),
+            )
+
+    def is_settled(self, end: datetime.datetime = None):
+        """
+        Whether a range ending at end is old enough to never change again
+        """
+        if end is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return now - end > datetime.timedelta(days=self.settle_days)
+
+    def query(self, client=None, jsoc_string: str = None, key=None, end: datetime.datetime = None):
+        """
+        Answer a query from the cache, or run it with the drms client and store the result
+
+        Parameters:
+            client: (drms.Client)
+                Client used on a cache miss
+            jsoc_string: str
+                JSOC record-set string
+            key: (str or list)
+                Keywords requested from the query
+            end: (datetime.datetime)
+                End of the queried range, used to cache settled ranges forever
+
+        Returns:
+            query: (panda.df)
+        """
+        query = self.get(jsoc_string, key)
+        if query is None:
+            query = client.query(jsoc_string, key=key)
+            self.put(jsoc_string, key, query, permanent=self.is_settled(end))
+        return query
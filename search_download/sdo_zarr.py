@@ -0,0 +1,853 @@
+"""
+Parallel ingestion of SDO stacks into a zarr array.  Frames are grouped by the time chunk of
+the array they fall in and every time chunk is handled by a single task of a process pool:
+the task loads and preprocesses the stacks of its frames and writes them to the chunk it owns.
+As no two tasks write to the same chunk, the writers need no locking and the conversion scales
+with the number of cores.  Writers gather the frames of a chunk in a ChunkWriteBuffer so that
+every chunk is compressed and written once instead of once per frame.
+
+Stores may hold block-averaged copies of the stacks at 1/2, 1/4, ... of the resolution, written
+by the same tasks next to the full resolution stacks, so that thumbnails and previews only read
+a fraction of the data, see select_level.
+
+The stacks are stored as float32, float16 or int16 with a scale and offset per channel, see
+STORAGE_ENCODINGS.  Open stores with open_sdo_store to read int16 stacks back as float32.
+
+"""
+import logging
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Memory a writer may use to gather chunks before it has to write incomplete ones
+DEFAULT_BUFFER_BYTES = 2 * 1024 ** 3
+
+# Chunk size of the one dimensional arrays along t_obs
+COORD_CHUNK_SIZE = 2 ** 16
+
+# Arrays along t_obs that xarray exposes as coordinates of the stacks, next to the header columns
+STORE_COORDINATES = ["dates", "completed", "valid"]
+
+# Storage type of the stacks for each encoding: lossless float32, float16 (about 3 significant
+# digits) and int16 with a scale and offset per channel (65535 levels over the range of a channel)
+STORAGE_ENCODINGS = {"float32": "f4", "float16": "f2", "int16": "i2"}
+
+# Value of the int16 stacks for missing pixels, read back as NaN
+INT16_FILL_VALUE = np.iinfo("i2").min
+
+# Blosc shuffle filters by name
+SHUFFLES = {"noshuffle": Blosc.NOSHUFFLE, "shuffle": Blosc.SHUFFLE, "bitshuffle": Blosc.BITSHUFFLE}
+
+# Value of the header columns for frames without a value, by kind of type
+HEADER_FILL_VALUES = {"i": np.iinfo("i8").min, "f": np.nan, "U": ""}
+
+
+class ChunkWriteBuffer:
+    """Buffer of whole time indices written to a zarr array.  Writing a single time index of
+    an array whose time chunks are larger than one decompresses, updates and recompresses
+    every chunk it touches, so a chunk ends up rewritten once per time index.  The buffer
+    instead gathers the time indices of each time chunk in memory and writes the chunk once
+    when it is complete.  If the buffered data exceeds max_bytes, the most complete time chunk
+    is written as it is, and the rest of it will be read back and rewritten later.
+
+    Parameters
+    ----------
+    array : zarr.Array
+        Array to write to, with time as first dimension
+    max_bytes : int, optional
+        Memory budget of the buffered time chunks, by default DEFAULT_BUFFER_BYTES
+    """
+
+    def __init__(self, array, max_bytes=DEFAULT_BUFFER_BYTES):
+        self.array = array
+        self.max_bytes = max_bytes
+        self.time_chunk_size = array.chunks[0]
+        self.chunks_per_time_chunk = math.prod(math.ceil(s / c) for s, c in zip(array.shape[1:], array.chunks[1:]))
+        self.chunk_bytes = math.prod(array.chunks) * array.dtype.itemsize
+        self.fill_value = 0 if array.fill_value is None else array.fill_value
+        self.slabs = {}
+        self.flushed_time_chunks = set()
+        self.stats = {"frames": 0, "flushes": 0, "partial_flushes": 0, "chunk_writes": 0, "bytes_written": 0}
+
+    @property
+    def nbytes(self):
+        return sum(data.nbytes for data, _ in self.slabs.values())
+
+    def write(self, index, value):
+        """Write value to array[index], flushing the time chunk of index once it is complete
+
+        Parameters
+        ----------
+        index : int
+            Time index
+        value : numpy.ndarray
+            Data of the time index, with the shape of array[index]
+        """
+        time_chunk = index // self.time_chunk_size
+        if time_chunk not in self.slabs:
+            start = time_chunk * self.time_chunk_size
+            length = min(self.time_chunk_size, self.array.shape[0] - start)
+            self.slabs[time_chunk] = (np.full((length,) + self.array.shape[1:], self.fill_value, dtype=self.array.dtype),
+                                      np.zeros(length, dtype=bool))
+        data, written = self.slabs[time_chunk]
+        data[index % self.time_chunk_size] = value
+        written[index % self.time_chunk_size] = True
+        self.stats["frames"] += 1
+
+        if written.all():
+            self.flush_time_chunk(time_chunk)
+        elif self.nbytes > self.max_bytes:
+            self.flush_time_chunk(max(self.slabs, key=lambda n: self.slabs[n][1].sum()))
+
+    def flush_time_chunk(self, time_chunk):
+        """Write the buffered time indices of one time chunk, in one write if all of them are
+        there and in one write per contiguous run of time indices otherwise
+        """
+        data, written = self.slabs.pop(time_chunk)
+        start = time_chunk * self.time_chunk_size
+        if written.all():
+            runs = [(0, len(written))]
+        else:
+            edges = np.flatnonzero(np.diff(np.concatenate([[False], written, [False]]).astype(int)))
+            runs = list(zip(edges[0::2], edges[1::2]))
+            self.stats["partial_flushes"] += 1
+        for run_start, run_stop in runs:
+            self.array[start + run_start:start + run_stop] = data[run_start:run_stop]
+        self.stats["flushes"] += 1
+        self.stats["chunk_writes"] += len(runs) * self.chunks_per_time_chunk
+        self.stats["bytes_written"] += len(runs) * self.chunks_per_time_chunk * self.chunk_bytes
+        self.flushed_time_chunks.add(time_chunk)
+
+    def flush(self):
+        """Write all buffered time indices"""
+        for time_chunk in list(self.slabs):
+            self.flush_time_chunk(time_chunk)
+
+    def summary(self):
+        """Write statistics
+
+        Returns
+        -------
+        dict
+            Counts of frames, flushes and chunk writes, the uncompressed bytes of the chunks
+            written and the write amplification: chunk writes per chunk written, 1 when every
+            chunk was written exactly once
+        """
+        stats = dict(self.stats)
+        stats["chunks"] = len(self.flushed_time_chunks) * self.chunks_per_time_chunk
+        stats["write_amplification"] = stats["chunk_writes"] / max(1, stats["chunks"])
+        return stats
+
+
+def merge_write_stats(stats):
+    """Add up the ChunkWriteBuffer.summary of several writers
+
+    Parameters
+    ----------
+    stats : list
+        Summaries of the writers
+
+    Returns
+    -------
+    dict
+        Totals, with the write amplification of all writers together
+    """
+    keys = ["frames", "flushes", "partial_flushes", "chunk_writes", "bytes_written", "chunks"]
+    total = {key: sum(s[key] for s in stats) for key in keys}
+    total["write_amplification"] = total["chunk_writes"] / max(1, total["chunks"])
+    return total
+
+
+def create_sdo_store(store_path, dataset_name, dates, channels, resolution, time_chunk_size=1,
+                     channel_chunk_size=1, space_chunk_size=None, pyramid_levels=(), encoding="float32",
+                     channel_scale=None, channel_offset=None, compressor=None):
+    """Create an empty store for the stacks of the given dates.  Next to the (t_obs, channel,
+    x, y) array, the group holds one dimensional arrays along t_obs with the time of the
+    frames (t_obs, the slot time until the frame is written), the slot time of the match
+    table (dates) and a completion bitmap (completed) used to resume and append, and a
+    (t_obs, channel) array that is True for the channels loaded successfully (valid).
+    Header values are added as they are written, one array along t_obs per keyword, see
+    write_checkpoint.  Each pyramid level is a sibling array, e.g. aia_hmi_4x, with the
+    stacks block-averaged by its factor, see level_name.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the zarr DirectoryStore, overwritten if it exists
+    dataset_name : str
+        Name of the stacks array
+    dates : pandas.DatetimeIndex
+        Slot time of every frame, sorted
+    channels : list
+        Names of the channels
+    resolution : int
+        Pixels on a side
+    time_chunk_size : int, optional
+        Size of the chunks in time
+    channel_chunk_size : int, optional
+        Size of the chunks in channels
+    space_chunk_size : int, optional
+        Size of the chunks in x and y, by default whole images
+    pyramid_levels : list, optional
+        Downsampling factors of the pyramid levels, e.g. [2, 4, 8], by default none
+    encoding : str, optional
+        Storage encoding of the stacks, one of STORAGE_ENCODINGS, by default float32
+    channel_scale : list, optional
+        Scale of every channel, required by the int16 encoding, see channel_scale_offset
+    channel_offset : list, optional
+        Offset of every channel, required by the int16 encoding
+    compressor : numcodecs codec, optional
+        Compressor of the stacks
+
+    Returns
+    -------
+    zarr.Group
+    """
+    factors = [1] + sorted(pyramid_levels)
+    if any(factor % previous != 0 for previous, factor in zip(factors[:-1], factors[1:])):
+        raise ValueError(f"Every pyramid level has to be a multiple of the previous one: {pyramid_levels}")
+    if encoding not in STORAGE_ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {list(STORAGE_ENCODINGS)}")
+    encoding_attrs = {"encoding": encoding}
+    if encoding == "int16":
+        if channel_scale is None or channel_offset is None:
+            raise ValueError("The int16 encoding needs the scale and offset of every channel")
+        encoding_attrs.update({"channel_scale": [float(scale) for scale in channel_scale],
+                               "channel_offset": [float(offset) for offset in channel_offset]})
+    dtype = STORAGE_ENCODINGS[encoding]
+    fill_value = INT16_FILL_VALUE if encoding == "int16" else 0
+
+    store = zarr.DirectoryStore(store_path)
+    root = zarr.group(store=store, overwrite=True)
+    dates = pd.DatetimeIndex(dates).as_unit("ns")
+
+    sdo_stacks = root.create_dataset(dataset_name,
+                                     shape=(len(dates), len(channels), resolution, resolution),
+                                     chunks=(time_chunk_size, channel_chunk_size, space_chunk_size, space_chunk_size),
+                                     dtype=dtype,
+                                     fill_value=fill_value,
+                                     compressor=compressor)
+    # Set attribute that specifies the dimensions so that xarray can open the zarr
+    sdo_stacks.attrs["_ARRAY_DIMENSIONS"] = ["t_obs", "channel", "x", "y"]
+    sdo_stacks.attrs["coordinates"] = " ".join(STORE_COORDINATES)
+    sdo_stacks.attrs["pyramid_levels"] = factors[1:]
+    sdo_stacks.attrs.update(encoding_attrs)
+
+    # The time chunks of the levels match the stacks, so the writer of a time chunk owns them too
+    for factor in factors[1:]:
+        size = resolution // factor
+        level = root.create_dataset(level_name(dataset_name, factor),
+                                    shape=(len(dates), len(channels), size, size),
+                                    chunks=(time_chunk_size, channel_chunk_size,
+                                            None if space_chunk_size is None else min(space_chunk_size, size),
+                                            None if space_chunk_size is None else min(space_chunk_size, size)),
+                                    dtype=dtype,
+                                    fill_value=fill_value,
+                                    compressor=compressor)
+        level.attrs["_ARRAY_DIMENSIONS"] = ["t_obs", "channel", f"x_{factor}x", f"y_{factor}x"]
+        level.attrs["pyramid_factor"] = factor
+        level.attrs.update(encoding_attrs)
+
+    # No fill value, so that xarray does not mask False or the epoch, all values are written
+    for name, dtype in [("t_obs", "M8[ns]"), ("dates", "M8[ns]"), ("completed", bool)]:
+        array = root.create_dataset(name, shape=(len(dates),), chunks=(COORD_CHUNK_SIZE,), dtype=dtype,
+                                    fill_value=None, compressor=None)
+        array.attrs["_ARRAY_DIMENSIONS"] = ["t_obs"]
+    root["t_obs"][:] = dates.to_numpy()
+    root["dates"][:] = dates.to_numpy()
+    root["completed"][:] = False
+
+    valid = root.create_dataset("valid", shape=(len(dates), len(channels)), chunks=(COORD_CHUNK_SIZE, None),
+                                dtype=bool, fill_value=None)
+    valid.attrs["_ARRAY_DIMENSIONS"] = ["t_obs", "channel"]
+    valid[:] = False
+
+    # All channels need to have the same number of characters
+    sdo_channels = root.create_dataset("channel", shape=(len(channels),), chunks=(None,), dtype=str, compressor=None)
+    sdo_channels[:] = np.array(channels)
+    sdo_channels.attrs["_ARRAY_DIMENSIONS"] = ["channel"]
+
+    zarr.consolidate_metadata(store)
+    return root
+
+
+def level_name(dataset_name, factor):
+    """Name of the array of the pyramid level of a stacks array downsampled by factor"""
+    return f"{dataset_name}_{factor}x"
+
+
+def block_average(stack, factor):
+    """Average the (channel, y, x) stack over factor x factor blocks, dropping the last rows
+    and columns if the size is not a multiple of factor
+    """
+    n_channels, height, width = stack.shape
+    height, width = height // factor, width // factor
+    blocks = stack[:, :height * factor, :width * factor].reshape(n_channels, height, factor, width, factor)
+    return blocks.mean(axis=(2, 4), dtype=np.float64).astype(stack.dtype)
+
+
+def make_compressor(cname="zstd", clevel=5, shuffle="bitshuffle"):
+    """Blosc compressor from the names used on the command line and by codec_autotune"""
+    return Blosc(cname=cname, clevel=clevel, shuffle=SHUFFLES[shuffle])
+
+
+def channel_scale_offset(samples, margin=0.1):
+    """Scale and offset of every channel mapping the range of sample stacks, widened by margin
+    on both sides, to the int16 range.  Values outside of it are clipped when encoded.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray
+        (frame, channel, y, x) sample stacks
+    margin : float, optional
+        Fraction of the range added on both sides, by default 0.1
+
+    Returns
+    -------
+    tuple
+        Scale and offset of every channel
+    """
+    low = np.nanmin(samples, axis=(0, 2, 3)).astype(np.float64)
+    high = np.nanmax(samples, axis=(0, 2, 3)).astype(np.float64)
+    low, high = low - margin * (high - low), high + margin * (high - low)
+    scale = (high - low) / (2 * np.iinfo("i2").max)
+    scale[scale == 0] = 1
+    return scale, (high + low) / 2
+
+
+def sample_stacks(frames, load_frame, n_samples=8):
+    """Load up to n_samples frames evenly spaced in frames, skipping the ones that fail, e.g.
+    to get the range of the channels before creating an int16 store
+
+    Parameters
+    ----------
+    frames : list
+        Arguments of load_frame for each frame
+    load_frame : callable
+        Function taking a frame and returning its (channel, y, x) stack first
+    n_samples : int, optional
+        Number of frames to load
+
+    Returns
+    -------
+    numpy.ndarray
+        (frame, channel, y, x) stacks
+    """
+    stacks = []
+    for position in np.unique(np.linspace(0, len(frames) - 1, n_samples).round().astype(int)):
+        try:
+            stacks.append(load_frame(frames[position])[0])
+        except Exception as e:
+            logger.warning(f"Sample frame {position} failed: {e}")
+    if not stacks:
+        raise ValueError("None of the sample frames could be loaded")
+    return np.stack(stacks)
+
+
+def encode_stack(stack, channel_scale, channel_offset):
+    """Encode a (channel, y, x) stack as int16, non-finite pixels as INT16_FILL_VALUE"""
+    shape = (-1,) + (1,) * (stack.ndim - 1)
+    encoded = np.rint((stack - np.reshape(channel_offset, shape)) / np.reshape(channel_scale, shape))
+    encoded = np.clip(encoded, -np.iinfo("i2").max, np.iinfo("i2").max)
+    encoded[~np.isfinite(stack)] = INT16_FILL_VALUE
+    return encoded.astype("i2")
+
+
+def stack_encoder(array):
+    """Function encoding (channel, y, x) stacks for an array created by create_sdo_store"""
+    if array.attrs.get("encoding") == "float16":
+        # Clip instead of overflowing to infinity
+        limit = np.finfo("f2").max
+        return lambda stack: np.clip(stack, -limit, limit)
+    if array.attrs.get("encoding") != "int16":
+        return lambda stack: stack
+    channel_scale = np.array(array.attrs["channel_scale"])
+    channel_offset = np.array(array.attrs["channel_offset"])
+    return lambda stack: encode_stack(stack, channel_scale, channel_offset)
+
+
+def decode_stacks(data):
+    """Lazily decode the int16 arrays of a store opened with xarray to float32, NaN where
+    the pixels are missing.  Other arrays are returned as they are.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Store opened with xarray.open_zarr
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    data = data.copy()
+    for name, array in data.data_vars.items():
+        if array.attrs.get("encoding") != "int16":
+            continue
+        channel_scale = xr.DataArray(np.array(array.attrs["channel_scale"], dtype=np.float32), dims="channel")
+        channel_offset = xr.DataArray(np.array(array.attrs["channel_offset"], dtype=np.float32), dims="channel")
+        # xarray already masked the fill value, so the array is float32 with NaN
+        decoded = (array.astype(np.float32) * channel_scale + channel_offset).transpose(*array.dims)
+        attrs = {key: value for key, value in array.attrs.items() if key not in ["channel_scale", "channel_offset"]}
+        data[name] = decoded.assign_attrs(attrs, encoding="float32", stored_encoding="int16")
+    return data
+
+
+def open_sdo_store(store_path, **kwargs):
+    """Open a store with xarray.open_zarr, decoding the int16 stacks to float32
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the zarr store
+    kwargs :
+        Additional xarray.open_zarr arguments
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+    return decode_stacks(xr.open_zarr(store_path, **kwargs))
+
+
+def time_arrays(root):
+    """Arrays of a store whose first dimension is t_obs"""
+    return [array for _, array in root.arrays() if array.attrs.get("_ARRAY_DIMENSIONS", [None])[0] == "t_obs"]
+
+
+def append_dates(root, dataset_name, dates):
+    """Find the time index of every date in a store, growing all the arrays along t_obs,
+    header columns included, for the dates after the last one stored.  Dates that are missing but fall inside the stored
+    range cannot be inserted and are skipped.  Dates before the first stored one cannot be prepended either, so they
+    raise instead of being dropped; such a store has to be rebuilt over the full range.
+
+    Parameters
+    ----------
+    root : zarr.Group
+        Group created by create_sdo_store
+    dataset_name : str
+        Name of the stacks array
+    dates : pandas.DatetimeIndex
+        Slot time of every frame, sorted
+
+    Returns
+    -------
+    numpy.ndarray
+        Time index of every date, -1 for skipped dates
+
+    Raises
+    ------
+    ValueError
+        If some dates are before the first stored date
+    """
+    stored = pd.DatetimeIndex(root["dates"][:])
+    dates = pd.DatetimeIndex(dates).as_unit("ns")
+    indices = stored.get_indexer(dates)
+    missing = indices < 0
+    if len(stored) > 0:
+        earlier = missing & (dates < stored.min())
+        if earlier.any():
+            raise ValueError(f"{earlier.sum()} dates are before the first stored date {stored.min()}, "
+                             f"e.g. {list(dates[earlier][0:5])}.  Dates cannot be prepended to a store, "
+                             f"rebuild it over the full range instead")
+        new = missing & (dates > stored.max())
+    else:
+        new = missing
+    skipped = missing & ~new
+    if skipped.any():
+        logger.warning(f"Skipping {skipped.sum()} dates inside the stored range that are not in the store, "
+                       f"e.g. {list(dates[skipped][0:5])}")
+
+    n_stored, n_new = len(stored), int(new.sum())
+    indices[new] = n_stored + np.arange(n_new)
+    if n_new > 0:
+        for array in time_arrays(root):
+            array.resize((n_stored + n_new,) + array.shape[1:])
+        root["t_obs"][n_stored:] = dates[new].to_numpy()
+        root["dates"][n_stored:] = dates[new].to_numpy()
+        root["completed"][n_stored:] = False
+        root["valid"][n_stored:] = False
+        zarr.consolidate_metadata(root.store)
+        logger.info(f"Appended {n_new} dates to {n_stored} stored ones")
+    return indices
+
+
+def parse_t_obs(values):
+    """Parse T_OBS header values, either ISO (2010-12-21T00:00:08.34Z) or JSOC TAI
+    (2010.12.21_00:00:08_TAI) strings
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        NaT where a value cannot be parsed
+    """
+    values = pd.Series([str(value) for value in values], dtype=object)
+    values = values.str.replace("_TAI", "", regex=False).str.rstrip("Z")
+    values = values.str[0:10].str.replace(".", "-", regex=False) + "T" + values.str[11:]
+    return pd.DatetimeIndex(pd.to_datetime(values, format="ISO8601", errors="coerce")).as_unit("ns")
+
+
+def header_column_name(key):
+    """Name of the array of a header keyword, e.g. date_obs for DATE-OBS"""
+    return key.lower().replace("-", "_")
+
+
+def header_dtype(values):
+    """Type of a header column holding values: int64 for integers and booleans, float64 for
+    other numbers and fixed-width strings, with room to spare, for anything else
+    """
+    if all(isinstance(value, (bool, int, np.bool_, np.integer)) for value in values):
+        return np.dtype("i8")
+    if all(isinstance(value, (bool, int, float, np.bool_, np.number)) for value in values):
+        return np.dtype("f8")
+    width = max(len(str(value)) for value in values)
+    return np.dtype(f"U{max(16, 2 ** math.ceil(math.log2(max(width, 1))))}")
+
+
+def promote_header_dtype(dtype, other):
+    """Type that can hold the values of both header column types"""
+    kinds = "ifU"
+    if dtype.kind == other.kind:
+        return max(dtype, other, key=lambda d: d.itemsize)
+    if "U" in (dtype.kind, other.kind):
+        return np.dtype(f"U{max(32, dtype.itemsize // 4, other.itemsize // 4)}")
+    return max(dtype, other, key=lambda d: kinds.index(d.kind))
+
+
+def header_column(root, dataset_name, key, values):
+    """Array of the header keyword key able to hold values, created, or rewritten with a
+    wider type, as needed.  Header columns have a fill value for the frames without a value,
+    so xarray reads them as NaN (or an empty string).
+
+    Parameters
+    ----------
+    root : zarr.Group
+        Group created by create_sdo_store
+    dataset_name : str
+        Name of the stacks array
+    key : str
+        Header keyword
+    values : list
+        New values of the keyword
+
+    Returns
+    -------
+    zarr.Array
+        None if the name of the keyword is taken by an array that is not a header column,
+        like t_obs
+    """
+    name = header_column_name(key)
+    dtype = header_dtype(values)
+    data = None
+    if name in root:
+        array = root[name]
+        if "header_key" not in array.attrs:
+            return None
+        if promote_header_dtype(array.dtype, dtype) == array.dtype:
+            return array
+        dtype = promote_header_dtype(array.dtype, dtype)
+        data = array[:]
+        missing = data == array.fill_value if array.dtype.kind != "f" else np.isnan(data)
+        data = data.astype(dtype)
+        data[missing] = HEADER_FILL_VALUES[dtype.kind]
+        del root[name]
+        logger.info(f"Converting header column {name} from {array.dtype} to {dtype}")
+
+    array = root.create_dataset(name, shape=(root[dataset_name].shape[0],), chunks=(COORD_CHUNK_SIZE,),
+                                dtype=dtype, fill_value=HEADER_FILL_VALUES[dtype.kind])
+    array.attrs.update({"_ARRAY_DIMENSIONS": ["t_obs"], "header_key": key})
+    if data is not None:
+        array[:] = data
+    return array
+
+
+def header_columns(root):
+    """Names of the header column arrays of a store"""
+    return sorted(name for name, array in root.arrays() if "header_key" in array.attrs)
+
+
+def write_checkpoint(root, dataset_name, indices, metas, valid=None):
+    """Record the frames written since the last checkpoint: their header values in one array
+    per keyword, their T_OBS as t_obs, the validity of their channels and, last, their
+    completion bit.  A frame is only marked complete once its metadata is stored, so a run
+    stopped at any point resumes consistently.
+
+    Parameters
+    ----------
+    root : zarr.Group
+        Group created by create_sdo_store
+    dataset_name : str
+        Name of the stacks array
+    indices : list
+        Time index of every frame
+    metas : list
+        Header dict of every frame, None for failed frames that stay incomplete
+    valid : numpy.ndarray, optional
+        (frame, channel) validity of the frames, by default all channels of the frames with
+        a header dict
+    """
+    if valid is None:
+        valid = np.repeat(np.array([meta is not None for meta in metas])[:, None], root["valid"].shape[1], axis=1)
+    order = np.argsort(indices)
+    if len(order) > 0:
+        root["valid"].set_orthogonal_selection((np.asarray(indices)[order], slice(None)), np.asarray(valid)[order])
+
+    written = [(index, meta) for index, meta in zip(indices, metas) if meta is not None]
+    if not written:
+        return
+    written.sort(key=lambda item: item[0])
+    indices = np.array([index for index, _ in written])
+
+    columns = {}
+    for index, meta in written:
+        for key, value in meta.items():
+            if value is not None:
+                value = value.item() if isinstance(value, np.generic) else value
+                columns.setdefault(key, ([], []))
+                columns[key][0].append(index)
+                columns[key][1].append(value)
+    dtypes = {name: root[name].dtype for name in header_columns(root)}
+    for key, (column_indices, values) in columns.items():
+        array = header_column(root, dataset_name, key, values)
+        if array is not None:
+            array.set_coordinate_selection(np.array(column_indices), np.array(values, dtype=array.dtype))
+    # Columns that were created or widened change the consolidated metadata
+    if {name: root[name].dtype for name in header_columns(root)} != dtypes:
+        root[dataset_name].attrs["coordinates"] = " ".join(STORE_COORDINATES + header_columns(root))
+        zarr.consolidate_metadata(root.store)
+
+    t_obs = parse_t_obs([meta.get("t_obs") for _, meta in written])
+    valid = ~t_obs.isna()
+    if valid.any():
+        root["t_obs"].set_coordinate_selection(indices[valid], t_obs[valid].to_numpy())
+    root["completed"].set_coordinate_selection(indices, True)
+
+
+def group_by_time_chunk(indices, time_chunk_size):
+    """Positions of the time indices that fall in each time chunk
+
+    Parameters
+    ----------
+    indices : list
+        Time indices
+    time_chunk_size : int
+        Size of the time chunks
+
+    Returns
+    -------
+    list
+        One list of positions in indices per time chunk, in time order
+    """
+    groups = {}
+    for position, index in enumerate(indices):
+        groups.setdefault(index // time_chunk_size, []).append(position)
+    return [groups[time_chunk] for time_chunk in sorted(groups)]
+
+
+def write_time_chunk(store_path, dataset_name, indices, frames, load_frame, buffer_bytes=DEFAULT_BUFFER_BYTES):
+    """Load the stacks of frames that fall in one time chunk and write them, and their
+    pyramid levels, through ChunkWriteBuffers.  Frames that fail to load are logged and left
+    as the fill value, with all their channels invalid.
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the zarr DirectoryStore
+    dataset_name : str
+        Name of the (time, channel, y, x) array in the store
+    indices : list
+        Time index of every frame
+    frames : list
+        Arguments of load_frame for each frame
+    load_frame : callable
+        Picklable function taking a frame and returning its (channel, y, x) stack, a dict
+        with its header values and, optionally, a boolean per channel that is False for the
+        channels that could not be loaded
+    buffer_bytes : int, optional
+        Memory budget of the write buffer of the stacks, the buffers of the pyramid levels
+        get the same budget
+
+    Returns
+    -------
+    tuple
+        indices, the header dict of every frame (None for failed frames), the (frame,
+        channel) validity of the frames and the write statistics of the buffers
+    """
+    root = zarr.open_group(store_path, mode="r+")
+    buffer = ChunkWriteBuffer(root[dataset_name], buffer_bytes)
+    factors = root[dataset_name].attrs.get("pyramid_levels", [])
+    levels = {factor: ChunkWriteBuffer(root[level_name(dataset_name, factor)], buffer_bytes) for factor in factors}
+    encode = stack_encoder(root[dataset_name])
+    metas = []
+    valid = np.zeros((len(indices), buffer.array.shape[1]), dtype=bool)
+    for position, (index, frame) in enumerate(zip(indices, frames)):
+        try:
+            stack, meta, *channel_valid = load_frame(frame)
+            buffer.write(index, encode(stack))
+            # Each level is averaged from the previous one, before encoding
+            level, previous = stack, 1
+            for factor, level_buffer in levels.items():
+                level = block_average(level, factor // previous)
+                level_buffer.write(index, encode(level))
+                previous = factor
+            valid[position] = channel_valid[0] if channel_valid else True
+            # Channels without a single finite pixel are blank as well
+            valid[position] &= np.isfinite(stack).any(axis=tuple(range(1, stack.ndim)))
+        except Exception as e:
+            logger.warning(f"Frame {index} failed: {e}")
+            for frame_buffer in [buffer, *levels.values()]:
+                frame_buffer.write(index, frame_buffer.fill_value)
+            meta = None
+        metas.append(meta)
+    buffers = [buffer, *levels.values()]
+    for frame_buffer in buffers:
+        frame_buffer.flush()
+    return indices, metas, valid, merge_write_stats([frame_buffer.summary() for frame_buffer in buffers])
+
+
+def ingest_frames(store_path, dataset_name, frames, load_frame, indices=None, max_workers=None, processes=True,
+                  max_pending=None, buffer_bytes=DEFAULT_BUFFER_BYTES, checkpoint=None, checkpoint_every=64,
+                  return_stats=False):
+    """Load and write frames, one task per time chunk of the array
+
+    Parameters
+    ----------
+    store_path : str
+        Path of the zarr DirectoryStore
+    dataset_name : str
+        Name of the (time, channel, y, x) array in the store
+    frames : list
+        Arguments of load_frame for each frame
+    load_frame : callable
+        Picklable function taking a frame and returning its (channel, y, x) stack and a dict
+        with its header values
+    indices : list, optional
+        Time index of every frame, by default the position of the frame
+    max_workers : int, optional
+        Number of workers, all cores by default
+    processes : bool, optional
+        Whether to use a process pool (decompression and preprocessing hold the GIL) or a
+        thread pool, by default True
+    max_pending : int, optional
+        Number of chunks submitted ahead of the finished ones, by default 4 per worker
+    buffer_bytes : int, optional
+        Memory budget of the write buffer of each worker
+    checkpoint : callable, optional
+        Called in this process with the time indices, header dicts and (frame, channel)
+        validity of the frames written since the last call, every checkpoint_every time
+        chunks and at the end, e.g. partial(write_checkpoint, root, dataset_name)
+    checkpoint_every : int, optional
+        Number of time chunks between checkpoints
+    return_stats : bool, optional
+        Whether to also return the write statistics of all workers, see merge_write_stats
+
+    Returns
+    -------
+    list
+        Header dict of every frame, None for failed frames
+    """
+    indices = list(range(len(frames))) if indices is None else list(indices)
+    time_chunk_size = zarr.open_array(store_path, mode="r", path=dataset_name).chunks[0]
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    max_pending = max_pending or 4 * (max_workers or os.cpu_count())
+    positions = {index: position for position, index in enumerate(indices)}
+    metas = [None] * len(frames)
+    stats = []
+    unsaved = ([], [], [])
+    unsaved_chunks = 0
+
+    with executor(max_workers=max_workers) as pool, tqdm(total=len(frames), desc="Ingesting stacks") as progress:
+        groups = iter(group_by_time_chunk(indices, time_chunk_size))
+        pending = set()
+        while True:
+            for group in groups:
+                pending.add(pool.submit(write_time_chunk, store_path, dataset_name, [indices[p] for p in group],
+                                        [frames[p] for p in group], load_frame, buffer_bytes))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_indices, chunk_metas, chunk_valid, chunk_stats = future.result()
+                for index, meta in zip(chunk_indices, chunk_metas):
+                    metas[positions[index]] = meta
+                unsaved[0].extend(chunk_indices)
+                unsaved[1].extend(chunk_metas)
+                unsaved[2].append(chunk_valid)
+                unsaved_chunks += 1
+                stats.append(chunk_stats)
+                progress.update(len(chunk_metas))
+            if checkpoint is not None and unsaved_chunks >= checkpoint_every:
+                checkpoint(unsaved[0], unsaved[1], np.concatenate(unsaved[2]))
+                unsaved = ([], [], [])
+                unsaved_chunks = 0
+
+    if checkpoint is not None and unsaved[0]:
+        checkpoint(unsaved[0], unsaved[1], np.concatenate(unsaved[2]))
+    stats = merge_write_stats(stats)
+    logger.info(f"Wrote {stats['chunks']} chunks with a write amplification of {stats['write_amplification']:.2f}")
+    if return_stats:
+        return metas, stats
+    return metas
+
+
+def select_valid_frames(data, channels=None, require_all=True):
+    """Select the time indices of a store opened with xarray whose channels were loaded
+    successfully.  Only the small valid coordinate is read, not the stacks.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        Store opened with xarray.open_zarr, or one of its arrays
+    channels : list, optional
+        Channels that have to be valid, by default all of them
+    require_all : bool, optional
+        Whether all the channels have to be valid or only one of them, by default True
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        data restricted to the valid time indices
+    """
+    valid = data["valid"]
+    if channels is not None:
+        valid = valid.sel(channel=channels)
+    valid = valid.values
+    mask = valid.all(axis=1) if require_all else valid.any(axis=1)
+    return data.isel(t_obs=np.flatnonzero(mask))
+
+
+def select_level(data, dataset_name, output_size=None):
+    """Coarsest pyramid level of a stacks array that still has at least output_size pixels on
+    a side, the stacks themselves if no level is large enough
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Store opened with xarray.open_zarr
+    dataset_name : str
+        Name of the stacks array
+    output_size : int, optional
+        Pixels on a side needed, by default the full resolution
+
+    Returns
+    -------
+    xarray.DataArray
+    """
+    stacks = data[dataset_name]
+    if output_size is None:
+        return stacks
+    for factor in sorted(stacks.attrs.get("pyramid_levels", []), reverse=True):
+        level = data[level_name(dataset_name, factor)]
+        if min(level.shape[2:]) >= output_size:
+            return level
+    return stacks
@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from search_download.codec_autotune import autotune, pick_codec, sample_store
+from search_download.sdo_zarr import create_sdo_store, ingest_frames, write_checkpoint
+from search_download.zarr_benchmark import synthetic_frame
+
+
+class CodecAutotuneTest(unittest.TestCase):
+    """
+    Test the codec autotuning on a small synthetic store.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        dates = pd.date_range("2010-12-21", periods=6, freq="3min")
+        root = create_sdo_store(self.path, "stacks", dates, ["a", "b"], 32)
+        load_frame = partial(synthetic_frame, n_channels=2, image_size=32, work=0)
+        ingest_frames(self.path, "stacks", [0, 1, -2, 3, 4, 5], load_frame, processes=False,
+                      checkpoint=partial(write_checkpoint, root, "stacks"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sample_store(self):
+        """
+        Check that only valid frames are sampled
+        """
+        samples = sample_store(self.path, n_samples=10)
+        self.assertEqual(samples.shape, (5, 2, 32, 32))
+        self.assertTrue(np.isfinite(samples).all())
+
+    def test_autotune(self):
+        """
+        Check that every combination is measured, that float32 is lossless and that the
+        pick honours the constraints
+        """
+        samples = sample_store(self.path, n_samples=3)
+        results = autotune(samples, cnames=["lz4", "zstd"], clevels=[1, 5], shuffles=["noshuffle", "bitshuffle"],
+                           repeats=1)
+        self.assertEqual(len(results), 3 * 2 * 2 * 2)
+        self.assertTrue((results[results.encoding == "float32"].max_error == 0).all())
+        self.assertTrue((results[results.encoding != "float32"].ratio > 1.5).all())
+        self.assertTrue((results.ratio.diff().dropna() <= 0).all())
+
+        self.assertEqual(pick_codec(results, max_error=0).encoding, "float32")
+        self.assertEqual(pick_codec(results).ratio, results.ratio.max())
+        self.assertIsNone(pick_codec(results, min_decode_mb_s=np.inf))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from search_download.downloader import Downloader
+from search_download.tests.fake_drms import FakeClient, FakeFileServer
+
+
+class ConcurrentDownloadTest(unittest.TestCase):
+    """
+    Test the concurrent and sharded export modes against a fake JSOC client.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.wavelengths = [94, 131, 171, 193]
+        self.client = FakeClient(delay=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_downloader(self, **kwargs):
+        return Downloader(
+            sdate="2010-12-21T00:00:00",
+            edate="2010-12-22T00:00:00",
+            wavelength=self.wavelengths,
+            instrument="aia",
+            cadence="12h",
+            file_format="fits",
+            path=self.path,
+            poll_interval=0.05,
+            client=self.client,
+            **kwargs,
+        )
+
+    def test_all_wavelengths_downloaded(self):
+        """
+        Check that every wavelength ends up renamed in its own folder
+        """
+        self.make_downloader(concurrent_exports=len(self.wavelengths)).download_data()
+        self.assertEqual(len(self.client.exports), len(self.wavelengths))
+        for wl in self.wavelengths:
+            files = sorted(os.listdir(os.path.join(self.path, str(wl))))
+            self.assertEqual(len(files), 4)
+            self.assertEqual(files[0], f"20101221_000000_aia_{wl}_4k.fits")
+
+    def test_wall_clock_is_slowest_export(self):
+        """
+        Check that the export queue waits overlap instead of adding up
+        """
+        start = time.time()
+        self.make_downloader(concurrent_exports=len(self.wavelengths)).download_data()
+        elapsed = time.time() - start
+        self.assertLess(elapsed, self.client.delay * len(self.wavelengths))
+
+    def test_jobs_share_event_loop(self):
+        """
+        Check that several Downloader jobs run side by side in one event loop
+        """
+        self.wavelengths = [171]
+        downloaders = [self.make_downloader() for _ in range(4)]
+        for n, downloader in enumerate(downloaders):
+            downloader.path = os.path.join(self.path, str(n))
+            os.mkdir(downloader.path)
+
+        async def run_all():
+            return await asyncio.gather(*[d.download_data_async() for d in downloaders])
+
+        start = time.time()
+        asyncio.run(run_all())
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed, self.client.delay * len(downloaders))
+        for downloader in downloaders:
+            self.assertEqual(len(os.listdir(os.path.join(downloader.path, "171"))), 4)
+
+    def test_metrics(self):
+        """
+        Check that per-shard and per-wavelength metrics are returned and written
+        """
+        self.wavelengths = [171]
+        metrics_path = os.path.join(self.path, "metrics.jsonl")
+        downloader = self.make_downloader(shard_records=2, metrics_path=metrics_path)
+        _, metrics = downloader.download_data(return_metrics=True)
+
+        shards = [m for m in metrics if m["level"] == "shard"]
+        self.assertEqual(len(shards), 2)
+        for m in shards:
+            self.assertEqual(m["status"], "ok")
+            self.assertEqual(m["files"], 2)
+            self.assertGreaterEqual(m["export_seconds"], self.client.delay)
+            for key in ["transfer_seconds", "unpack_seconds", "mb_per_s"]:
+                self.assertIn(key, m)
+
+        summary = metrics[-1]
+        self.assertEqual(summary["level"], "wavelength")
+        self.assertEqual(summary["files"], 4)
+        with open(metrics_path) as f:
+            self.assertEqual([json.loads(line) for line in f], metrics)
+
+    def test_retry_metrics_are_per_attempt(self):
+        """
+        Check that a failed attempt does not leak its transfer metrics into the next one
+        """
+        self.wavelengths = [171]
+        self.client.delay = 0
+        downloader = self.make_downloader(max_retries=1)
+
+        def download_export(wavelength, export_request, metrics):
+            metrics.update(bytes=100, transfer_seconds=1.0)
+            self.client.fail_once.add(self.client.exports[-1])
+            raise OSError("connection reset")
+
+        downloader.download_export = download_export
+        _, metrics = downloader.download_data(return_metrics=True)
+
+        shard = metrics[0]
+        self.assertEqual(shard["status"], "failed")
+        self.assertEqual(shard["attempts"], 2)
+        for key in ["bytes", "transfer_seconds", "mb_per_s", "export_seconds"]:
+            self.assertNotIn(key, shard)
+
+    def test_download_bug_is_raised(self):
+        """
+        Check that an error that is not a transfer error is raised instead of retried
+        """
+        self.wavelengths = [171]
+        self.client.delay = 0
+        downloader = self.make_downloader(max_retries=2)
+
+        def download_export(wavelength, export_request, metrics):
+            raise KeyError("record")
+
+        downloader.download_export = download_export
+        with self.assertRaises(KeyError):
+            downloader.download_data()
+        self.assertEqual(len(self.client.exports), 1)
+        self.assertEqual(downloader.failed_exports, [])
+
+    def test_time_shards(self):
+        """
+        Check that shards tile the date range on the cadence grid
+        """
+        downloader = self.make_downloader(shard_records=3)
+        shards = downloader.time_shards()
+        self.assertEqual([duration for _, duration in shards], [129600, 43200])
+        self.assertEqual(
+            downloader.assemble_jsoc_string(171, shards[1]),
+            "aia.lev1_euv_12s[2010-12-22T12:00:00/12h@12h][171]{image}",
+        )
+
+        downloader = self.make_downloader(shard_bytes=2.5e7, record_bytes=1e7)
+        self.assertEqual(len(downloader.time_shards()), 2)
+        self.assertEqual(self.make_downloader().time_shards(), [None])
+
+    def test_failed_shard_is_retried(self):
+        """
+        Check that a failing shard is resubmitted and the other shards are kept
+        """
+        self.wavelengths = [171]
+        downloader = self.make_downloader(shard_records=1)
+        jsoc_strings = [jsoc_string for _, jsoc_string in downloader.export_jobs()]
+        self.client.fail_once = {jsoc_strings[2]}
+        self.client.delay = 0
+
+        downloader.download_data()
+        self.assertEqual(len(self.client.exports), len(jsoc_strings) + 1)
+        self.assertEqual(downloader.failed_exports, [])
+        self.assertEqual(len(os.listdir(os.path.join(self.path, "171"))), 4)
+
+    def test_incremental_first_run(self):
+        """
+        Check that a wavelength folder that does not exist yet is read as empty without warnings
+        """
+        self.wavelengths = [171]
+        downloader = self.make_downloader(incremental=True)
+        with self.assertNoLogs("search_download.utils.scandir_walker"):
+            self.assertEqual(downloader.local_record_times(171), set())
+            self.assertEqual(
+                downloader.export_jobs(),
+                [(171, "aia.lev1_euv_12s[2010-12-21T00:00:00/2d@12h][171]{image}")],
+            )
+
+    def test_incremental_exports_missing_records(self):
+        """
+        Check that only records missing on disk are exported, coalesced into runs
+        """
+        self.wavelengths = [171]
+        os.makedirs(os.path.join(self.path, "171"))
+        for name in ["20101221_000000_aia_171_4k.fits", "20101222_000000_aia_171_4k.fits"]:
+            open(os.path.join(self.path, "171", name), "w").close()
+
+        downloader = self.make_downloader(incremental=True)
+        self.assertEqual(
+            [jsoc_string for _, jsoc_string in downloader.export_jobs()],
+            [
+                "aia.lev1_euv_12s[2010-12-21T12:00:00/12h@12h][171]{image}",
+                "aia.lev1_euv_12s[2010-12-22T12:00:00/12h@12h][171]{image}",
+            ],
+        )
+
+        open(os.path.join(self.path, "171", "20101221_120000_aia_171_4k.fits"), "w").close()
+        os.remove(os.path.join(self.path, "171", "20101222_000000_aia_171_4k.fits"))
+        self.assertEqual(
+            [jsoc_string for _, jsoc_string in downloader.export_jobs()],
+            ["aia.lev1_euv_12s[2010-12-22T00:00:00/1d@12h][171]{image}"],
+        )
+
+        downloader.download_data()
+        self.assertEqual(len(os.listdir(os.path.join(self.path, "171"))), 4)
+        self.assertEqual(downloader.export_jobs(), [])
+
+    def test_download_limit_thins_cadence(self):
+        """
+        Check that requests over the download limit are exported at a coarser cadence
+        """
+        self.wavelengths = [171]
+        downloader = self.make_downloader(download_limit=3)
+        self.assertEqual(
+            downloader.export_jobs(),
+            [(171, "aia.lev1_euv_12s[2010-12-21/2d@1d][171]{image}")],
+        )
+
+        downloader.download_data()
+        self.assertEqual(len(os.listdir(os.path.join(self.path, "171"))), 2)
+
+        downloader = self.make_downloader(download_limit=4)
+        self.assertEqual(downloader.thin_cadences(), {})
+
+    def test_thinned_incremental_queries_once(self):
+        """
+        Check that thinning and the incremental comparison share a single query per wavelength
+        """
+        self.wavelengths = [171, 193]
+        os.makedirs(os.path.join(self.path, "171"))
+        open(os.path.join(self.path, "171", "20101221_000000_aia_171_4k.fits"), "w").close()
+
+        downloader = self.make_downloader(download_limit=3, incremental=True)
+        jobs = downloader.export_jobs()
+        self.assertEqual(len(self.client.queries), len(self.wavelengths))
+        self.assertEqual(
+            jobs,
+            [
+                (171, "aia.lev1_euv_12s[2010-12-22T00:00:00/1d@1d][171]{image}"),
+                (193, "aia.lev1_euv_12s[2010-12-21T00:00:00/2d@1d][193]{image}"),
+            ],
+        )
+
+    def test_stream_tar(self):
+        """
+        Check that fits files are extracted from the HTTP tar stream under their final names
+        """
+        self.wavelengths = [171]
+        file_server = FakeFileServer()
+        self.client = FakeClient(file_server=file_server)
+        try:
+            self.make_downloader(stream_tar=True).download_data()
+        finally:
+            file_server.close()
+
+        files = sorted(os.listdir(os.path.join(self.path, "171")))
+        self.assertEqual(len(files), 4)
+        self.assertTrue(all(f.endswith("_aia_171_4k.fits") for f in files))
+        with open(os.path.join(self.path, "171", files[1])) as f:
+            self.assertEqual(
+                f.read(), "aia.lev1_euv_12s.2010-12-21T120000Z.171.image_lev1.fits"
+            )
+
+    def test_url_quick_fetch(self):
+        """
+        Check that per-file exports are fetched and named after their records
+        """
+        self.wavelengths = [171]
+        file_server = FakeFileServer()
+        self.client = FakeClient(file_server=file_server)
+        try:
+            self.make_downloader(method="url_quick", fetch_workers=4).download_data()
+        finally:
+            file_server.close()
+
+        files = sorted(os.listdir(os.path.join(self.path, "171")))
+        self.assertEqual(
+            files,
+            [
+                "20101221_000000_aia_171_4k.fits",
+                "20101221_120000_aia_171_4k.fits",
+                "20101222_000000_aia_171_4k.fits",
+                "20101222_120000_aia_171_4k.fits",
+            ],
+        )
+
+    def test_files_written_under_final_names(self):
+        """
+        Check that unpacked files get their compact names directly and that other files in
+        the folder are left alone
+        """
+        self.wavelengths = [171]
+        os.makedirs(os.path.join(self.path, "171"))
+        stray = os.path.join(self.path, "171", "aia.lev1_euv_12s.2010-12-20T000000Z.171.image_lev1.fits")
+        open(stray, "w").close()
+
+        self.make_downloader().download_data()
+
+        files = sorted(os.listdir(os.path.join(self.path, "171")))
+        self.assertEqual(len(files), 5)
+        self.assertTrue(os.path.exists(stray))
+        self.assertEqual(files[0], "20101221_000000_aia_171_4k.fits")
+        self.assertFalse(any(f.endswith((".part", ".tar")) for f in files))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+from astropy.io import fits
+
+from search_download.concurrent_file_indexer import build_match_index, match_file_times, read_match_index
+from search_download.fake_jsoc import fits_file
+from search_download.utils import file_scan
+from search_download.utils.file_scan import _filename_to_date, filenames_to_dates, scan_fits_quality
+
+
+def channel(sufix, offset, n_files, cadence):
+    """
+    Dates and filenames of n_files files every cadence seconds, starting offset seconds
+    after 2010-12-21
+    """
+    start = datetime.datetime(2010, 12, 21)
+    dates = [start + datetime.timedelta(seconds=offset + i * cadence) for i in range(n_files)]
+    return dates, [f"{d:%Y%m%d_%H%M%S}_{sufix}.fits" for d in dates]
+
+
+class ConcurrentFileIndexerTest(unittest.TestCase):
+    """
+    Test the file indexing steps on synthetic file lists.
+    """
+
+    def setUp(self):
+        self.aia_files = [
+            "/data/171/20101221_000000_aia_171_4k.fits",
+            "/data/20101220_000000_backup/171/20101221_000012_aia_171_4k.fits",
+            "/data/171/20101221_000024_aia_171_4k.spikes.fits",
+        ]
+        self.hmi_files = [
+            "/data/hmi/hmi.m_720s.20101221_000000_TAI.1.magnetogram.fits",
+            "/data/hmi/hmi_20101221.fits",
+        ]
+
+    def test_filenames_to_dates_matches_per_file(self):
+        """
+        Check that the vectorized dates are the ones of _filename_to_date
+        """
+        dates = filenames_to_dates([self.aia_files, self.hmi_files])
+        for files, channel_dates in zip([self.aia_files, self.hmi_files], dates):
+            self.assertEqual(list(channel_dates), [_filename_to_date(f) for f in files])
+
+    def test_unparseable_filenames(self):
+        """
+        Check that all unparseable names are reported together
+        """
+        files = self.aia_files + ["/data/171/image_lev1.fits", "/data/171/x_20109999_000000.fits"]
+        with self.assertRaisesRegex(ValueError, "2 of 5 filenames"):
+            filenames_to_dates([files])
+
+        dates = filenames_to_dates([files], errors="coerce")[0]
+        self.assertEqual(int(pd.isna(dates).sum()), 2)
+
+    def test_match_keeps_closest_file(self):
+        """
+        Check that each slot gets the file closest to it rather than the first one that
+        rounds into it
+        """
+        aia171 = channel("aia171", 1, 30, 12)
+        aia193 = channel("aia193", 7, 30, 12)
+        matches = match_file_times(
+            [aia171[0], aia193[0]],
+            [aia171[1], aia193[1]],
+            ["aia171", "aia193"],
+            cadence="3min",
+            offsets=True,
+        )
+        self.assertEqual(list(matches.index), list(pd.date_range("2010-12-21 00:00", periods=3, freq="3min")))
+        self.assertEqual(matches.files_aia171.iloc[1], "20101221_000301_aia171.fits")
+        self.assertEqual(matches.files_aia193.iloc[1], "20101221_000255_aia193.fits")
+        self.assertEqual(list(matches.offset_aia193), [7.0, -5.0, -5.0])
+
+    def test_match_across_slot_boundary(self):
+        """
+        Check that files on either side of a slot boundary are matched together once
+        """
+        aia171 = channel("aia171", 89, 1, 180)
+        aia193 = channel("aia193", 91, 1, 180)
+        matches = match_file_times(
+            [aia171[0], aia193[0]],
+            [aia171[1], aia193[1]],
+            ["aia171", "aia193"],
+            cadence="3min",
+            tolerance="2min",
+        )
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(list(matches.iloc[0]), [aia171[1][0], aia193[1][0]])
+
+    def test_match_tolerance_per_channel(self):
+        """
+        Check that a channel without a file within its tolerance drops the slot
+        """
+        aia171 = channel("aia171", 0, 10, 60)
+        aia193 = channel("aia193", 20, 10, 60)
+        matches = match_file_times(
+            [aia171[0], aia193[0]],
+            [aia171[1], aia193[1]],
+            ["aia171", "aia193"],
+            cadence="1min",
+            tolerance={"aia193": "10s"},
+        )
+        self.assertTrue(matches.empty)
+
+    def test_match_aia_to_hmi(self):
+        """
+        Check that 720s HMI files are matched to the closest of the 12s AIA slots
+        """
+        aia171 = channel("aia171", 3, 300, 12)
+        hmi = channel("hmi", 0, 5, 720)
+        matches = match_file_times([aia171[0]], [aia171[1]], ["aia171"], cadence="12s")
+        matches = match_file_times([hmi[0]], [hmi[1]], ["hmi"], joint_df=matches, offsets=True)
+        self.assertEqual(list(matches.files_hmi), hmi[1])
+        self.assertEqual(list(matches.index), hmi[0])
+        self.assertEqual(matches.files_aia171.iloc[1], "20101221_001203_aia171.fits")
+        self.assertTrue((matches.offset_hmi == 0).all())
+
+
+class FitsQualityTest(unittest.TestCase):
+    """
+    Test the header-only quality scan on synthetic AIA and HMI files.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = []
+        for n, (wavelength, compress) in enumerate([(171, True), (193, True), (None, False)]):
+            t_rec = datetime.datetime(2010, 12, 21, n)
+            self.files.append(os.path.join(self.path, f"{t_rec:%Y%m%d_%H%M%S}_{wavelength}.fits"))
+            with open(self.files[-1], "wb") as f:
+                f.write(fits_file(t_rec, wavelength, image_size=16, compress=compress))
+        fits.setval(self.files[1], "QUALITY", value=2, ext=1)
+        self.files.append(os.path.join(self.path, "20101221_030000_171.fits"))
+        with open(self.files[-1], "wb") as f:
+            f.write(b"not a fits file")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_scan_fits_quality(self):
+        """
+        Check the keywords of compressed and uncompressed files and the unreadable file
+        """
+        for processes in [False, True]:
+            quality = scan_fits_quality(self.files, batch_size=2, processes=processes)
+            self.assertEqual(list(quality.file), self.files)
+            self.assertEqual(list(quality.QUALITY[0:3]), [0, 2, 0])
+            self.assertEqual(list(quality.WAVELNTH[0:2]), [171, 193])
+            self.assertEqual(quality.T_REC[2], "2010.12.21_02:00:00_TAI")
+            self.assertTrue(quality.error[0:3].isna().all())
+            self.assertTrue(pd.isna(quality.QUALITY[3]))
+            self.assertIsInstance(quality.error[3], str)
+
+    def test_scan_reports_any_header_error(self):
+        """
+        Check that an unexpected astropy error on a corrupt file is reported in its row
+        """
+        read_fits_header = file_scan.read_fits_header
+
+        def corrupt_second_file(file):
+            if file == self.files[1]:
+                raise IndexError("list index out of range")
+            return read_fits_header(file)
+
+        with mock.patch.object(file_scan, "read_fits_header", side_effect=corrupt_second_file):
+            quality = scan_fits_quality(self.files, batch_size=2)
+        self.assertEqual(list(quality.file), self.files)
+        self.assertEqual(quality.error[1], "IndexError: list index out of range")
+        self.assertEqual(list(quality.QUALITY[[0, 2]]), [0, 0])
+
+
+class BuildMatchIndexTest(unittest.TestCase):
+    """
+    Test the match table built from AIA and HMI folders.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.aia_path = os.path.join(self.path, "aia")
+        self.hmi_path = os.path.join(self.path, "hmi")
+        os.makedirs(self.hmi_path)
+        for wl in [171, 304]:
+            os.makedirs(os.path.join(self.aia_path, str(wl)))
+            for t_rec in channel("aia", 0, 10, 180)[0]:
+                self.write(os.path.join(self.aia_path, str(wl), f"{t_rec:%Y%m%d_%H%M%S}_aia_{wl}_4k.fits"), t_rec, wl)
+        for t_rec in channel("hmi", 0, 3, 720)[0]:
+            self.write(os.path.join(self.hmi_path, f"{t_rec:%Y%m%d_%H%M%S}_hmi_1_4k.fits"), t_rec, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, path, t_rec, wavelength):
+        with open(path, "wb") as f:
+            f.write(fits_file(t_rec, wavelength, image_size=16))
+
+    def test_build_match_index(self):
+        """
+        Check the types of the matches and that Parquet and csv read back the same table
+        """
+        output = os.path.join(self.path, "matches.parquet")
+        matches = build_match_index(self.aia_path, self.hmi_path, [304, 171, 94], output=output)
+        self.assertEqual(list(matches.columns), ["files_aia171", "files_aia304", "files_hmi"])
+        self.assertEqual(list(matches.index), channel("hmi", 0, 3, 720)[0])
+        self.assertEqual(str(matches.index.dtype), "datetime64[ns]")
+        self.assertTrue(all(isinstance(matches[c].dtype, pd.CategoricalDtype) for c in matches.columns))
+        pd.testing.assert_frame_equal(read_match_index(output), matches)
+
+        matches.to_csv(os.path.join(self.path, "matches.csv"))
+        pd.testing.assert_frame_equal(read_match_index(os.path.join(self.path, "matches.csv")), matches)
+
+    def test_tolerance_list_follows_matched_channels(self):
+        """
+        Check that a tolerance list applies to the sorted channels found on disk, whatever
+        the order of the directory listing and of the requested wavelengths
+        """
+        # Move the 00:12 file of 304 a minute late, it only matches with a 90s tolerance
+        folder = os.path.join(self.aia_path, "304")
+        os.remove(os.path.join(folder, "20101221_001200_aia_304_4k.fits"))
+        t_rec = datetime.datetime(2010, 12, 21, 0, 13)
+        self.write(os.path.join(folder, f"{t_rec:%Y%m%d_%H%M%S}_aia_304_4k.fits"), t_rec, 304)
+
+        listdir = os.listdir
+        with mock.patch("os.listdir", side_effect=lambda path: sorted(listdir(path), reverse=True)):
+            matches = build_match_index(self.aia_path, self.hmi_path, [304, 171, 94],
+                                        tolerance=["10s", "90s", "10s"])
+            self.assertEqual(list(matches.index), channel("hmi", 0, 3, 720)[0])
+
+            with self.assertRaises(ValueError):
+                build_match_index(self.aia_path, self.hmi_path, [304, 171, 94], tolerance=["10s", "90s"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+"""
+Offline stand-ins for the drms client used to exercise the Downloader without a JSOC
+account or network access.
+
+"""
+import io
+import os
+import tarfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+
+from search_download.fake_jsoc import (FileRequestHandler, export_filename, parse_record_set, record_string,
+                                      t_rec_string)
+
+
+def fits_bytes(record: str, size: int = 2880 * 4):
+    """
+    Synthetic file content of a given size that starts with its record string
+    """
+    content = record.encode().ljust(80)
+    return (content * (size // len(content) + 1))[0:size]
+
+
+def tar_bytes(filenames: list):
+    """
+    Build an in-memory tar file with one small fake fits file per filename.  The content
+    of every member is its own filename.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for filename in filenames:
+            content = filename.encode()
+            info = tarfile.TarInfo(filename)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class FakeFileServer:
+    """
+    Local HTTP/1.1 server that serves in-memory files, standing in for the JSOC download
+    server.  It honours range requests and keep-alive connections.
+
+    Parameters:
+        latency: (float)
+            Seconds every request waits before the response is sent
+        fail_once: (set)
+            Paths whose first request is answered with a 500 error
+        truncate_once: (dict)
+            Path -> number of bytes after which its first response is cut off, with the
+            full Content-Length announced
+    """
+
+    def __init__(self, latency: float = 0, fail_once: set = None, truncate_once: dict = None):
+        self.files = {}
+        self.latency = latency
+        self.fail_once = set() if fail_once is None else set(fail_once)
+        self.truncate_once = {} if truncate_once is None else dict(truncate_once)
+        self.requests = []  # (path, range header) of every request
+        self.connections = set()  # client ports that opened a connection
+        server = self
+
+        class Handler(FileRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.path, self.headers.get("Range")))
+                server.connections.add(self.client_address[1])
+                time.sleep(server.latency)
+                content = server.files.get(self.path)
+                if self.path in server.fail_once:
+                    server.fail_once.discard(self.path)
+                    content = None
+                    self.send_error(500)
+                    return
+                if content is None:
+                    self.send_error(404)
+                    return
+
+                self.send_file(content, limit=server.truncate_once.pop(self.path, None))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def add(self, path: str, content: bytes):
+        """
+        Serve content under path and return its URL
+        """
+        self.files[path] = content
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeExportRequest:
+    """
+    Export request that becomes ready a fixed number of seconds after submission and
+    downloads a tar file with one small fake fits file per record.
+
+    Parameters:
+        filenames: (list)
+            Names of the files contained in the export
+        delay: (float)
+            Seconds from submission until the request is ready
+        transfer_time: (float)
+            Seconds the download takes
+        fail: (bool)
+            Whether the export finishes with an error
+        url: (str)
+            URL the tar file is served from, if any
+        urls: (pandas.DataFrame)
+            Record, filename and URL of every file for per-file export methods
+        records: (list)
+            Record string of every file, if None, the export lists no records
+    """
+
+    def __init__(
+        self,
+        filenames: list,
+        delay: float = 0,
+        transfer_time: float = 0,
+        fail: bool = False,
+        url: str = None,
+        urls: pd.DataFrame = None,
+        records: list = None,
+    ):
+        self.filenames = filenames
+        self.records = [None for _ in filenames] if records is None else records
+        self.delay = delay
+        self.transfer_time = transfer_time
+        self.fail = fail
+        self.url = url
+        self._urls = urls
+        self.submitted = time.time()
+
+    @property
+    def urls(self):
+        if self._urls is not None:
+            return self._urls
+        return pd.DataFrame({"record": [None], "filename": ["export.tar"], "url": [self.url]})
+
+    @property
+    def data(self):
+        return pd.DataFrame({"record": self.records, "filename": self.filenames})
+
+    def has_finished(self, skip_update=False):
+        return time.time() - self.submitted >= self.delay
+
+    def wait(self, timeout=None, sleep=5, retries_notfound=5):
+        remaining = self.delay - (time.time() - self.submitted)
+        if remaining > 0:
+            time.sleep(remaining)
+        if self.fail:
+            raise RuntimeError("DRMS export request failed. [status=4]")
+        return True
+
+    def download(self, directory):
+        time.sleep(self.transfer_time)
+        tar_path = os.path.join(directory, f"export_{id(self)}.tar")
+        with open(tar_path, "wb") as f:
+            f.write(tar_bytes(self.filenames))
+        return pd.DataFrame({"record": [None], "download": [tar_path]})
+
+
+class FakeClient:
+    """
+    drms.Client replacement that records the export calls it receives
+
+    Parameters:
+        delay: (float)
+            Seconds each export takes to become ready
+        transfer_time: (float)
+            Seconds each download takes
+        fail_once: (set)
+            JSOC strings whose first export attempt fails
+        file_server: (FakeFileServer)
+            Server that exports are published on, so they can be fetched over HTTP
+    """
+
+    def __init__(
+        self,
+        delay: float = 0,
+        transfer_time: float = 0,
+        fail_once: set = None,
+        file_server: FakeFileServer = None,
+    ):
+        self.delay = delay
+        self.transfer_time = transfer_time
+        self.fail_once = set() if fail_once is None else set(fail_once)
+        self.file_server = file_server
+        self.exports = []
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def query(self, jsoc_string, key=None):
+        _, t_recs, wavelength, _ = parse_record_set(jsoc_string)
+        with self._lock:
+            self.queries.append(jsoc_string)
+        return pd.DataFrame({"T_REC": [t_rec_string(t_rec, wavelength) for t_rec in t_recs]})
+
+    def export(self, jsoc_string, method="url_quick", protocol="as-is", protocol_args=None):
+        _, t_recs, wavelength, _ = parse_record_set(jsoc_string)
+        with self._lock:
+            self.exports.append(jsoc_string)
+            fail = jsoc_string in self.fail_once
+            self.fail_once.discard(jsoc_string)
+            export_id = len(self.exports)
+        filenames = [export_filename(t_rec, wavelength) for t_rec in t_recs]
+        records = [record_string(t_rec, wavelength) for t_rec in t_recs]
+        url = None
+        urls = None
+        if self.file_server is not None and method == "url-tar":
+            url = self.file_server.add(f"/export/{export_id}.tar", tar_bytes(filenames))
+        elif self.file_server is not None:
+            if method == "url_quick":
+                # Quick exports keep the storage names, which carry no date
+                filenames = ["image_lev1.fits" for _ in t_recs]
+            urls = pd.DataFrame(
+                {
+                    "record": records,
+                    "filename": filenames,
+                    "url": [
+                        self.file_server.add(
+                            f"/export/{export_id}/{n}/{filename}", fits_bytes(record)
+                        )
+                        for n, (record, filename) in enumerate(zip(records, filenames))
+                    ],
+                }
+            )
+        return FakeExportRequest(
+            filenames,
+            delay=self.delay,
+            transfer_time=self.transfer_time,
+            fail=fail,
+            url=url,
+            urls=urls,
+            records=records,
+        )
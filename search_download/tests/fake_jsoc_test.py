@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from astropy.io import fits
+
+from search_download.download_benchmark import run_benchmark
+from search_download.downloader import Downloader
+from search_download.fake_jsoc import FakeJsocServer
+from search_download.file_renamer import compact_filename
+
+
+class FakeJsocTest(unittest.TestCase):
+    """
+    Test the local JSOC stand-in with the real drms client and the Downloader.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeJsocServer(queue_delay=0.3, image_size=64)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path)
+
+    def test_query(self):
+        """
+        Check that a drms query returns the records on the requested cadence
+        """
+        query = self.client.query("aia.lev1_euv_12s[2010-12-21/1d@6h][171]{image}", key="t_rec")
+        self.assertEqual(
+            list(query["T_REC"]),
+            [f"2010-12-21T{h:02d}:00:00Z" for h in [0, 6, 12, 18]],
+        )
+
+    def test_export_waits_in_queue(self):
+        """
+        Check that an export stays pending for the queue delay and then lists its files
+        """
+        export_request = self.client.export(
+            "hmi.M_720s[2010-12-21/1h@30m]{image}", method="url", protocol="fits"
+        )
+        self.assertFalse(export_request.has_finished())
+        time.sleep(self.server.queue_delay)
+        self.assertTrue(export_request.has_finished())
+        self.assertEqual(
+            list(export_request.urls.filename),
+            [
+                "hmi.m_720s.20101221_000000_TAI.1.magnetogram.fits",
+                "hmi.m_720s.20101221_003000_TAI.1.magnetogram.fits",
+            ],
+        )
+
+    def test_bandwidth(self):
+        """
+        Check that file transfers are throttled to the configured bandwidth
+        """
+        self.server.bandwidth = 1e5
+        export_request = self.client.export(
+            "aia.lev1_euv_12s[2010-12-21/1h@1h][171]{image}", method="url_quick"
+        )
+        start = time.time()
+        export_output = export_request.download(self.path)
+        size = os.path.getsize(export_output.download[0])
+        self.assertGreaterEqual(time.time() - start, 0.9 * size / self.server.bandwidth)
+
+    def test_downloader(self):
+        """
+        Check that the Downloader ends up with renamed fits files carrying JSOC headers
+        """
+        Downloader(
+            sdate="2010-12-21T00:00:00",
+            edate="2010-12-21T00:00:00",
+            wavelength=[171, 304],
+            instrument="aia",
+            cadence="6h",
+            file_format="fits",
+            path=self.path,
+            poll_interval=0.05,
+            client=self.client,
+        ).download_data()
+        for wl in [171, 304]:
+            files = sorted(os.listdir(os.path.join(self.path, str(wl))))
+            self.assertEqual(len(files), 4)
+            header = fits.getheader(os.path.join(self.path, str(wl), files[0]), 1)
+            self.assertEqual(files[0], f"20101221_000000_aia_{wl}_4k.fits")
+            self.assertEqual(header["WAVELNTH"], wl)
+            self.assertEqual(header["T_REC"], "2010-12-21T00:00:00Z")
+
+    def test_downloader_jpg(self):
+        """
+        Check that jpg exports are written under their compact names
+        """
+        Downloader(
+            sdate="2010-12-21T00:00:00",
+            edate="2010-12-21T00:00:00",
+            wavelength=[171],
+            instrument="aia",
+            cadence="12h",
+            file_format="jpg",
+            path=self.path,
+            poll_interval=0.05,
+            client=self.client,
+        ).download_data()
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.path, "171"))),
+            ["20101221_000000_aia_171_4k.jpg", "20101221_120000_aia_171_4k.jpg"],
+        )
+
+    def test_benchmark(self):
+        """
+        Check that the benchmark reports one row per configuration
+        """
+        results = run_benchmark(
+            wavelengths=[1, 2],
+            methods=["url-tar", "url"],
+            path=self.path,
+            server_kwargs={"image_size": 64},
+            cadence="6h",
+        )
+        self.assertEqual(len(results), 4)
+        self.assertEqual(list(results.files), [4, 8, 4, 8])
+        self.assertTrue((results.failed_shards == 0).all())
+        self.assertTrue((results.mb_per_s > 0).all())
+
+    def test_jpg_export_names(self):
+        """
+        Check that jpg exports are named like the JSOC ones and benchmark without failures
+        """
+        export_request = self.client.export(
+            "aia.lev1_euv_12s[2010-12-21/1h@1h][171]{image}", method="url", protocol="jpg"
+        )
+        time.sleep(self.server.queue_delay)
+        filename = export_request.urls.filename[0]
+        self.assertEqual(filename, "aia.lev1_euv_12s.20101221T000000Z.171.image_lev1.jpg")
+        self.assertEqual(compact_filename(filename), "20101221_000000_aia_171_4k.jpg")
+
+        results = run_benchmark(
+            wavelengths=[1], formats=["jpg"], path=self.path, server_kwargs={"image_size": 64}, cadence="6h"
+        )
+        self.assertTrue((results.failed_shards == 0).all())
+        self.assertEqual(list(results.files), [4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from search_download.file_fetcher import FileFetcher
+from search_download.tests.fake_drms import FakeFileServer, fits_bytes
+
+
+class FileFetcherTest(unittest.TestCase):
+    """
+    Test the pooled per-file fetcher against a local HTTP stand-in.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeFileServer(latency=0.1)
+        self.contents = [fits_bytes(f"record {n}") for n in range(16)]
+        self.urls = [
+            self.server.add(f"/export/{n}.fits", content)
+            for n, content in enumerate(self.contents)
+        ]
+        self.destinations = [os.path.join(self.path, f"{n}.fits") for n in range(16)]
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path)
+
+    def test_parallel_fetch(self):
+        """
+        Check that the pool downloads every file and overlaps the request latency
+        """
+        fetcher = FileFetcher(max_workers=8, progress=False)
+        start = time.time()
+        stats = fetcher.fetch(self.urls, self.destinations)
+        elapsed = time.time() - start
+
+        self.assertEqual(stats["files"], 16)
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(stats["bytes"], sum(len(c) for c in self.contents))
+        self.assertLess(elapsed, 16 * self.server.latency / 2)
+        # Workers reuse their keep-alive connection
+        self.assertLessEqual(len(self.server.connections), 8)
+        for destination, content in zip(self.destinations, self.contents):
+            with open(destination, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+    def test_resume_partial_file(self):
+        """
+        Check that an existing .part file is completed with a range request
+        """
+        with open(self.destinations[0] + ".part", "wb") as f:
+            f.write(self.contents[0][0:1000])
+
+        fetcher = FileFetcher(max_workers=1, progress=False)
+        stats = fetcher.fetch(self.urls[0:1], self.destinations[0:1])
+
+        self.assertEqual(self.server.requests, [("/export/0.fits", "bytes=1000-")])
+        self.assertEqual(stats["bytes"], len(self.contents[0]) - 1000)
+        with open(self.destinations[0], "rb") as f:
+            self.assertEqual(f.read(), self.contents[0])
+
+    def test_retry(self):
+        """
+        Check that a failed transfer is retried
+        """
+        self.server.fail_once = {"/export/0.fits"}
+        fetcher = FileFetcher(max_workers=1, backoff=0.01, progress=False)
+        stats = fetcher.fetch(self.urls[0:1], self.destinations[0:1])
+
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(os.path.exists(self.destinations[0]))
+
+    def test_truncated_transfer(self):
+        """
+        Check that a connection closed before Content-Length is retried from the partial
+        file instead of being taken as a complete download
+        """
+        self.server.truncate_once = {"/export/0.fits": 4000}
+        fetcher = FileFetcher(max_workers=1, backoff=0.01, progress=False)
+        stats = fetcher.fetch(self.urls[0:1], self.destinations[0:1])
+
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(self.server.requests, [("/export/0.fits", None), ("/export/0.fits", "bytes=4000-")])
+        with open(self.destinations[0], "rb") as f:
+            self.assertEqual(f.read(), self.contents[0])
+        self.assertFalse(os.path.exists(self.destinations[0] + ".part"))
+
+        # Without retries the partial file is kept and no destination is written
+        self.server.truncate_once = {"/export/1.fits": 4000}
+        stats = FileFetcher(max_workers=1, max_retries=0, progress=False).fetch(self.urls[1:2],
+                                                                              self.destinations[1:2])
+        self.assertEqual(stats["failed"], [self.destinations[1]])
+        self.assertFalse(os.path.exists(self.destinations[1]))
+        self.assertEqual(os.path.getsize(self.destinations[1] + ".part"), 4000)
+
+    def test_connections_kept_between_fetches(self):
+        """
+        Check that successive fetches reuse the keep-alive connections until close
+        """
+        self.server.latency = 0
+        fetcher = FileFetcher(max_workers=2, progress=False)
+        for n in range(0, 8, 2):
+            stats = fetcher.fetch(self.urls[n:n + 2], self.destinations[n:n + 2])
+            self.assertEqual(stats["failed"], [])
+        self.assertLessEqual(len(self.server.connections), 2)
+
+        fetcher.close()
+        stats = fetcher.fetch(self.urls[8:10], self.destinations[8:10])
+        fetcher.close()
+        self.assertEqual(stats["failed"], [])
+        self.assertGreater(len(self.server.connections), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
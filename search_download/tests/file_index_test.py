@@ -0,0 +1,79 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from astropy.io import fits
+
+from search_download.fake_jsoc import fits_file
+from search_download.file_index import FileIndex
+
+
+class FileIndexTest(unittest.TestCase):
+    """
+    Test the incremental updates of the persistent file index.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.path, "file_index.sqlite")
+        self.channels = {}
+        for wl in [171, 193]:
+            directory = os.path.join(self.path, str(wl))
+            os.mkdir(directory)
+            for n in range(4):
+                self.write(wl, n)
+            self.channels[f"aia{wl}"] = (directory, f"*aia*{wl}_*.fits")
+        open(os.path.join(self.path, "171", "notes.txt"), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, wl, n):
+        t_rec = datetime.datetime(2010, 12, 21, 0, 3 * n)
+        path = os.path.join(self.path, str(wl), f"{t_rec:%Y%m%d_%H%M%S}_aia_{wl}_4k.fits")
+        with open(path, "wb") as f:
+            f.write(fits_file(t_rec, wl, image_size=16))
+        return path
+
+    def test_update_is_incremental(self):
+        """
+        Check that only changed directories are listed and only new files are added
+        """
+        with FileIndex(self.index_path) as index:
+            stats = index.update(self.channels)
+            self.assertEqual(list(stats.added), [4, 4])
+
+        with FileIndex(self.index_path) as index:
+            self.assertFalse(index.update(self.channels).listed.any())
+
+            self.write(171, 4)
+            os.remove(os.path.join(self.path, "193", "20101221_000000_aia_193_4k.fits"))
+            stats = index.update(self.channels)
+            self.assertEqual(list(stats.listed), [True, True])
+            self.assertEqual(list(stats.added), [1, 0])
+            self.assertEqual(list(stats.removed), [0, 1])
+
+            files = index.files("aia171")
+            self.assertEqual(len(files), 5)
+            self.assertEqual(files.date.iloc[-1], datetime.datetime(2010, 12, 21, 0, 12))
+            self.assertEqual(len(index.files("aia193")), 3)
+
+    def test_quality_checked_once(self):
+        """
+        Check that the quality flag is read once per file and bad files are left out
+        """
+        fits.setval(os.path.join(self.path, "171", "20101221_000300_aia_171_4k.fits"), "QUALITY", value=4, ext=1)
+        with FileIndex(self.index_path) as index:
+            stats = index.update(self.channels, check_fits=True)
+            self.assertEqual(list(stats.checked), [4, 4])
+            self.assertEqual(list(index.update(self.channels, check_fits=True).checked), [0, 0])
+
+            files = index.files("aia171", check_fits=True)
+            self.assertEqual(len(files), 3)
+            self.assertNotIn(os.path.join(self.path, "171", "20101221_000300_aia_171_4k.fits"), list(files.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
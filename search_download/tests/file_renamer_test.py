@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from search_download.file_renamer import compact_filename, rename_filenames
+
+
+class FileRenamerTest(unittest.TestCase):
+    """
+    Test the JSOC filename parser and the batched renamer.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.names = [
+            f"aia.lev1_euv_12s.2010-12-21T{h:02d}0013Z.171.image_lev1.fits" for h in range(10)
+        ]
+        for name in self.names:
+            open(os.path.join(self.path, name), "w").close()
+        self.files = [os.path.join(self.path, name) for name in self.names]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_compact_filename(self):
+        """
+        Check the compact names of the AIA, HMI, spikes and jpg filename patterns
+        """
+        self.assertEqual(
+            compact_filename("aia.lev1_euv_12s.2010-12-21T120013Z.171.image_lev1.fits"),
+            "20101221_120013_aia_171_4k.fits",
+        )
+        self.assertEqual(
+            compact_filename("aia.lev1_euv_12s.2010-12-21T000013Z.171.spikes.fits"),
+            "20101221_000013_aia_171_4k.spikes.fits",
+        )
+        self.assertEqual(
+            compact_filename("hmi.m_720s.20101223_000000_TAI.1.magnetogram.fits"),
+            "20101223_000000_hmi_1_4k.fits",
+        )
+        self.assertEqual(
+            compact_filename("aia.lev1_euv_12s.20101221T000013Z.171.image_lev1.jpg", 304),
+            "20101221_000013_aia_304_4k.jpg",
+        )
+        with self.assertRaises(ValueError):
+            compact_filename("image_lev1.fits")
+
+    def test_dry_run(self):
+        """
+        Check that a dry run returns the mapping and leaves the files alone
+        """
+        table = rename_filenames(self.files, dry_run=True)
+        self.assertEqual(list(table.old), [f.replace("\\", "/") for f in self.files])
+        self.assertEqual(
+            os.path.basename(table.new[1]), "20101221_010013_aia_171_4k.fits"
+        )
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(self.names))
+
+    def test_rename_in_batches(self):
+        """
+        Check that all files are renamed across batches and renamed files are skipped
+        """
+        table = rename_filenames(self.files, max_workers=2, batch_size=3)
+        self.assertTrue(table.error.isna().all())
+        files = sorted(os.listdir(self.path))
+        self.assertEqual(files[0], "20101221_000013_aia_171_4k.fits")
+        self.assertEqual(len(files), len(self.names))
+
+        table = rename_filenames([os.path.join(self.path, f) for f in files])
+        self.assertTrue(table.empty)
+
+    def test_unparsable_names(self):
+        """
+        Check that files whose name cannot be parsed are reported and the others renamed
+        """
+        for name in ["notes.fits", "image_lev1.fits"]:
+            open(os.path.join(self.path, name), "w").close()
+        files = [os.path.join(self.path, "notes.fits")] + self.files + [os.path.join(self.path, "image_lev1.fits")]
+
+        table = rename_filenames(files, dry_run=True)
+        self.assertEqual(len(table), len(self.files) + 2)
+        self.assertEqual(list(table.error.notna()), [True] + [False] * len(self.files) + [True])
+        self.assertTrue(pd.isna(table.new[0]))
+
+        table = rename_filenames(files, batch_size=3)
+        self.assertEqual(table.error.notna().sum(), 2)
+        self.assertIn("notes.fits", table.error[0])
+        files = sorted(os.listdir(self.path))
+        self.assertEqual(files[:2], ["20101221_000013_aia_171_4k.fits", "20101221_010013_aia_171_4k.fits"])
+        self.assertEqual(files[-2:], ["image_lev1.fits", "notes.fits"])
+
+
+if __name__ == "__main__":
+    unittest.main()
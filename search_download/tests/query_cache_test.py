@@ -0,0 +1,100 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from search_download.downloader import Downloader
+from search_download.query_cache import QueryCache
+from search_download.tests.fake_drms import FakeClient
+
+
+class QueryCacheTest(unittest.TestCase):
+    """
+    Test the persistent query cache with a fake drms client.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.path, "query_cache.sqlite")
+        self.client = FakeClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_downloader(self, sdate="2010-12-21T00:00:00", edate="2010-12-22T00:00:00", **kwargs):
+        return Downloader(
+            sdate=sdate,
+            edate=edate,
+            wavelength=[171, 193],
+            instrument="aia",
+            cadence="12h",
+            file_format="fits",
+            path=self.path,
+            client=self.client,
+            **kwargs,
+        )
+
+    def test_repeated_queries_hit_cache(self):
+        """
+        Check that a second run, even from a new Downloader, answers from disk
+        """
+        first = self.make_downloader(query_cache=self.cache_path).create_query_request()
+        second = self.make_downloader(query_cache=self.cache_path).create_query_request()
+
+        self.assertEqual(len(self.client.queries), 2)
+        for a, b in zip(first, second):
+            self.assertEqual(list(a.T_REC), list(b.T_REC))
+
+    def test_ttl(self):
+        """
+        Check that recent ranges expire while settled ranges are kept forever
+        """
+        today = datetime.date.today().isoformat() + "T00:00:00"
+        cache = QueryCache(self.cache_path, ttl=0)
+        self.make_downloader(today, today, query_cache=cache).create_query_request()
+        self.make_downloader(today, today, query_cache=cache).create_query_request()
+        self.assertEqual(len(self.client.queries), 4)
+
+        self.make_downloader(query_cache=cache).create_query_request()
+        self.make_downloader(query_cache=cache).create_query_request()
+        self.assertEqual(len(self.client.queries), 6)
+
+    def test_connections_closed(self):
+        """
+        Check that every connection opened by the cache is closed after use
+        """
+        connections = []
+        connect = sqlite3.connect
+
+        def tracked_connect(*args, **kwargs):
+            connections.append(connect(*args, **kwargs))
+            return connections[-1]
+
+        with mock.patch("search_download.query_cache.sqlite3.connect", side_effect=tracked_connect):
+            cache = QueryCache(self.cache_path)
+            self.make_downloader(query_cache=cache).create_query_request()
+            self.make_downloader(query_cache=cache).create_query_request()
+        self.assertEqual(len(connections), 7)
+        for connection in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute("SELECT 1")
+
+    def test_key_list(self):
+        """
+        Check that the key list is part of the cache key
+        """
+        self.assertEqual(
+            QueryCache.cache_key("aia.lev1_euv_12s[2010-12-21]", "T_REC, QUALITY"),
+            QueryCache.cache_key("aia.lev1_euv_12s[2010-12-21]", ["t_rec", "quality"]),
+        )
+        self.assertNotEqual(
+            QueryCache.cache_key("aia.lev1_euv_12s[2010-12-21]", "t_rec"),
+            QueryCache.cache_key("aia.lev1_euv_12s[2010-12-21]", "t_rec,quality"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from search_download.utils import scandir_walker
+from search_download.utils.scandir_walker import list_files, walk_files
+
+
+class SlowStatEntry:
+    """
+    os.DirEntry wrapper whose stat takes a millisecond, like on a network filesystem, and
+    records the thread it ran on
+    """
+
+    def __init__(self, entry, threads):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.threads = threads
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self):
+        return self.entry.is_file()
+
+    def stat(self):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.001)
+        return self.entry.stat()
+
+
+class SlowStatScandir:
+    """
+    os.scandir replacement that lists SlowStatEntry objects
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.scandir = os.scandir
+
+    def __call__(self, directory):
+        self.entries = self.scandir(directory)
+        return self
+
+    def __enter__(self):
+        return (SlowStatEntry(entry, self.threads) for entry in self.entries)
+
+    def __exit__(self, *args):
+        self.entries.close()
+
+
+class ScandirWalkerTest(unittest.TestCase):
+    """
+    Test the parallel scandir walker on a small tree.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp().replace("\\", "/")
+        self.files = []
+        for folder in ["171", "193", "193/backup"]:
+            os.makedirs(os.path.join(self.path, folder))
+            for n in range(5):
+                for extension in ["fits", "jpg"]:
+                    self.files.append(f"{self.path}/{folder}/{n:04d}.{extension}")
+                    open(self.files[-1], "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_walk_recursive(self):
+        """
+        Check that all matching files are found, across chunks and subdirectories
+        """
+        files = list_files(self.path, "*.fits", recursive=True, max_workers=2, chunk_size=2)
+        self.assertEqual(files, sorted(f for f in self.files if f.endswith(".fits")))
+        self.assertEqual(list_files(self.path, ["*.fits", "*.jpg"], recursive=True), sorted(self.files))
+
+    def test_walk_one_level(self):
+        """
+        Check that only the files of root are listed with their stat cached
+        """
+        entries = list(walk_files(f"{self.path}/193", "0001.*"))
+        self.assertEqual(sorted(entry.name for entry in entries), ["0001.fits", "0001.jpg"])
+        self.assertTrue(all(entry.stat().st_size == 0 for entry in entries))
+
+    def test_flat_directory_stat_in_parallel(self):
+        """
+        Check that the entries of a single flat directory are stat'ed by several threads
+        """
+        flat = f"{self.path}/flat"
+        os.makedirs(flat)
+        for n in range(400):
+            open(f"{flat}/{n:04d}.fits", "w").close()
+
+        threads = set()
+        with mock.patch.object(scandir_walker.os, "scandir", SlowStatScandir(threads)):
+            entries = list(walk_files(flat, "*.fits", max_workers=4, chunk_size=50))
+        self.assertEqual(len(entries), 400)
+        self.assertGreater(len(threads), 1)
+        self.assertTrue(all(name.startswith("stat") for name in threads))
+
+    def test_missing_and_early_stop(self):
+        """
+        Check that a missing root yields nothing and that a walk can be abandoned
+        """
+        self.assertEqual(list_files(f"{self.path}/211"), [])
+        walk = walk_files(self.path, recursive=True, chunk_size=1)
+        self.assertTrue(next(walk).is_file())
+        walk.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
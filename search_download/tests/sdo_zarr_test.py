@@ -0,0 +1,247 @@
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from search_download.sdo_zarr import (ChunkWriteBuffer, append_dates, create_sdo_store, ingest_frames,
+                                      block_average, channel_scale_offset, open_sdo_store, sample_stacks,
+                                      select_level, select_valid_frames, write_checkpoint)
+from search_download.zarr_benchmark import create_store, synthetic_frame
+
+
+def partially_failing_frame(frame):
+    """
+    Synthetic stack whose last channel fails on odd frames and is blank on frame 4
+    """
+    stack, meta = synthetic_frame(frame, n_channels=3, image_size=16, work=0)
+    if frame == 4:
+        stack[2] = np.nan
+    return stack, meta, np.array([True, True, frame % 2 == 0])
+
+
+class SdoZarrTest(unittest.TestCase):
+    """
+    Test the parallel ingestion of synthetic stacks into a zarr store.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.load_frame = partial(synthetic_frame, n_channels=3, image_size=16, work=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_ingest_frames(self):
+        """
+        Check that every frame lands at its time index across chunks and workers
+        """
+        frames = list(range(10))
+        array = create_store(self.path, len(frames), 3, 16, time_chunk_size=3)
+        metas, stats = ingest_frames(self.path, "stacks", frames, self.load_frame, max_workers=2, max_pending=2,
+                                     return_stats=True)
+        self.assertEqual([meta["frame"] for meta in metas], frames)
+        self.assertEqual(stats["chunks"], 4 * 3)
+        self.assertEqual(stats["write_amplification"], 1)
+        for frame in [0, 4, 9]:
+            np.testing.assert_array_equal(array[frame], self.load_frame(frame)[0])
+
+    def test_failed_frames(self):
+        """
+        Check that a failed frame is left empty without stopping its chunk
+        """
+        frames = [0, -1, 2, 3]
+        array = create_store(self.path, len(frames), 3, 16, time_chunk_size=2)
+        metas = ingest_frames(self.path, "stacks", frames, self.load_frame, max_workers=2, processes=False)
+        self.assertIsNone(metas[1])
+        self.assertEqual(metas[2]["frame"], 2)
+        self.assertTrue((array[1] == 0).all())
+        np.testing.assert_array_equal(array[3], self.load_frame(3)[0])
+
+    def test_write_buffer(self):
+        """
+        Check that complete chunks are written once and that the memory budget forces
+        incomplete chunks out without losing data
+        """
+        array = create_store(self.path, 8, 3, 16, time_chunk_size=4)
+        frames = {frame: self.load_frame(frame)[0] for frame in range(8)}
+
+        buffer = ChunkWriteBuffer(array)
+        for frame in [1, 0, 3, 2]:
+            buffer.write(frame, frames[frame])
+        self.assertEqual(buffer.summary()["chunk_writes"], 3)
+        self.assertFalse(buffer.slabs)
+
+        buffer = ChunkWriteBuffer(array, max_bytes=frames[0].nbytes * 4)
+        for frame in [4, 6, 0, 7, 5]:
+            buffer.write(frame, frames[frame])
+        buffer.flush()
+        summary = buffer.summary()
+        self.assertGreater(summary["partial_flushes"], 0)
+        self.assertGreater(summary["write_amplification"], 1)
+        for frame in [0, 4, 5, 6, 7]:
+            np.testing.assert_array_equal(array[frame], frames[frame])
+
+    def ingest(self, root, frames, indices):
+        completed = root["completed"][:]
+        todo = [i for i in range(len(frames)) if indices[i] >= 0 and not completed[indices[i]]]
+        ingest_frames(self.path, "stacks", [frames[i] for i in todo], self.load_frame,
+                      indices=[indices[i] for i in todo], max_workers=2, processes=False,
+                      checkpoint=partial(write_checkpoint, root, "stacks"), checkpoint_every=1)
+        return todo
+
+    def test_resume_and_append(self):
+        """
+        Check that a rerun only writes the failed frame, that appending grows every array
+        along t_obs, and that the store still opens with xarray
+        """
+        dates = pd.date_range("2010-12-21", periods=6, freq="3min")
+        frames = [0, 1, -2, 3, 4, 5]
+        root = create_sdo_store(self.path, "stacks", dates, ["a", "b", "c"], 16, time_chunk_size=4)
+        self.assertEqual(self.ingest(root, frames, np.arange(6)), list(range(6)))
+        self.assertEqual(list(root["completed"][:]), [True, True, False, True, True, True])
+        np.testing.assert_array_equal(root["frame"][:], [0, 1, np.iinfo("i8").min, 3, 4, 5])
+
+        frames[2] = 2
+        self.assertEqual(self.ingest(root, frames, np.arange(6)), [2])
+        self.assertTrue(root["completed"][:].all())
+
+        new_dates = dates.append(pd.date_range("2010-12-21 00:18", periods=3, freq="3min"))
+        indices = append_dates(root, "stacks", new_dates[[0, 6, 7, 8]])
+        np.testing.assert_array_equal(indices, [0, 6, 7, 8])
+        self.assertEqual(self.ingest(root, [0, 6, 7, 8], indices), [1, 2, 3])
+        self.assertEqual(root["stacks"].shape[0], 9)
+        np.testing.assert_array_equal(root["frame"][:], np.arange(9))
+        np.testing.assert_array_equal(root["stacks"][7], self.load_frame(7)[0])
+
+        ds = xr.open_zarr(self.path)
+        self.assertEqual(ds.stacks.shape, (9, 3, 16, 16))
+        self.assertTrue(ds.completed.values.all())
+        np.testing.assert_array_equal(ds.dates.values, new_dates.to_numpy())
+        np.testing.assert_array_equal(ds.t_obs.values, new_dates.to_numpy())
+        self.assertIn("frame", ds.coords)
+        np.testing.assert_array_equal(ds.frame.values, np.arange(9))
+
+    def test_append_earlier_and_gap_dates(self):
+        """
+        Check that dates before the store raise, and that gaps inside it are skipped
+        """
+        dates = pd.date_range("2010-12-21", periods=6, freq="6min")
+        root = create_sdo_store(self.path, "stacks", dates, ["a", "b", "c"], 16)
+
+        earlier = pd.DatetimeIndex(["2010-12-20 23:54"]).append(dates)
+        with self.assertRaises(ValueError):
+            append_dates(root, "stacks", earlier)
+        self.assertEqual(root["stacks"].shape[0], 6)
+
+        with self.assertLogs("search_download.sdo_zarr", level="WARNING"):
+            indices = append_dates(root, "stacks", pd.DatetimeIndex(["2010-12-21 00:03", "2010-12-21 00:36"]))
+        np.testing.assert_array_equal(indices, [-1, 6])
+
+    def test_header_columns(self):
+        """
+        Check that header values are stored in typed arrays that are widened when a value
+        does not fit, and are read back by xarray as coordinates with missing values masked
+        """
+        dates = pd.date_range("2010-12-21", periods=4, freq="3min")
+        root = create_sdo_store(self.path, "stacks", dates, ["a"], 4)
+        write_checkpoint(root, "stacks", [0, 1], [{"naxis": 4, "crpix1": 2, "origin": "SDO", "date-obs": "a"},
+                                                 {"naxis": 4, "crpix1": 2, "origin": "SDO"}])
+        self.assertEqual(root["naxis"].dtype, np.dtype("i8"))
+        self.assertEqual(root["crpix1"].dtype, np.dtype("i8"))
+        self.assertEqual(root["origin"].dtype.kind, "U")
+        self.assertEqual(root["date_obs"].attrs["header_key"], "date-obs")
+
+        write_checkpoint(root, "stacks", [3], [{"naxis": 4, "crpix1": 2.5, "origin": "x" * 40}])
+        self.assertEqual(root["crpix1"].dtype, np.dtype("f8"))
+        self.assertEqual(root["origin"][3], "x" * 40)
+
+        ds = xr.open_zarr(self.path)
+        self.assertEqual(set(ds.coords), {"t_obs", "channel", "dates", "completed", "valid", "naxis", "crpix1",
+                                          "origin", "date_obs"})
+        np.testing.assert_array_equal(ds.crpix1.values, [2, 2, np.nan, 2.5])
+        np.testing.assert_array_equal(ds.naxis.values, [4, 4, np.nan, 4])
+        self.assertEqual(list(ds.completed.values), [True, True, False, True])
+
+    def test_valid_frames(self):
+        """
+        Check that the validity of every channel is stored, failed frames included, and that
+        valid frames are selected without loading the stacks
+        """
+        dates = pd.date_range("2010-12-21", periods=6, freq="3min")
+        root = create_sdo_store(self.path, "stacks", dates, ["a", "b", "c"], 16, time_chunk_size=2)
+        ingest_frames(self.path, "stacks", [0, 1, 2, 3, 4, -5], partially_failing_frame, max_workers=2,
+                      processes=False, checkpoint=partial(write_checkpoint, root, "stacks"))
+        valid = root["valid"][:]
+        np.testing.assert_array_equal(valid[:, 0], [True] * 5 + [False])
+        np.testing.assert_array_equal(valid[:, 2], [True, False, True, False, False, False])
+        self.assertEqual(list(root["completed"][:]), [True] * 5 + [False])
+
+        ds = xr.open_zarr(self.path)
+        np.testing.assert_array_equal(select_valid_frames(ds).t_obs.values, dates[[0, 2]].to_numpy())
+        stacks = select_valid_frames(ds.stacks.loc[:, ["a", "b"]])
+        self.assertIsNotNone(stacks.data.dask)
+        self.assertEqual(stacks.shape, (5, 2, 16, 16))
+        self.assertEqual(select_valid_frames(ds, ["c"], require_all=False).sizes["t_obs"], 2)
+
+    def test_pyramid_levels(self):
+        """
+        Check that the pyramid levels are block averages of the stacks, chunked like them,
+        and that the reader picks the coarsest level covering the requested size
+        """
+        dates = pd.date_range("2010-12-21", periods=5, freq="3min")
+        root = create_sdo_store(self.path, "stacks", dates, ["a", "b", "c"], 16, time_chunk_size=2,
+                                space_chunk_size=4, pyramid_levels=[8, 2, 4])
+        self.assertEqual(root["stacks"].chunks, (2, 1, 4, 4))
+        self.assertEqual(root["stacks_8x"].chunks, (2, 1, 2, 2))
+        ingest_frames(self.path, "stacks", [0, 1, -2, 3, 4], self.load_frame, max_workers=2, processes=False,
+                      checkpoint=partial(write_checkpoint, root, "stacks"))
+        stack = self.load_frame(3)[0]
+        np.testing.assert_allclose(root["stacks_2x"][3], stack.reshape(3, 8, 2, 8, 2).mean(axis=(2, 4)), rtol=1e-6)
+        np.testing.assert_allclose(root["stacks_8x"][3], block_average(stack, 8), rtol=1e-6)
+        self.assertTrue((root["stacks_4x"][2] == 0).all())
+
+        ds = xr.open_zarr(self.path)
+        self.assertEqual(select_level(ds, "stacks", 3).name, "stacks_4x")
+        self.assertEqual(select_level(ds, "stacks", 2).name, "stacks_8x")
+        self.assertEqual(select_level(ds, "stacks", 9).name, "stacks")
+        self.assertEqual(select_level(ds, "stacks").name, "stacks")
+        self.assertEqual(select_valid_frames(select_level(ds, "stacks", 4)).shape, (4, 3, 4, 4))
+
+        with self.assertRaises(ValueError):
+            create_sdo_store(self.path, "stacks", dates, ["a"], 16, pyramid_levels=[3, 4])
+
+    def test_encodings(self):
+        """
+        Check that float16 and int16 stacks, and their pyramid levels, are read back as floats
+        close to the originals through open_sdo_store, with failed frames as NaN for int16
+        """
+        dates = pd.date_range("2010-12-21", periods=4, freq="3min")
+        frames = [0, 1, -2, 3]
+        stacks = sample_stacks(frames, self.load_frame, n_samples=4)
+        self.assertEqual(stacks.shape, (3, 3, 16, 16))
+        scale, offset = channel_scale_offset(stacks)
+
+        for encoding, dtype, rtol in [("float16", np.float16, 1e-3), ("int16", np.float32, 1e-3)]:
+            root = create_sdo_store(self.path, "stacks", dates, ["a", "b", "c"], 16, time_chunk_size=2,
+                                    pyramid_levels=[2], encoding=encoding, channel_scale=scale,
+                                    channel_offset=offset)
+            ingest_frames(self.path, "stacks", frames, self.load_frame, processes=False,
+                          checkpoint=partial(write_checkpoint, root, "stacks"))
+            ds = open_sdo_store(self.path)
+            self.assertEqual(ds.stacks.dtype, dtype)
+            np.testing.assert_allclose(ds.stacks[3].values, self.load_frame(3)[0], rtol=rtol)
+            np.testing.assert_allclose(ds.stacks_2x[1].values, block_average(self.load_frame(1)[0], 2), rtol=rtol)
+            self.assertEqual(select_valid_frames(ds).sizes["t_obs"], 3)
+
+        self.assertEqual(root["stacks"].dtype, np.dtype("i2"))
+        self.assertTrue(np.isnan(ds.stacks[2].values).all())
+        with self.assertRaises(ValueError):
+            create_sdo_store(self.path, "stacks", dates, ["a"], 16, encoding="int16")
+
+
+if __name__ == "__main__":
+    unittest.main()
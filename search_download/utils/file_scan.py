@@ -0,0 +1,195 @@
+"""
+Helpers shared by the file indexers (concurrent_file_indexer and file_index): parsing the date
+in the name of the AIA and HMI files, and scanning the headers of many fits files for their
+QUALITY flag.
+
+"""
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+import dateutil.parser as dt
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def _filename_to_date(data_filename):
+    """ Takes a single path to an AIA or HMI file and returns its associated date   
+    Assumes that the files have the date within their name in the following format:
+        YYYYMMDD_hhmmss
+
+    Parameters
+    ----------
+    data_filename: str
+        path to an HMI or AIA file
+    Returns
+    -------
+    dt.datetime associated with the file    
+    """
+    try:
+        date_string = re.search(r"\d{8}_\d{6}(?!.+\d{8}_\d{6}.+)", data_filename).group().replace('_', 'T')
+    except:
+        date_string = data_filename.split("_")[-1].split('.')[0]
+    
+    return dt.isoparse(date_string)
+
+
+# Last YYYYMMDD_hhmmss token of a path, the same one _filename_to_date picks
+DATE_TOKEN_PATTERN = r"(\d{8}_\d{6})(?!.+\d{8}_\d{6}.+)"
+
+
+def channel_filenames_to_dates(data_filenames, errors='raise'):
+    """ Vectorized version of _filename_to_date for the files of one channel.  The date
+    token of every path is extracted with pandas string operations and parsed with a single
+    ISO 8601 to_datetime call.  Names without a token fall back to _filename_to_date,
+    so the results are the same.
+
+    Parameters
+    ----------
+    data_filenames: list
+        paths of the AIA or HMI files of a channel
+    errors: str
+        'raise' to raise a single ValueError listing every unparseable name, 'coerce' to
+        log them and return NaT in their place
+
+    Returns
+    -------
+    pd.DatetimeIndex with the date of every file
+    """
+    files = pd.Series(data_filenames, dtype=object)
+    tokens = files.str.extract(DATE_TOKEN_PATTERN, expand=False).str.replace('_', 'T', regex=False)
+    # YYYYMMDDThhmmss is basic ISO 8601, which pandas parses in C
+    dates = pd.to_datetime(tokens, format='ISO8601', errors='coerce')
+
+    unparseable = []
+    for i in np.flatnonzero(dates.isna().to_numpy()):
+        try:
+            dates.iloc[i] = _filename_to_date(files.iloc[i])
+        except (ValueError, OverflowError):
+            unparseable.append(files.iloc[i])
+
+    if unparseable:
+        message = f'{len(unparseable)} of {len(files)} filenames have no parseable date, e.g. {unparseable[0:5]}'
+        if errors == 'raise':
+            raise ValueError(message)
+        logger.warning(message)
+
+    return pd.DatetimeIndex(dates)
+
+
+def filenames_to_dates(data_filenames, debug=False, errors='raise'):
+    """ load dates from filenames for both AIA and HMI. it    
+    Assumes that the files have the date within their name in the following format:
+        YYYYMMDD_hhmmss
+
+    Parameters
+    ----------
+    data_filenames: List of Lists
+        path names of the AIA files as a list of list, with each list in the list corresponding to
+        an AIA wavelength.  In the case of HMI it should be a list of lists with a single list of hmi files.
+    debug: 
+        if True select only the first 10 dates.
+    errors: 
+        'raise' or 'coerce', see channel_filenames_to_dates
+
+    Returns
+    -------
+    List of pd.DatetimeIndex with files converted to datetimes, one per list of files.
+    """
+    iso_dates = [channel_filenames_to_dates(wl_files, errors=errors) for wl_files in data_filenames]
+    return iso_dates
+
+
+# Keywords collected by scan_fits_quality
+QUALITY_KEYWORDS = ['QUALITY', 'T_REC', 'T_OBS', 'WAVELNTH', 'EXPTIME', 'PERCENTD']
+
+
+def read_fits_header(filepath):
+    """ Read the header of the image HDU of a fits file without reading the image.  AIA
+    level 1 files keep the image in a compressed HDU after an empty primary HDU, whose
+    header astropy reads without decompressing the data.
+
+    Parameters
+    ----------
+    filepath: path to an AIA or HMI fits file
+
+    Returns
+    -------
+    astropy.io.fits.Header
+    """
+    with fits.open(filepath, lazy_load_hdus=True) as hdul:
+        header = hdul[0].header
+        if 'QUALITY' not in header:
+            try:
+                header = hdul[1].header
+            except IndexError:
+                pass
+    return header
+
+
+def scan_fits_batch(files, keywords):
+    """ Read the keywords of a batch of fits files
+
+    Parameters
+    ----------
+    files: list of fits paths
+    keywords: list of header keywords to read
+
+    Returns
+    -------
+    list with one row per file: the keyword values (None if missing) followed by the
+    error message of files that could not be read.  Any error of astropy on a corrupt
+    file is reported in its row, so one bad file does not abort the scan
+    """
+    rows = []
+    for file in files:
+        try:
+            header = read_fits_header(file)
+            rows.append([header.get(keyword) for keyword in keywords] + [None])
+        except Exception as e:
+            rows.append([None] * len(keywords) + [f'{type(e).__name__}: {e}'])
+    return rows
+
+
+def scan_fits_quality(files, keywords=None, batch_size=256, max_workers=None, processes=False):
+    """ Scan the headers of many fits files for QUALITY and related keywords.  Files are
+    read in batches on a thread pool (or a process pool if the header parsing is the
+    bottleneck rather than the file system), so there is one task per batch, not per file.
+
+    Parameters
+    ----------
+    files: list of fits paths
+    keywords: header keywords to read, defaults to QUALITY_KEYWORDS
+    batch_size: number of files read by each task
+    max_workers: number of workers of the pool
+    processes: if True, use a process pool instead of a thread pool
+
+    Returns
+    -------
+    pandas df with one row per file: the file, the keyword values and the error of files
+    that could not be read
+    """
+    keywords = QUALITY_KEYWORDS if keywords is None else list(keywords)
+    files = list(files)
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    rows = []
+    with executor(max_workers=max_workers) as pool, \
+            tqdm(total=len(files), desc="Checking quality flag for all files") as progress:
+        for batch_rows in pool.map(scan_fits_batch, batches, repeat(keywords)):
+            rows += batch_rows
+            progress.update(len(batch_rows))
+
+    table = pd.DataFrame(rows, columns=keywords + ['error'])
+    table.insert(0, 'file', files)
+    return table
+
+
+def get_fits_quality(filepath):
+    return read_fits_header(filepath).get("QUALITY") == 0
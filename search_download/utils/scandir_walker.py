@@ -0,0 +1,173 @@
+"""
+Directory walker built on os.scandir for archives with millions of files per directory, often on
+network filesystems.  Directories are scanned in parallel, names are filtered while the listing
+streams, and matching entries are yielded in chunks as soon as they are found, with their stat
+data already cached, instead of materializing the whole listing first like glob does.  Chunks are
+stat'ed on their own pool, so even a single flat directory is stat'ed by several threads.
+
+"""
+import logging
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the scan of one directory in the results queue
+_DONE = object()
+
+
+def compile_patterns(patterns=None):
+    """
+    Match function of one or several fnmatch patterns
+
+    Parameters:
+        patterns: (str or list)
+            fnmatch patterns of the file names, all names if None
+
+    Returns:
+        match: (function)
+            Returns a match object for names matching any pattern, None otherwise
+    """
+    if patterns is None:
+        patterns = ["*"]
+    elif isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile("|".join(f"(?:{translate(pattern)})" for pattern in patterns)).match
+
+
+def walk_files(
+    root: str = None,
+    patterns=None,
+    recursive: bool = False,
+    stat: bool = True,
+    max_workers: int = 8,
+    chunk_size: int = 1024,
+):
+    """
+    Lazily yield the files under root whose name matches a pattern.  Each directory is
+    scanned by a task on a thread pool, so subdirectories are listed in parallel.  Every
+    chunk of matching entries is stat'ed by a task on a second pool while the listing goes
+    on, so the stat calls of a single directory run in parallel too.  The order of the
+    entries is not defined.  Directories that cannot be read, including a missing root,
+    are logged and skipped like os.walk does.
+
+    Parameters:
+        root: (str)
+            Directory to walk
+        patterns: (str or list)
+            fnmatch patterns of the file names, all files if None
+        recursive: (bool)
+            Whether to walk the subdirectories of root
+        stat: (bool)
+            Whether to stat the matching entries in the pool, so entry.stat() is cached
+        max_workers: (int)
+            Number of directories scanned at the same time, and of chunks stat'ed at the
+            same time
+        chunk_size: (int)
+            Number of entries stat'ed by a task and handed over from the pools at a time
+
+    Returns:
+        entries: (generator)
+            os.DirEntry of every matching file
+    """
+    match = compile_patterns(patterns)
+    results = queue.Queue(maxsize=max(2, 4 * max_workers))
+    stop = threading.Event()
+    pending_lock = threading.Lock()
+    pending = [1]  # Scan and stat tasks that have not put _DONE yet
+    # Chunks submitted to the stat pool and not handed over yet, bounded like the results
+    stat_slots = threading.Semaphore(max(2, 4 * max_workers))
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def stat_chunk(chunk):
+        try:
+            for entry in chunk:
+                if stop.is_set():
+                    return
+                try:
+                    entry.stat()
+                except OSError:
+                    pass  # Removed since it was listed, entry.stat() raises again for the caller
+            put(chunk)
+        finally:
+            stat_slots.release()
+            put(_DONE)
+
+    def hand_over(chunk):
+        if not chunk:
+            return
+        if not stat:
+            put(chunk)
+            return
+        while not stat_slots.acquire(timeout=0.1):
+            if stop.is_set():
+                return
+        with pending_lock:
+            pending[0] += 1
+        stat_pool.submit(stat_chunk, chunk)
+
+    def scan(directory):
+        try:
+            chunk = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if stop.is_set():
+                        return
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            with pending_lock:
+                                pending[0] += 1
+                            pool.submit(scan, entry.path)
+                    elif match(entry.name) and entry.is_file():
+                        chunk.append(entry)
+                        if len(chunk) >= chunk_size:
+                            hand_over(chunk)
+                            chunk = []
+            hand_over(chunk)
+        except OSError as e:
+            logger.warning(f"Skipping {directory}: {e}")
+        finally:
+            put(_DONE)
+
+    # Stat tasks get their own pool, so they never wait behind scan tasks that wait for them
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan")
+    stat_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stat")
+    try:
+        pool.submit(scan, root)
+        while True:
+            item = results.get()
+            if item is _DONE:
+                with pending_lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        break
+                continue
+            yield from item
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        stat_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def list_files(root: str = None, patterns=None, recursive: bool = False, **kwargs):
+    """
+    Sorted paths of the files under root whose name matches a pattern, see walk_files
+
+    Returns:
+        paths: (list)
+            Paths with forward slashes
+    """
+    return sorted(
+        entry.path.replace("\\", "/") for entry in walk_files(root, patterns, recursive, stat=False, **kwargs)
+    )
@@ -0,0 +1,254 @@
+"""
+Benchmark of the parallel zarr ingestion (see sdo_zarr.py) with synthetic stacks, so that the
+scaling with the number of workers can be measured without FITS files or the preprocessing
+dependencies.
+
+Example:
+python -m search_download.zarr_benchmark --n_frames 256 --workers 1 2 4 8 --image_size 1024
+
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+
+from search_download.sdo_zarr import ChunkWriteBuffer, create_sdo_store, ingest_frames, select_level
+
+
+def synthetic_frame(frame: int, n_channels: int = 4, image_size: int = 256, work: int = 1):
+    """
+    Synthetic stack of a time index, with a configurable amount of CPU work standing in for
+    the decompression and preprocessing of real files
+
+    Parameters:
+        frame: (int)
+            Time index, negative indices raise a ValueError like a failed file
+        n_channels: (int)
+            Number of channels
+        image_size: (int)
+            Pixels on a side
+        work: (int)
+            Number of FFT round trips of every channel
+
+    Returns:
+        stack: (numpy.ndarray)
+            (n_channels, image_size, image_size) float32 array
+        meta: (dict)
+            t_obs and frame of the stack
+    """
+    if frame < 0:
+        raise ValueError(f"Cannot load frame {frame}")
+    rng = np.random.default_rng(frame)
+    stack = rng.normal(100, 10, (n_channels, image_size, image_size))
+    for _ in range(work):
+        stack = np.fft.irfft2(np.fft.rfft2(stack), s=stack.shape[1:])
+    t_obs = pd.Timestamp("2010-12-21") + pd.Timedelta(minutes=3 * frame)
+    return stack.astype(np.float32), {"t_obs": t_obs.strftime("%Y-%m-%dT%H:%M:%S.%f"), "frame": frame}
+
+
+def create_store(path: str, n_frames: int, n_channels: int, image_size: int, time_chunk_size: int = 1):
+    """
+    Empty store with a (time, channel, y, x) stacks array like the one fits_to_zarr creates
+
+    Returns:
+        array: (zarr.Array)
+    """
+    root = zarr.group(store=zarr.DirectoryStore(path), overwrite=True)
+    return root.create_dataset(
+        "stacks",
+        shape=(n_frames, n_channels, image_size, image_size),
+        chunks=(time_chunk_size, 1, None, None),
+        dtype="f4",
+        compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    )
+
+
+def benchmark_ingest(n_frames: int = 64, workers: list = None, n_channels: int = 4, image_size: int = 256,
+                     time_chunk_size: int = 1, work: int = 1):
+    """
+    Time the ingestion of n_frames synthetic stacks with each number of workers
+
+    Parameters:
+        n_frames: (int)
+            Number of time indices
+        workers: (list)
+            Numbers of worker processes
+        n_channels: (int)
+            Number of channels
+        image_size: (int)
+            Pixels on a side
+        time_chunk_size: (int)
+            Size of the time chunks of the array
+        work: (int)
+            CPU work per stack, see synthetic_frame
+
+    Returns:
+        results: (pandas.DataFrame)
+            Seconds, frames per second and speedup over the first number of workers
+    """
+    workers = [1, 2, 4] if workers is None else workers
+    load_frame = partial(synthetic_frame, n_channels=n_channels, image_size=image_size, work=work)
+    results = []
+    for n_workers in workers:
+        path = tempfile.mkdtemp()
+        try:
+            create_store(path, n_frames, n_channels, image_size, time_chunk_size)
+            start = time.perf_counter()
+            ingest_frames(path, "stacks", list(range(n_frames)), load_frame, max_workers=n_workers)
+            seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(path)
+        results.append({"workers": n_workers, "n_frames": n_frames, "seconds": seconds,
+                        "frames_per_s": n_frames / seconds})
+    results = pd.DataFrame(results)
+    results["speedup"] = results.seconds.iloc[0] / results.seconds
+    return results
+
+
+def benchmark_write_buffer(n_frames: int = 64, n_channels: int = 4, image_size: int = 256,
+                           time_chunk_size: int = 8):
+    """
+    Time writing n_frames stacks one time index at a time directly to the array and through a
+    ChunkWriteBuffer
+
+    Parameters:
+        n_frames: (int)
+            Number of time indices
+        n_channels: (int)
+            Number of channels
+        image_size: (int)
+            Pixels on a side
+        time_chunk_size: (int)
+            Size of the time chunks of the array
+
+    Returns:
+        result: (dict)
+            Seconds of each approach and the write amplification of the buffer
+    """
+    stacks = [synthetic_frame(frame, n_channels, image_size, work=0)[0] for frame in range(n_frames)]
+    path = tempfile.mkdtemp()
+    try:
+        array = create_store(path, n_frames, n_channels, image_size, time_chunk_size)
+        start = time.perf_counter()
+        for frame, stack in enumerate(stacks):
+            array[frame] = stack
+        direct_seconds = time.perf_counter() - start
+
+        array = create_store(path, n_frames, n_channels, image_size, time_chunk_size)
+        buffer = ChunkWriteBuffer(array)
+        start = time.perf_counter()
+        for frame, stack in enumerate(stacks):
+            buffer.write(frame, stack)
+        buffer.flush()
+        buffered_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(path)
+
+    return {
+        "time_chunk_size": time_chunk_size,
+        "n_frames": n_frames,
+        "direct_seconds": direct_seconds,
+        "direct_write_amplification": min(time_chunk_size, n_frames),
+        "buffered_seconds": buffered_seconds,
+        "buffered_write_amplification": buffer.summary()["write_amplification"],
+        "speedup": direct_seconds / buffered_seconds,
+    }
+
+
+def benchmark_reads(n_frames: int = 16, image_size: int = 1024, space_chunk_size: int = 256,
+                    thumbnail_size: int = 128, cutout_size: int = 64):
+    """
+    Time reading thumbnails and small cutouts of n_frames synthetic stacks from stores with
+    whole-image chunks and no pyramid, and with spatial chunks and 2x, 4x and 8x levels
+
+    Parameters:
+        n_frames: (int)
+            Number of time indices
+        image_size: (int)
+            Pixels on a side
+        space_chunk_size: (int)
+            Size of the spatial chunks of the chunked store
+        thumbnail_size: (int)
+            Pixels on a side of the thumbnails
+        cutout_size: (int)
+            Pixels on a side of the cutouts
+
+    Returns:
+        results: (pandas.DataFrame)
+            Seconds of each read with each layout
+    """
+    load_frame = partial(synthetic_frame, n_channels=4, image_size=image_size, work=0)
+    dates = pd.date_range("2010-12-21", periods=n_frames, freq="3min")
+    results = []
+    for space_chunks, levels in [(None, []), (space_chunk_size, [2, 4, 8])]:
+        path = tempfile.mkdtemp()
+        try:
+            create_sdo_store(path, "stacks", dates, ["a", "b", "c", "d"], image_size, space_chunk_size=space_chunks,
+                             pyramid_levels=levels, compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE))
+            ingest_frames(path, "stacks", list(range(n_frames)), load_frame, processes=False)
+            data = xr.open_zarr(path)
+
+            start = time.perf_counter()
+            select_level(data, "stacks", thumbnail_size).compute()
+            thumbnail_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            data.stacks[:, :, 0:cutout_size, 0:cutout_size].compute()
+            cutout_seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(path)
+        results.append({"space_chunk_size": space_chunks, "pyramid_levels": levels,
+                        "thumbnail_seconds": thumbnail_seconds, "cutout_seconds": cutout_seconds})
+    return pd.DataFrame(results)
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments to script.
+
+    Parameters:
+        args (list):    defaults to parsing any command line arguments
+
+    Returns:
+        parser args:    Namespace from argparse
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_frames", type=int, default=64, help="Number of time indices")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of worker processes")
+    parser.add_argument("--n_channels", type=int, default=4, help="Number of channels")
+    parser.add_argument("--image_size", type=int, default=256, help="Pixels on a side")
+    parser.add_argument("--time_chunk_size", type=int, default=1, help="Size of the time chunks")
+    parser.add_argument("--work", type=int, default=1, help="FFT round trips per channel standing in for preprocessing")
+    parser.add_argument("--space_chunk_size", type=int, default=None,
+                        help="Also time thumbnail and cutout reads with spatial chunks of this size and pyramid levels")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parser_output = parse_args()
+    results = benchmark_ingest(
+        parser_output.n_frames,
+        parser_output.workers,
+        parser_output.n_channels,
+        parser_output.image_size,
+        parser_output.time_chunk_size,
+        parser_output.work,
+    )
+    print(results.to_string(index=False))
+    results = pd.DataFrame(
+        [
+            benchmark_write_buffer(parser_output.n_frames, parser_output.n_channels, parser_output.image_size, size)
+            for size in sorted({1, parser_output.time_chunk_size, 8, 32})
+        ]
+    )
+    print(results.to_string(index=False))
+    if parser_output.space_chunk_size:
+        results = benchmark_reads(parser_output.n_frames, parser_output.image_size, parser_output.space_chunk_size)
+        print(results.to_string(index=False))
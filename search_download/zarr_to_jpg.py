@@ -13,9 +13,7 @@ import pandas as pd
 from tqdm import tqdm
 
 import zarr
-from numcodecs import Blosc
 
-import xarray as xr
 import dask
 import dask.array as da
 
@@ -23,6 +21,9 @@ from astropy.visualization import ImageNormalize, AsinhStretch
 
 from tqdm.dask import TqdmCallback
 
+from search_download.sdo_zarr import (SHUFFLES, ChunkWriteBuffer, make_compressor, open_sdo_store, select_level,
+                                      select_valid_frames)
+
 # Initialize Python Logger
 logging.basicConfig(
     format="%(levelname)-4s " "[%(module)s:%(funcName)s:%(lineno)d]" " %(message)s"
@@ -61,6 +62,12 @@ class ZarrToJpg:
         Percentile that will be pegged to a stretch position after stretch, by default 40
     stretch_position : float, optional
         Stretch position to wich the percentile above will be mapped, by default 0.4
+    valid_only : bool, optional
+        Skip the time indices where one of the channels failed to load, for stores with a
+        validity array, by default True
+    output_size : int, optional
+        Read the coarsest pyramid level with at least output_size pixels on a side, for
+        stores with pyramid levels, by default the full resolution
     """
 
     def __init__(
@@ -76,6 +83,8 @@ class ZarrToJpg:
         vmax_factor: float = 2.5,
         stretch_percentile: float = 40,
         stretch_position: float = 0.4,
+        valid_only: bool = True,
+        output_size: int = None,
     ):
         # assert (
         #     len(wavelength_order) == 3
@@ -86,10 +95,15 @@ class ZarrToJpg:
         )
         self.channel_index = ["aia" + str(wl).zfill(3) for wl in wavelength_order]
         self.debug = debug
-        self.data = xr.open_zarr(self.aia_path)
-        self.aia_slice = self.data.aia_hmi.loc[:, self.channel_index, :, :]
+        self.data = open_sdo_store(self.aia_path)
+        self.aia_slice = select_level(self.data, "aia_hmi", output_size).loc[:, self.channel_index, :, :]
         self.wavelength_order = wavelength_order
 
+        if valid_only and "valid" in self.data:
+            n_frames = self.aia_slice.shape[0]
+            self.aia_slice = select_valid_frames(self.aia_slice)
+            LOG.info(f"Skipping {n_frames - self.aia_slice.shape[0]} of {n_frames} frames with invalid channels")
+
         if self.debug:
             self.aia_slice = self.aia_slice[0:10, :, :, :]
 
@@ -268,6 +282,18 @@ def parse_args():
         help="Order in which to stack the files, needs to contain only available wavelengths",
     )
     p.add_argument("--debug", action="store_true", help="Only process a few files (10)")
+    p.add_argument(
+        "--output_size",
+        dest="output_size",
+        type=int,
+        default=None,
+        help="Pixels on a side needed, reads the coarsest pyramid level that has them",
+    )
+    p.add_argument(
+        "--keep_invalid",
+        action="store_true",
+        help="Also process the frames whose channels failed to load",
+    )
 
     p.add_argument(
         "--hist_low_lim",
@@ -341,6 +367,39 @@ def parse_args():
         help="Size of chunks in channels",
     )
 
+    p.add_argument(
+        "--write_buffer_mb",
+        dest="write_buffer_mb",
+        type=float,
+        default=2048,
+        help="Memory in MB used to gather complete chunks before writing them",
+    )
+
+    p.add_argument(
+        "--cname",
+        dest="cname",
+        type=str,
+        default="zstd",
+        help="Blosc compressor of the zarr output, see codec_autotune",
+    )
+
+    p.add_argument(
+        "--clevel",
+        dest="clevel",
+        type=int,
+        default=9,
+        help="Blosc compression level of the zarr output",
+    )
+
+    p.add_argument(
+        "--shuffle",
+        dest="shuffle",
+        type=str,
+        default="bitshuffle",
+        choices=list(SHUFFLES),
+        help="Blosc shuffle filter of the zarr output",
+    )
+
     p.add_argument(
         "--space_chunk_size",
         dest="space_chunk_size",
@@ -385,6 +444,8 @@ if __name__ == "__main__":
         vmax_factor=vmax_factor,
         stretch_percentile=stretch_percentile,
         stretch_position=stretch_position,
+        valid_only=not args.keep_invalid,
+        output_size=args.output_size,
     )
 
     if out_format == "jpg":
@@ -397,7 +458,7 @@ if __name__ == "__main__":
         
         # Initialize zarr
         store = zarr.DirectoryStore(zarr_outpath)
-        compressor = Blosc(cname="zstd", clevel=9, shuffle=Blosc.BITSHUFFLE)
+        compressor = make_compressor(args.cname, args.clevel, args.shuffle)
         root = zarr.group(store=store, overwrite=True)
 
         dataset_name = 'aia_jpg'
@@ -409,6 +470,8 @@ if __name__ == "__main__":
             compressor=compressor,
         )
 
+        # Gather whole chunks so that each one is compressed and written once
+        write_buffer = ChunkWriteBuffer(sdo_stacks, max_bytes=int(args.write_buffer_mb * 1024 ** 2))
         for index in tqdm(range(zarr_to_jpg.aia_slice.shape[0]), total=zarr_to_jpg.aia_slice.shape[0], desc='Processing AIA stacks'):
             aia_stack = zarr_to_jpg.aia_slice[index, :, :, :].load()
             for i, channel in enumerate(aia_stack.channel):
@@ -420,7 +483,10 @@ if __name__ == "__main__":
             aia_stack[aia_stack > 255] = 255
             aia_stack = aia_stack.astype('u1')
 
-            sdo_stacks[index, :, :, :] = aia_stack
+            write_buffer.write(index, aia_stack)
+
+        write_buffer.flush()
+        LOG.info(f"Write statistics: {write_buffer.summary()}")
 
         # Set attribute that specifies the dimensions so that xarray can open the zarr
         sdo_stacks.attrs['_ARRAY_DIMENSIONS'] = ['t_obs', 'channel', 'x', 'y']